@@ -56,9 +56,23 @@ echo "Checking permissions for RESERVOIR_MODEL_DIR: ${RESERVOIR_MODEL_DIR} $(ls
 python3 /dreservoir/manage.py makemigrations
 python3 /dreservoir/manage.py makemigrations mainapp
 python3 /dreservoir/manage.py migrate
-python3 /dreservoir/manage.py runmodwsgi --port="${RESERVOIR_PORT}" --user=www-data --group=www-data \
-        --server-root=/etc/mod_wsgi-express-8080 --error-log-format "%M" --log-to-terminal \
-        --reload-on-changes
+
+# Stores the models uploaded with ?async=1, as the same user as the web server
+# so both can write to RESERVOIR_MODEL_DIR.
+runuser -u www-data -- python3 /dreservoir/manage.py process_upload_jobs \
+        --workers="${RESERVOIR_UPLOAD_JOB_WORKERS:-2}" &
+
+# RESERVOIR_SERVER=asgi serves reservoir/asgi.py with uvicorn instead, which
+# sends downloads to slow clients without holding a thread each. Static files
+# are then left to a proxy in front of it.
+if [ "${RESERVOIR_SERVER}" = "asgi" ]; then
+    runuser -u www-data -- uvicorn reservoir.asgi:application --app-dir /dreservoir \
+            --host 0.0.0.0 --port "${RESERVOIR_PORT}" --workers "${RESERVOIR_ASGI_WORKERS:-1}"
+else
+    python3 /dreservoir/manage.py runmodwsgi --port="${RESERVOIR_PORT}" --user=www-data --group=www-data \
+            --server-root=/etc/mod_wsgi-express-8080 --error-log-format "%M" --log-to-terminal \
+            --reload-on-changes
+fi
 # python3 manage.py runserver 8080
 
 exec "$@"
@@ -0,0 +1,194 @@
+"""Synthetic catalogues and timing helpers for the generate_catalogue and
+run_benchmarks commands.
+
+Generated models belong to the CATALOGUE_USERNAME user, which is how they are
+told apart from real ones and deleted.
+"""
+import importlib
+import io
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import zipfile
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+blobstore = importlib.import_module('third_party.3dmr.mainapp.blobstore')
+database = importlib.import_module('third_party.3dmr.mainapp.database')
+geo = importlib.import_module('third_party.3dmr.mainapp.geo')
+serving = importlib.import_module('third_party.3dmr.mainapp.serving')
+mainapp_models = importlib.import_module('third_party.3dmr.mainapp.models')
+mainapp_model = getattr(mainapp_models, 'Model')
+mainapp_latest_model = getattr(mainapp_models, 'LatestModel')
+
+CATALOGUE_USERNAME = 'benchmark_catalogue'
+BUILDING_ID_PREFIX = 'benchmark/'
+
+# Models stored per transaction when generating a catalogue.
+BATCH_SIZE = 500
+
+WORDS = [
+    'abbey', 'arch', 'bank', 'barn', 'bell', 'bridge', 'castle', 'chapel', 'church', 'clock',
+    'court', 'dock', 'factory', 'fort', 'gate', 'hall', 'harbour', 'house', 'library', 'lighthouse',
+    'market', 'mill', 'museum', 'office', 'palace', 'school', 'station', 'theatre', 'tower', 'warehouse',
+]
+
+TAG_KEYS = ['building', 'roof:shape', 'height', 'material', 'colour']
+CATEGORIES = ['tall', 'historic', 'religious', 'industrial', 'residential', 'commercial', 'monuments']
+
+# Locations are spread over a few dense areas, as buildings are.
+CENTERS = [(51.5, -0.12), (48.85, 2.35), (40.71, -74.0), (35.68, 139.69), (-33.87, 151.21)]
+
+
+def building_id(index):
+    return '{}{}'.format(BUILDING_ID_PREFIX, index)
+
+def model_zip(generator, vertices, texture_bytes):
+    """Returns a valid model zip: a grid of about |vertices| vertices with
+    texture coordinates, an MTL file, and a texture of |texture_bytes|.
+    """
+    side = max(2, int(math.sqrt(vertices)))
+    lines = ['mtllib model.mtl', 'usemtl surface']
+    for y in range(side):
+        for x in range(side):
+            lines.append('v {:.4f} {:.4f} {:.4f}'.format(x, y, generator.uniform(0, 2)))
+            lines.append('vt {:.4f} {:.4f}'.format(x / (side - 1), y / (side - 1)))
+    for y in range(side - 1):
+        for x in range(side - 1):
+            a = y * side + x + 1
+            b, c, d = a + 1, a + side, a + side + 1
+            lines.append('f {0}/{0} {1}/{1} {2}/{2}'.format(a, b, d))
+            lines.append('f {0}/{0} {1}/{1} {2}/{2}'.format(a, d, c))
+
+    model_file = io.BytesIO()
+    with zipfile.ZipFile(model_file, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('model.obj', '\n'.join(lines) + '\n')
+        zip_file.writestr('model.mtl', 'newmtl surface\nKd 0.8 0.8 0.8\nmap_Kd texture.png\n')
+        zip_file.writestr('texture.png', generator.getrandbits(8 * texture_bytes).to_bytes(texture_bytes, 'little')
+                          if texture_bytes else b'')
+    return model_file.getvalue()
+
+def model_metadata(generator, index, tags, categories):
+    latitude, longitude = generator.choice(CENTERS)
+    return {
+        'title': ' '.join(generator.choice(WORDS) for _ in range(2))[:32],
+        'building_id': building_id(index),
+        'description': ' '.join(generator.choice(WORDS) for _ in range(20)),
+        'latitude': latitude + generator.gauss(0, 0.05),
+        'longitude': longitude + generator.gauss(0, 0.05),
+        'categories': generator.sample(CATEGORIES, min(categories, len(CATEGORIES))),
+        'tags': {key: generator.choice(WORDS) for key in generator.sample(TAG_KEYS, min(tags, len(TAG_KEYS)))},
+        'translation': [0., 0., 0.],
+        'rotation': 0.,
+        'scale': 1.,
+        'license': 0,
+    }
+
+def get_author():
+    author, _ = User.objects.get_or_create(username=CATALOGUE_USERNAME)
+    return author
+
+def generate_catalogue(count, revisions=1, vertices=100, texture_bytes=4096, tags=2, categories=1,
+                       seed=0, start=0, log=None):
+    """Stores |count| models with |revisions| revisions each, through
+    database.bulk_upload(), and returns the number of revisions stored.
+    """
+    generator = random.Random(seed)
+    author = get_author()
+    stored = 0
+    tmp_dir = tempfile.mkdtemp(prefix='reservoir-catalogue-')
+    try:
+        for revision in range(1, revisions + 1):
+            for batch_start in range(start, start + count, BATCH_SIZE):
+                uploads = []
+                for index in range(batch_start, min(batch_start + BATCH_SIZE, start + count)):
+                    path = os.path.join(tmp_dir, '{}.zip'.format(index))
+                    with open(path, 'wb') as f:
+                        f.write(model_zip(generator, vertices, texture_bytes))
+
+                    options = model_metadata(generator, index, tags, categories)
+                    options['author'] = author
+                    uploads.append((path, options))
+
+                if database.bulk_upload(uploads, workers=os.cpu_count() or 1) is None:
+                    raise RuntimeError('Failed to store generated models.')
+
+                stored += len(uploads)
+                for path, _ in uploads:
+                    os.unlink(path)
+                if log:
+                    log('Stored {} revisions.'.format(stored))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE mainapp_model')
+        cursor.execute('ANALYZE mainapp_latestmodel')
+        cursor.execute('ANALYZE mainapp_location')
+
+    return stored
+
+def catalogue_size():
+    """Returns the number of generated models, not counting the ones added by
+    the upload benchmark.
+    """
+    return mainapp_latest_model.objects.filter(
+        author__username=CATALOGUE_USERNAME, building_id__startswith=BUILDING_ID_PREFIX).count()
+
+def delete_catalogue():
+    """Deletes every generated model and its files, and returns how many
+    there were.
+    """
+    model_ids = list(
+        mainapp_model.objects.filter(author__username=CATALOGUE_USERNAME)
+        .values_list('model_id', flat=True).distinct())
+
+    with mainapp_latest_model.bulk_updates():
+        mainapp_model.objects.filter(model_id__in=model_ids).delete()
+
+    for model_id in model_ids:
+        blobstore.delete_model(model_id)
+        serving.delete_cached_zips(model_id)
+
+    return len(model_ids)
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(function, iterations, prepare=None):
+    """Calls |function| |iterations| times and returns its latency
+    percentiles, throughput and query counts. |function| is passed the
+    iteration number, or what |prepare| returns for it, which isn't timed.
+    """
+    timings = []
+    queries = 0
+    for i in range(iterations):
+        argument = prepare(i) if prepare else i
+        with CaptureQueriesContext(connection) as captured:
+            call_start = time.perf_counter()
+            function(argument)
+            timings.append(time.perf_counter() - call_start)
+        queries += len(captured)
+    total = sum(timings)
+
+    return {
+        'iterations': iterations,
+        'throughput_per_second': iterations / total if total else None,
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'queries_per_call': queries / iterations,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from reservoir.api import benchmark
+
+class Command(BaseCommand):
+    help = 'Adds synthetic models to the catalogue, for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models', type=int, default=1000,
+            help='Number of models to add.')
+        parser.add_argument(
+            '--revisions', type=int, default=1,
+            help='Number of revisions of each model.')
+        parser.add_argument(
+            '--vertices', type=int, default=100,
+            help='Approximate number of vertices of each OBJ file.')
+        parser.add_argument(
+            '--texture-bytes', type=int, default=4096,
+            help='Size of the texture of each model.')
+        parser.add_argument(
+            '--tags', type=int, default=2,
+            help='Number of tags of each model.')
+        parser.add_argument(
+            '--categories', type=int, default=1,
+            help='Number of categories of each model.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the random generator, so catalogues can be reproduced.')
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Delete the synthetic models instead.')
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            deleted = benchmark.delete_catalogue()
+            self.stdout.write('Deleted {} synthetic models.'.format(deleted))
+            return
+
+        start = benchmark.catalogue_size()
+        stored = benchmark.generate_catalogue(
+            options['models'],
+            revisions=options['revisions'],
+            vertices=options['vertices'],
+            texture_bytes=options['texture_bytes'],
+            tags=options['tags'],
+            categories=options['categories'],
+            seed=options['seed'] + start,
+            start=start,
+            log=self.stdout.write)
+
+        self.stdout.write('Added {} revisions, the catalogue has {} synthetic models.'.format(
+            stored, benchmark.catalogue_size()))
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import resource
+import socket
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reservoir.api import benchmark
+
+# Bytes read per client socket read.
+READ_SIZE = 4096
+
+def process_status(pid):
+    """Returns the threads and resident memory of process |pid|, read from
+    /proc, or None if it can't be read, e.g. on another host.
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    return int(fields['Threads']), int(fields['VmRSS'].split()[0]) * 1024
+
+async def request(host, port, path, headers=None, rate=None, receive_buffer=None):
+    """Sends a GET request and reads the whole response, at most |rate|
+    bytes per second if given. Returns the status and the size of the body.
+    """
+    reader, writer = await asyncio.open_connection(host, port, limit=READ_SIZE)
+    try:
+        if receive_buffer:
+            # A small kernel buffer, so the server sees the client is slow
+            # instead of the kernel absorbing the response.
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(host), 'Connection: close']
+        lines.extend('{}: {}'.format(name, value) for name, value in (headers or {}).items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1])
+
+        size = 0
+        start = time.monotonic()
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if rate:
+                delay = size / rate - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        return status, size
+    finally:
+        writer.close()
+
+class Command(BaseCommand):
+    help = ('Downloads a model with many slow concurrent clients, and measures the latency of other '
+            'requests to the same server meanwhile')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', default='http://localhost:8080',
+            help='Base URL of the server.')
+        parser.add_argument(
+            '--path',
+            help='Path downloaded by the slow clients, by default a model of the synthetic catalogue.')
+        parser.add_argument(
+            '--clients', type=int, default=2000,
+            help='Concurrent slow clients.')
+        parser.add_argument(
+            '--rate', type=int, default=32 * 1024,
+            help='Bytes per second each slow client reads.')
+        parser.add_argument(
+            '--probe-path', default='/api/v1/health/',
+            help='Path requested every --probe-interval seconds while the clients download.')
+        parser.add_argument(
+            '--probe-interval', type=float, default=0.1,
+            help='Seconds between probe requests.')
+        parser.add_argument(
+            '--server-pid', type=int,
+            help='Server process, on this host, whose threads and memory are recorded.')
+        parser.add_argument(
+            '--output',
+            help='JSON file the results are written to.')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        host, port = url.hostname, url.port or 80
+        path = options['path'] or '/api/v1/download/building_id/{}/'.format(benchmark.building_id(0))
+
+        # Each client needs a file descriptor.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < options['clients'] + 100:
+            if hard != resource.RLIM_INFINITY and hard < options['clients'] + 100:
+                raise CommandError('At most {} open files are allowed, fewer than --clients.'.format(hard))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (options['clients'] + 100, hard))
+
+        results = asyncio.get_event_loop().run_until_complete(self.run(host, port, path, options))
+
+        self.stdout.write('{clients} clients: {completed} completed, {failed} failed in {duration_seconds:.1f} s, '
+                          '{bytes} bytes.'.format(**results))
+        if results['probe_p50_ms'] is not None:
+            self.stdout.write('{probes} probes meanwhile: p50 {probe_p50_ms:.1f} ms, p99 {probe_p99_ms:.1f} ms, '
+                              'max {probe_max_ms:.1f} ms.'.format(**results))
+        if results['server_max_threads'] is not None:
+            self.stdout.write('Server: at most {server_max_threads} threads and {server_max_rss_bytes} bytes '
+                              'resident.'.format(**results))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('Wrote {}.'.format(options['output']))
+
+    async def run(self, host, port, path, options):
+        done = asyncio.Event()
+        probe_timings = []
+        statuses = []
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    await request(host, port, options['probe_path'])
+                except (OSError, asyncio.IncompleteReadError):
+                    pass
+                else:
+                    probe_timings.append(time.perf_counter() - start)
+                await asyncio.sleep(options['probe_interval'])
+
+        async def watch_server():
+            while not done.is_set():
+                status = process_status(options['server_pid'])
+                if status is not None:
+                    statuses.append(status)
+                await asyncio.sleep(0.5)
+
+        async def client():
+            try:
+                return await request(host, port, path, rate=options['rate'], receive_buffer=READ_SIZE)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                return e, 0
+
+        watchers = [asyncio.ensure_future(probe())]
+        if options['server_pid']:
+            watchers.append(asyncio.ensure_future(watch_server()))
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[client() for _ in range(options['clients'])])
+        duration = time.perf_counter() - start
+        done.set()
+        await asyncio.gather(*watchers)
+
+        completed = [size for status, size in responses if status == 200]
+        return {
+            'clients': options['clients'],
+            'completed': len(completed),
+            'failed': len(responses) - len(completed),
+            'bytes': sum(completed),
+            'duration_seconds': duration,
+            'probes': len(probe_timings),
+            'probe_p50_ms': benchmark.percentile(probe_timings, 0.5) * 1000 if probe_timings else None,
+            'probe_p99_ms': benchmark.percentile(probe_timings, 0.99) * 1000 if probe_timings else None,
+            'probe_max_ms': max(probe_timings) * 1000 if probe_timings else None,
+            'server_max_threads': max(threads for threads, _ in statuses) if statuses else None,
+            'server_max_rss_bytes': max(rss for _, rss in statuses) if statuses else None,
+        }
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from reservoir.api.v1 import jobs
+
+# Seconds between checks for stale jobs.
+REQUEUE_INTERVAL = 60
+
+class Command(BaseCommand):
+    help = 'Stores the models uploaded asynchronously through the API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=2,
+            help='Number of jobs processed concurrently.')
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait before checking an empty queue again.')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the queue is empty instead of waiting for new jobs.')
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        self.processed = 0
+        self.lock = threading.Lock()
+
+        requeued = jobs.requeue_stale_jobs()
+        if requeued:
+            self.stdout.write('Queued {} stale jobs again.'.format(requeued))
+
+        threads = [
+            threading.Thread(target=self.work, args=(options['poll_interval'], options['once']))
+            for _ in range(max(1, options['workers']))
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            last_requeue = time.monotonic()
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+
+                if time.monotonic() - last_requeue > REQUEUE_INTERVAL:
+                    jobs.requeue_stale_jobs()
+                    last_requeue = time.monotonic()
+        except KeyboardInterrupt:
+            # Running jobs are finished before exiting.
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            connection.close()
+
+        self.stdout.write('Processed {} jobs.'.format(self.processed))
+
+    # Runs in each worker thread, which has its own database connection.
+    def work(self, poll_interval, once):
+        try:
+            while not self.stop.is_set():
+                try:
+                    job = jobs.run_next_job()
+                except Exception as e:
+                    self.stderr.write('Failed to claim a job: {}'.format(e))
+                    connection.close()
+                    job = None
+
+                if job is not None:
+                    with self.lock:
+                        self.processed += 1
+                elif once:
+                    return
+                else:
+                    self.stop.wait(poll_interval)
+        finally:
+            connection.close()
@@ -0,0 +1,193 @@
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from reservoir.api import benchmark
+
+BENCHMARKS = [
+    'upload',
+    'revise',
+    'download_building_id',
+    'download_batch',
+    'search_range',
+    'search_full',
+    'lookup_tag',
+    'nightly',
+]
+
+# Building ids per batch download.
+BATCH_SIZE = 50
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def consume(response):
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+class Command(BaseCommand):
+    help = 'Measures the latency, throughput and queries of the main endpoints against the synthetic catalogue'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmarks', nargs='*',
+            help='Benchmarks to run, all by default: {}.'.format(', '.join(BENCHMARKS)))
+        parser.add_argument(
+            '--iterations', type=int, default=50,
+            help='Calls per benchmark. The nightly dump runs a tenth as many times.')
+        parser.add_argument(
+            '--output', default='benchmark-results.json',
+            help='JSON file the results are written to.')
+        parser.add_argument(
+            '--baseline',
+            help='Results of an earlier run to compare with.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the random generator choosing what to request.')
+
+    def handle(self, *args, **options):
+        unknown = set(options['benchmarks']) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+        size = benchmark.catalogue_size()
+        if not size:
+            raise CommandError('The catalogue has no synthetic models, run generate_catalogue first.')
+
+        self.generator = random.Random(options['seed'])
+        self.size = size
+        self.uploaded = []
+
+        author = benchmark.get_author()
+        token, _ = Token.objects.get_or_create(user=author)
+        self.client = Client(HTTP_AUTHORIZATION='Token {}'.format(token.key))
+
+        iterations = max(1, options['iterations'])
+        results = {}
+        for name in [name for name in BENCHMARKS if name in (options['benchmarks'] or BENCHMARKS)]:
+            count = max(1, iterations // 10) if name == 'nightly' else iterations
+            self.stdout.write('Running {} {} times.'.format(name, count))
+            results[name] = benchmark.measure(
+                getattr(self, 'bench_{}'.format(name)), count,
+                prepare=getattr(self, 'prepare_{}'.format(name), None))
+
+        report = {
+            'commit': git_commit(),
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'catalogue_models': size,
+            'results': results,
+        }
+
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+
+        for name, result in results.items():
+            line = '{:<22} p50 {:9.2f} ms  p95 {:9.2f} ms  p99 {:9.2f} ms  {:8.1f}/s  {:6.1f} queries'.format(
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['throughput_per_second'] or 0, result['queries_per_call'])
+            if baseline and name in baseline:
+                line += '  p95 {:+.1f}%'.format(
+                    (result['p95_ms'] / baseline[name]['p95_ms'] - 1) * 100)
+            self.stdout.write(line)
+
+        self.stdout.write('Wrote {}.'.format(options['output']))
+
+    def random_building_id(self):
+        return benchmark.building_id(self.generator.randrange(self.size))
+
+    def model_file(self):
+        return SimpleUploadedFile(
+            'model.zip', benchmark.model_zip(self.generator, 100, 4096), content_type='application/zip')
+
+    def prepare_upload(self, i):
+        # Without a building_id, so every upload creates a model.
+        metadata = benchmark.model_metadata(self.generator, i, 2, 1)
+        metadata['building_id'] = ''
+        metadata['categories'] = ', '.join(metadata['categories'])
+
+        return {
+            'model_file': self.model_file(),
+            'metadata': json.dumps(metadata),
+        }
+
+    def bench_upload(self, data):
+        response = self.client.post(reverse('v1_upload'), data)
+        if response.status_code != 201:
+            raise CommandError('Upload failed: {}'.format(response.content))
+        self.uploaded.append(json.loads(response.content)['model_id'])
+
+    def prepare_revise(self, i):
+        # Revises the models uploaded by the upload benchmark if it ran, so the
+        # catalogue itself is left as generated.
+        if self.uploaded:
+            model_id = self.uploaded[i % len(self.uploaded)]
+        else:
+            model_id = benchmark.mainapp_latest_model.objects.filter(
+                building_id=self.random_building_id()).values_list('model_id', flat=True).first()
+
+        return model_id, self.model_file()
+
+    def bench_revise(self, prepared):
+        model_id, model_file = prepared
+        response = self.client.post(reverse('v1_revise_model', args=[model_id]), {
+            'model_file': model_file,
+        })
+        if response.status_code != 202:
+            raise CommandError('Revision failed: {}'.format(response.content))
+
+    def bench_download_building_id(self, i):
+        consume(self.client.get(reverse('v1_download_building_id', args=[self.random_building_id()])))
+
+    def bench_download_batch(self, i):
+        building_ids = [self.random_building_id() for _ in range(BATCH_SIZE)]
+        consume(self.client.post(
+            reverse('v1_download_batch_building_id'),
+            json.dumps({'building_ids': building_ids}),
+            content_type='application/json'))
+
+    def bench_search_range(self, i):
+        latitude, longitude = self.generator.choice(benchmark.CENTERS)
+        consume(self.client.get(reverse('lookup_range', kwargs={
+            'latitude': str(latitude),
+            'longitude': str(longitude),
+            'distance': '1000',
+        })))
+
+    def bench_search_full(self, i):
+        consume(self.client.post(
+            reverse('search_full'),
+            json.dumps({'title': self.generator.choice(benchmark.WORDS)}),
+            content_type='application/json'))
+
+    def bench_lookup_tag(self, i):
+        tag = 'building={}'.format(self.generator.choice(benchmark.WORDS))
+        consume(self.client.get(reverse('lookup_tag', kwargs={'tag': tag})))
+
+    def bench_nightly(self, i):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            call_command('nightly', output=os.path.join(tmp_dir, 'nightly.zip'), stdout=io.StringIO())
@@ -2,18 +2,20 @@ import importlib
 import logging
 import json
 import os
-import io
+import shutil
+import tempfile
 import time
 import uuid
-import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile, BadZipFile
 
-from pywavefront import Wavefront
-
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseServerError, FileResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseServerError
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.core.serializers import serialize
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Q
 from rest_framework import serializers, status
 from rest_framework.authtoken.models import Token
 from rest_framework.authentication import TokenAuthentication
@@ -21,22 +23,60 @@ from rest_framework.decorators import api_view, authentication_classes, permissi
 from rest_framework.renderers import JSONRenderer
 from rest_framework.permissions import IsAuthenticated
 
-from .database import get_model_path
-from .utils import build_revision_options
+from . import jobs
+from .database import get_latest_models_by_building_ids
+from .utils import build_new_model_options, build_upload_options
 
 DEFAULT_MAX_CHAR_LENGTH = 128
 
+# Most building_ids and model_ids looked up per request.
+MAX_LOOKUP_IDS = 10000
+
+# Fields returned by lookup_batch, besides model_id and building_id.
+LOOKUP_FIELDS = [
+    'revision',
+    'title',
+    'description',
+    'author',
+    'latitude',
+    'longitude',
+    'license',
+    'categories',
+    'tags',
+    'rotation',
+    'scale',
+    'translation',
+    'upload_date',
+]
+
+# Changes returned per page of the change feed, by default and at most.
+DEFAULT_CHANGES_PAGE = 500
+MAX_CHANGES_PAGE = 5000
+
+# Name of the metadata file in batch archives, as downloaded from
+# download_batch_building_id.
+BATCH_METADATA_FILENAME = 'metadata.json'
+
 # Must use dynamic imports from 3dmr as valid python modules cannot start with a number.
-ModelExtractor = getattr(
-    importlib.import_module('third_party.3dmr.mainapp.model_extractor'),
-    'ModelExtractor')
+model_validator = importlib.import_module('third_party.3dmr.mainapp.model_validator')
+validate_model_file = getattr(model_validator, 'validate_model_file')
+ModelValidationError = getattr(model_validator, 'ModelValidationError')
+
+ZipStream = getattr(
+    importlib.import_module('third_party.3dmr.mainapp.zipstream'),
+    'ZipStream')
+blobstore = importlib.import_module('third_party.3dmr.mainapp.blobstore')
+CHANGES = getattr(importlib.import_module('third_party.3dmr.mainapp.utils'), 'CHANGES')
+serving = importlib.import_module('third_party.3dmr.mainapp.serving')
+metrics = importlib.import_module('third_party.3dmr.mainapp.metrics')
 
 database = importlib.import_module('third_party.3dmr.mainapp.database')
 models = importlib.import_module('third_party.3dmr.mainapp.models')
 Model = getattr(models, 'Model')
+Change = getattr(models, 'Change')
 LatestModel = getattr(models, 'LatestModel')
 User = getattr(models, 'User')
-MODEL_DIR = getattr(importlib.import_module('third_party.3dmr.mainapp.utils'), 'MODEL_DIR')
+UploadJob = getattr(models, 'UploadJob')
 
 logger = logging.getLogger(__name__)
 
@@ -48,27 +88,12 @@ LICENSE_CHOICES = [
 class ModelFileField(serializers.FileField):
     def to_internal_value(self, value):
         try:
-            zip_file = ZipFile(value)
-            logger.debug('inspecting zip file.')
-            found_objs = 0 # files with the .obj extension found
-            for name in zip_file.namelist():
-                logger.debug('Found file with name: {}'.format(name))
-                if name.endswith('.obj'):
-                    found_objs += 1
-            if found_objs != 1:
-                logger.debug('No .obj file in upload.')
-                raise serializers.ValidationError('No single .obj file found in your uploaded zip file.', code='invalid')
-
-            with ModelExtractor(zip_file) as extracted_location:
-                try:
-                    scene = Wavefront(extracted_location['obj'])
-                except:
-                    logger.debug('Error parsing OBJ/MTL files.')
-                    raise serializers.ValidationError('Error parsing OBJ/MTL files.', code='invalid')
-        except BadZipFile:
-            logger.debug('BadZipFile exception.')
-            raise serializers.ValidationError('Uploaded file was not a valid zip file.', code='invalid')
+            summary = validate_model_file(value)
+        except ModelValidationError as e:
+            logger.debug('Model validation failed: {}'.format(e))
+            raise serializers.ValidationError(str(e), code='invalid')
 
+        logger.debug('Validated model: {}'.format(summary))
         logger.debug('Custom zip validation successful.')
         return super().to_internal_value(value)
 
@@ -96,6 +121,29 @@ class ModelFileSerializer(serializers.Serializer):
     # the json field with the ModelFileMetadataSerializer
     metadata = serializers.JSONField(required=False)
 
+class SpooledModelFileSerializer(ModelFileSerializer):
+    # Asynchronous uploads are validated by the job processing them.
+    model_file = serializers.FileField()
+
+class LookupBatchSerializer(serializers.Serializer):
+    building_ids = serializers.ListField(child=serializers.CharField(), default=list)
+    model_ids = serializers.ListField(child=serializers.IntegerField(), default=list)
+    fields = serializers.ListField(child=serializers.ChoiceField(LOOKUP_FIELDS), default=LOOKUP_FIELDS)
+    include_files = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        if len(data['building_ids']) + len(data['model_ids']) > MAX_LOOKUP_IDS:
+            raise serializers.ValidationError(
+                'At most {} building_ids and model_ids can be looked up at once.'.format(MAX_LOOKUP_IDS))
+        return data
+
+class ChangesSerializer(serializers.Serializer):
+    since = serializers.RegexField(r'^\d+-\d+$', default='0-0')
+    limit = serializers.IntegerField(min_value=1, max_value=MAX_CHANGES_PAGE, default=DEFAULT_CHANGES_PAGE)
+
+class BatchUploadSerializer(serializers.Serializer):
+    archive = serializers.FileField()
+
 class UserSerializer(serializers.Serializer):
     username = serializers.CharField(max_length=DEFAULT_MAX_CHAR_LENGTH)
     password = serializers.CharField(write_only=True)
@@ -123,6 +171,42 @@ class ModelSerializer(serializers.ModelSerializer):
             'upload_date',
             'tags']
 
+def _wants_async(request):
+    """Whether the client asked for the upload to be processed in the
+    background, with ?async=1 or a 'Prefer: respond-async' header.
+    """
+    if request.query_params.get('async', '').lower() in ('1', 'true'):
+        return True
+    return 'respond-async' in request.META.get('HTTP_PREFER', '')
+
+def _job_data(job):
+    return {
+        'job_id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'model_id': job.model_id,
+        'revision': job.revision,
+        'error': job.error,
+        'created': job.created,
+        'started': job.started,
+        'finished': job.finished,
+    }
+
+def _job_accepted(request, request_id, job):
+    """Responds to an upload queued as |job|, pointing the client to its
+    status.
+    """
+    status_url = request.build_absolute_uri(reverse('v1_upload_job', args=[job.id]))
+
+    response_data = _job_data(job)
+    response_data['request_id'] = request_id
+    response_data['status_url'] = status_url
+
+    response = JsonResponse(response_data, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = status_url
+    return response
+
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
@@ -153,6 +237,7 @@ def delete(request):
 
     options = {
         'model_id': model_id,
+        'author': request.user,
     }
 
     if database.delete_model(options):
@@ -181,28 +266,29 @@ def download_building_id(request, building_id, revision=None):
     m = models.last()
     if not revision:
         revision = get_object_or_404(LatestModel, model_id=m.model_id).revision
+        cache_control = serving.LATEST_CACHE_CONTROL
         logging.info('Revision was unspecified, found latest revision: {}'.format(revision))
     else:
+        cache_control = serving.IMMUTABLE_CACHE_CONTROL
         logging.info('Revision specified as {}'.format(revision))
 
-    model_path = get_model_path(m.model_id, revision)
-    logging.info('model_path: {}'.format(model_path))
-
-    response = FileResponse(open(model_path, 'rb'))
-
-    response['Content-Disposition'] = 'attachment; filename={}_{}.zip'.format(m.model_id, revision)
-    response['Content-Type'] = 'application/zip'
-    response['Cache-Control'] = 'public, max-age=86400'
-
-    return response
+    if not blobstore.has_revision(m.model_id, revision):
+        logging.error('Error reading model from disk: model_id: {}, revision: {}'.format(m.model_id, revision))
+        return HttpResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    logging.error('Error reading model from disk: {}'.format(model_path))
-    return HttpResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    # Revisions never change, so they are served with a strong ETag and byte
+    # ranges, letting clients revalidate and resume downloads.
+    return serving.serve_revision(
+        request, m.model_id, revision, '{}_{}.zip'.format(m.model_id, revision),
+        cache_control=cache_control)
 
 @api_view(['POST'])
 def download_batch_building_id(request):
     """API endpoint for downloading multiple models given a list of building ids.
 
+    Responses have a strong ETag, derived from the revisions and metadata
+    they contain, and are answered with 304 when it is sent as If-None-Match.
+
     Example:
     curl -X -H "Content-Type: application/json" \
       -d '{"building_ids":["way/123", "way/456"]}' \
@@ -225,44 +311,61 @@ def download_batch_building_id(request):
         return HttpResponseBadRequest()
 
 
-    metadata = {}
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, 'a', zipfile.ZIP_STORED, False) as zf:
+    members, metadata = _resolve_batch_building_id(request_id, building_ids)
+    metadata_json = json.dumps(metadata)
 
-        matching_models = Model.objects.filter(building_id__in=building_ids)
-        matching_model_ids = matching_models.values_list('model_id').distinct()
+    # Viewports are requested over and over, so bundles are cached by the
+    # revisions they contain. Empty ones aren't worth it.
+    return serving.serve_bundle(
+        request,
+        serving.bundle_etag([(model_id, revision) for _, model_id, revision in members], metadata_json.encode()),
+        lambda: _stream_batch_building_id(request_id, building_ids, members, metadata_json, start),
+        'models.zip',
+        cache=bool(members))
 
-        for model_id_list in matching_model_ids:
-            model_id = model_id_list[0]
-            latest_model = matching_models.filter(model_id=model_id).latest('revision','id')
+def _resolve_batch_building_id(request_id, building_ids):
+    """Returns the (filename, model_id, revision) of the latest revision of
+    each building id, and the metadata.json of download_batch_building_id.
+    """
+    members = []
+    metadata = {}
 
-            if not latest_model:
-                logging.error('{} No latest_model for model_id {}, this should not happen...'.format(
-                    request_id, model_id))
+    for latest_model in get_latest_models_by_building_ids(building_ids).iterator():
+        if not metadata.get(latest_model.building_id) and not latest_model.is_hidden:
+            model_id = latest_model.model_id
+            revision = latest_model.revision
+            building_id = latest_model.building_id
 
-            if not metadata.get(latest_model.building_id) and not latest_model.is_hidden:
-                revision = latest_model.revision
-                building_id = latest_model.building_id
-                model_path = get_model_path(model_id, revision)
+            if not blobstore.has_revision(model_id, revision):
+                logging.error('{} Error reading model from disk: model_id: {}, revision: {}'.format(
+                    request_id, model_id, revision))
+                continue
 
-                logging.debug(
-                    '{} Packing model with: model_id: {}, building_id: {}, model_path: {}'.format(
-                        request_id, model_id, building_id, model_path))
+            metadata[building_id] = json.loads(JSONRenderer().render(ModelSerializer(latest_model).data))
+            filename = "{}.zip".format(building_id.replace('/','_'))
+            metadata[building_id]['filename'] = filename
+            members.append((filename, model_id, revision))
 
-                metadata[building_id] = json.loads(JSONRenderer().render(ModelSerializer(latest_model).data))
+    return members, metadata
 
-                filename = "{}.zip".format(building_id.replace('/','_'))
-                metadata[building_id]['filename'] = filename
+def _stream_batch_building_id(request_id, building_ids, members, metadata_json, start):
+    """Generates the zip archive for download_batch_building_id.
 
+    Each model zip is sent as it is reassembled from the blob store and
+    metadata.json is written last. The archive only depends on its members
+    and metadata, so a cached copy is identical to a rebuilt one.
+    """
+    stream = ZipStream(date_time=serving.BUNDLE_DATE_TIME)
+
+    for filename, model_id, revision in members:
+        logging.debug(
+            '{} Packing model with: model_id: {}, filename: {}, revision: {}'.format(
+                request_id, model_id, filename, revision))
 
-                zf.write(model_path, '{}.zip'.format(building_id.replace('/', '_')))
-        zf.writestr('metadata.json', json.dumps(metadata))
+        yield from stream.write_chunks(filename, blobstore.revision_chunks(model_id, revision))
 
-    buf.seek(0)
-    response = FileResponse(buf)
-    response['Content-Disposition'] = 'attachment; filename=models.zip'
-    response['Content-Type'] = 'application/zip'
-    response['Cache-Control'] = 'public, max-age=86400'
+    yield from stream.write_str('metadata.json', metadata_json)
+    yield from stream.close()
 
     end = time.perf_counter()
 
@@ -270,14 +373,22 @@ def download_batch_building_id(request):
         '{} Batch download of {} building ids completed in {} seconds'.format(
             request_id, len(building_ids), end-start))
 
-    return response
-
 @api_view(['GET'])
 def health(request):
     logger.debug('Health Check')
     logger.debug('request.META: {}'.format(request.META))
     return HttpResponse(status=status.HTTP_200_OK)
 
+@api_view(['GET'])
+def metrics_view(request):
+    """Returns the request and operation metrics of every server process in
+    the Prometheus text format.
+
+    Example:
+    curl http://localhost:8080/api/v1/metrics/
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
@@ -339,6 +450,9 @@ def revise(request, model_id):
     curl -i -X POST -F 'model_file=@/Some/path/to/a/model.zip' \
     -H 'Authorization: Token [some token]' \
     http://localhost:8080/api/v1/revise/38
+
+    With ?async=1, or a 'Prefer: respond-async' header, the file is queued
+    and a job id is returned at once, see upload_job.
     """
     logger.debug('Fetching model with id: {}'.format(model_id))
 
@@ -361,23 +475,42 @@ def revise(request, model_id):
         return HttpResponseServerError(err_msg)
 
 
+    is_async = _wants_async(request)
+    serializer_class = SpooledModelFileSerializer if is_async else ModelFileSerializer
+
     try:
-        serialized_model = ModelFileSerializer(data=request.data)
+        serialized_model = serializer_class(data=request.data)
     except:
         err_msg = 'Faild to deserialize model data revision.'
         logger.warning(err_msg)
         return HttpResponseBadRequest(err_msg)
 
-    if serialized_model.is_valid():
-        m = database.upload(serialized_model.validated_data.get('model_file'),
-        {'revision': True,
-         'model_id': model_id,
-         'author': request.user})
-    else:
+    if not serialized_model.is_valid():
         err_msg = 'Failed to validate model payload.'
         logger.warning(err_msg)
         return HttpResponseBadRequest(err_msg)
 
+    model_file = serialized_model.validated_data.get('model_file')
+
+    if is_async:
+        try:
+            job = jobs.enqueue(UploadJob.KIND_REVISE, request.user, model_file, {'model_id': model_id})
+        except:
+            err_msg = 'Failed to queue model revision.'
+            logger.exception(err_msg)
+            return HttpResponseServerError(err_msg)
+
+        return _job_accepted(request, uuid.uuid4(), job)
+
+    m = database.upload(model_file,
+    {'revision': True,
+     'model_id': model_id,
+     'author': request.user})
+
+    if m is None:
+        err_msg = 'Failed to revise model with id: {}'.format(model_id)
+        return HttpResponseServerError(err_msg)
+
     response_data = {
         "model_id": model_id,
         "building_id": m.building_id,
@@ -387,6 +520,154 @@ def revise(request, model_id):
 
     return JsonResponse(response_data,status=status.HTTP_202_ACCEPTED)
 
+def _lookup_fields(model, fields):
+    """Returns the |fields| of a LatestModel, as listed in LOOKUP_FIELDS."""
+    location = model.location
+    values = {
+        'revision': lambda: model.revision,
+        'title': lambda: model.title,
+        'description': lambda: model.description,
+        'author': lambda: model.author.username,
+        'latitude': lambda: location.latitude if location else None,
+        'longitude': lambda: location.longitude if location else None,
+        'license': lambda: model.license,
+        'categories': lambda: [category.name for category in model.categories.all()],
+        'tags': lambda: model.tags,
+        'rotation': lambda: model.rotation,
+        'scale': lambda: model.scale,
+        'translation': lambda: [model.translation_x, model.translation_y, model.translation_z],
+        'upload_date': lambda: model.upload_date,
+    }
+
+    return {field: values[field]() for field in fields}
+
+@api_view(['POST'])
+def lookup_batch(request):
+    """Returns the metadata of the latest revisions of many models at once,
+    found by building_id and/or model_id.
+
+    |fields| restricts the metadata returned to some of LOOKUP_FIELDS, and
+    with |include_files| each model also has the size and sha256 of the zip
+    file it is downloaded as, and the ETag of that download. The lookup takes
+    the same number of queries however many ids are given.
+
+    Example:
+    curl -X POST -H "Content-Type: application/json" \
+      -d '{"building_ids": ["way/123", "way/456"], "model_ids": [12], "fields": ["revision", "title"]}' \
+      http://localhost:8080/api/v1/search/batch/
+    """
+    serialized = LookupBatchSerializer(data=request.data)
+    if not serialized.is_valid():
+        err_msg = 'Failed to validate batch lookup: {}'.format(serialized.errors)
+        logger.warning(err_msg)
+        return HttpResponseBadRequest(err_msg)
+
+    building_ids = serialized.validated_data['building_ids']
+    model_ids = serialized.validated_data['model_ids']
+    fields = serialized.validated_data['fields']
+    include_files = serialized.validated_data['include_files']
+
+    models = LatestModel.objects \
+        .filter(Q(building_id__in=building_ids) | Q(model_id__in=model_ids), is_hidden=False) \
+        .select_related('location', 'author') \
+        .order_by('model_id')
+    if 'categories' in fields:
+        models = models.prefetch_related('categories')
+
+    results = []
+    for model in models:
+        result = {
+            'model_id': model.model_id,
+            'building_id': model.building_id,
+        }
+        result.update(_lookup_fields(model, fields))
+
+        if include_files:
+            try:
+                result['file'] = blobstore.get_archive_info(model.model_id, model.revision)
+                result['file']['etag'] = '"{}"'.format(serving.revision_etag(model.model_id, model.revision))
+            except (blobstore.RevisionNotFound, OSError):
+                logger.error('Error reading model from disk: model_id: {}, revision: {}'.format(
+                    model.model_id, model.revision))
+                result['file'] = None
+
+        results.append(result)
+
+    found_building_ids = {result['building_id'] for result in results}
+    found_model_ids = {result['model_id'] for result in results}
+
+    response_payload = {
+        'models': results,
+        'missing': {
+            'building_ids': [building_id for building_id in building_ids if building_id not in found_building_ids],
+            'model_ids': [model_id for model_id in model_ids if model_id not in found_model_ids],
+        },
+    }
+
+    return JsonResponse(response_payload, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def changes(request):
+    """Returns the uploads, revisions, edits, hides, unhides and deletions
+    made after the cursor |since|, oldest first, so that a copy of the
+    catalogue can be kept in sync by fetching what changed since it was last
+    updated.
+
+    Each change has the model_id, revision and building_id it was made to,
+    and the sha256 of the zip file of the revision, as downloaded, which is
+    null for deletions and changes made before it was recorded. Deletions
+    remove every revision of the model. Pages are fetched by passing |next|
+    as |since| until |has_more| is false.
+
+    Changes are ordered by the transaction that recorded them, see
+    Change.txid, and only those of transactions older than every transaction
+    still running are returned. Changes committed later are then always after
+    the cursor, however long their transaction took, while a long running
+    transaction only delays the feed.
+
+    Example:
+    curl http://localhost:8080/api/v1/changes/?since=1234-5678
+    """
+    serialized = ChangesSerializer(data=request.query_params)
+    if not serialized.is_valid():
+        err_msg = 'Failed to validate change feed query: {}'.format(serialized.errors)
+        logger.warning(err_msg)
+        return HttpResponseBadRequest(err_msg)
+
+    since = serialized.validated_data['since']
+    since_txid, since_pk = (int(value) for value in since.split('-'))
+    limit = serialized.validated_data['limit']
+
+    # Transactions with a lower txid have all committed or rolled back.
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        committed_before = cursor.fetchone()[0]
+
+    rows = list(
+        Change.objects
+        .filter(Q(txid__gt=since_txid) | Q(txid=since_txid, pk__gt=since_pk), txid__lt=committed_before)
+        .order_by('txid', 'pk')
+        .values_list('txid', 'pk', 'typeof', 'target_model_id', 'revision', 'building_id', 'sha256', 'datetime')
+        [:limit + 1])
+
+    results = []
+    for txid, pk, typeof, model_id, revision, building_id, sha256, datetime in rows[:limit]:
+        results.append({
+            'cursor': '{}-{}'.format(txid, pk),
+            'type': CHANGES[typeof].lower(),
+            'model_id': model_id,
+            'revision': revision,
+            'building_id': building_id,
+            'sha256': sha256,
+            'datetime': datetime,
+        })
+
+    return JsonResponse({
+        'changes': results,
+        'next': results[-1]['cursor'] if results else since,
+        'has_more': len(rows) > limit,
+    }, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 def search_building_id(request, building_id):
     """Returns model ids matching a query building_id
@@ -402,7 +683,7 @@ def search_building_id(request, building_id):
 
     response_payload = {'models':[]}
 
-    for model in Model.objects.filter(building_id = building_id).order_by('upload_date'):
+    for model in Model.objects.filter(building_id = building_id).select_related('location').order_by('upload_date'):
         response_payload['models'].append(
             {'model_id': model.model_id,
              'title': model.title,
@@ -429,14 +710,20 @@ def upload(request):
     -F 'latitude=38.1' -F 'longitude=2.1' -F 'license=0' -F 'tags=building_id=foo' \
     -H 'Authorization: Token [insert token here]' \
     http://localhost:8080/api/v1/upload/
+
+    With ?async=1, or a 'Prefer: respond-async' header, the file is queued
+    and a job id is returned at once, see upload_job.
     """
 
     request_id = uuid.uuid4() # Generate a unique ID for the request to match log statements.
     logger.debug('{} {} requests file upload.'.format(
         request_id, request.user.username))
 
+    is_async = _wants_async(request)
+    serializer_class = SpooledModelFileSerializer if is_async else ModelFileSerializer
+
     try:
-        serialized_model = ModelFileSerializer(data=request.data)
+        serialized_model = serializer_class(data=request.data)
     except:
         import sys, traceback
         traceback.print_exc(file=sys.stdout)
@@ -465,82 +752,29 @@ def upload(request):
     logger.debug('{} Validated meta data: {}'.format(
         request_id, model_metadata.validated_data))
     validated_data = model_metadata.validated_data
-    building_id = validated_data.get('building_id')
 
-    model = None
-    if not building_id:
-        logging.debug(
-            '{} building_id was not provided in upload request.'.format(request_id))
+    if is_async:
         try:
-            model = database.upload(model_file, {
-                'title': validated_data.get('title'),
-                'building_id': validated_data.get('building_id'),
-                'description': validated_data.get('description'),
-                'latitude': validated_data.get('latitude'),
-                'longitude': validated_data.get('longitude'),
-                'categories': validated_data.get('categories'),
-                'tags': validated_data.get('tags'),
-                'origin': validated_data.get('origin'),
-                'translation': validated_data.get('translation'),
-                'rotation': validated_data.get('rotation'),
-                'scale': validated_data.get('scale'),
-                'license': validated_data.get('license', None),
-                'author':request.user
-            })
+            job = jobs.enqueue(UploadJob.KIND_UPLOAD, request.user, model_file, {'metadata': validated_data})
         except:
-            err_msg = 'Failed to upload model.'
-            logger.warning(err_msg)
+            err_msg = '{} Failed to queue model upload.'.format(request_id)
+            logger.exception(err_msg)
             return HttpResponseServerError(err_msg)
-    else:
-        logging.debug('{} Revising building_id: {}'.format(request_id, building_id))
-        try:
-            m = Model.objects.filter(building_id = building_id).latest('revision', 'id')
 
-            logging.debug(
-                '{} Found existing model with building_id {} and model_id {}'.format(
-                    request_id, building_id, m.model_id))
+        logger.debug('{} Queued upload job {}.'.format(request_id, job.id))
+        return _job_accepted(request, request_id, job)
 
-            try:
-                model = database.upload(model_file,
-                                        build_revision_options(
-                                            m,
-                                            model_file,
-                                            validated_data,
-                                            request.user))
-
-            except:
-                err_msg = '{} Failed to revise model with building id: {}'.format(
-                    request_id, building_id)
-                logger.warning(err_msg)
-                return HttpResponseServerError(err_msg)
-
-        except Model.DoesNotExist:
-            logging.debug('{} No existing model with building_id: {}'.format(request_id, building_id))
+    try:
+        model = database.upload(
+            model_file, build_upload_options(validated_data, model_file, request.user))
+    except:
+        logger.exception('{} Failed to upload model.'.format(request_id))
+        model = None
 
-            try:
-                model = database.upload(model_file, {
-                    'title': model_metadata.validated_data.get('title'),
-                    'building_id': validated_data.get('building_id'),
-                    'description': validated_data.get('description'),
-                    'latitude': validated_data.get('latitude'),
-                    'longitude': validated_data.get('longitude'),
-                    'categories': validated_data.get('categories'),
-                    'tags': validated_data.get('tags'),
-                    'origin': validated_data.get('origin'),
-                    'translation': validated_data.get('translation'),
-                    'rotation': validated_data.get('rotation'),
-                    'scale': validated_data.get('scale'),
-                    'license':validated_data.get('license', None),
-                    'author':request.user
-                })
-            except:
-                err_msg = '{} database.upload failed.'.format(request_id)
-                logger.warning(err_msg)
-                return HttpResponseServerError(err_msg)
-        except:
-            err_msg = '{} Unknown server error'.format(request_id)
-            logger.warning(err_msg)
-            return HttpResponseServerError(err_msg)
+    if model is None:
+        err_msg = '{} Failed to upload model.'.format(request_id)
+        logger.warning(err_msg)
+        return HttpResponseServerError(err_msg)
 
     response_data = {
         "request_id": request_id, # Match request to log statements.
@@ -551,3 +785,157 @@ def upload(request):
     }
 
     return JsonResponse(response_data, safe=False, status=status.HTTP_201_CREATED)
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def upload_job(request, job_id):
+    """Returns the status of an asynchronous upload or revision. Once done,
+    the job has the model_id and revision it stored.
+
+    Example:
+    curl -i -H 'Authorization: Token [insert token here]' \
+    http://localhost:8080/api/v1/jobs/0b5e4cbb-6e0e-4f0f-9a53-92b3a1f7c5f2/
+    """
+    job = get_object_or_404(UploadJob, id=job_id, author=request.user)
+    return JsonResponse(_job_data(job), status=status.HTTP_200_OK)
+
+def _batch_metadata(building_id, entry):
+    """Returns the fields of ModelFileMetadataSerializer for an entry of the
+    metadata.json of a batch archive. Entries are as written by
+    download_batch_building_id, or as the metadata of single uploads.
+    """
+    data = dict(entry)
+    data['building_id'] = building_id
+
+    location = data.get('location')
+    if isinstance(location, dict):
+        data.setdefault('latitude', location.get('latitude'))
+        data.setdefault('longitude', location.get('longitude'))
+
+    # Downloads have the stored translation, which is the opposite of the
+    # uploaded one.
+    if 'translation' not in data and 'translation_x' in data:
+        data['translation'] = [
+            -data.get('translation_x', 0.),
+            -data.get('translation_y', 0.),
+            -data.get('translation_z', 0.)]
+
+    data.setdefault('license', 0)
+    return data
+
+def _extract_batch_model(zip_file, filename, path):
+    """Extracts the model zip |filename| of a batch archive to |path| and
+    validates it. Returns an error message, or None if it is valid.
+    """
+    try:
+        with zip_file.open(filename) as source, open(path, 'wb') as destination:
+            shutil.copyfileobj(source, destination, blobstore.CHUNK_SIZE)
+    except KeyError:
+        return 'Missing model file: {}'.format(filename)
+    except BadZipFile as e:
+        return 'Invalid model file {}: {}'.format(filename, e)
+
+    try:
+        validate_model_file(path)
+    except ModelValidationError as e:
+        return str(e)
+
+    return None
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def upload_batch(request):
+    """Api endpoint to upload many models at once.
+
+    The archive has the layout of the ones from download_batch_building_id:
+    a zip file per model, and a metadata.json mapping each building_id to the
+    metadata of its model and the name of its zip file. Models whose
+    building_id already exists are revised, the others are created. Models are
+    validated concurrently and stored in a single transaction, and the
+    response reports the outcome for each building_id.
+
+    Example:
+    curl -i -X POST -F 'archive=@/Some/path/to/models.zip' \
+    -H 'Authorization: Token [insert token here]' \
+    http://localhost:8080/api/v1/upload/batch/
+    """
+    request_id = uuid.uuid4() # Generate a unique ID for the request to match log statements.
+    serialized = BatchUploadSerializer(data=request.data)
+    if not serialized.is_valid():
+        err_msg = '{} Failed to validate batch upload: {}'.format(request_id, serialized.errors)
+        logger.warning(err_msg)
+        return HttpResponseBadRequest(err_msg)
+
+    try:
+        zip_file = ZipFile(serialized.validated_data['archive'])
+        metadata = json.loads(zip_file.read(BATCH_METADATA_FILENAME).decode())
+        if not isinstance(metadata, dict):
+            raise ValueError('{} must map building ids to metadata'.format(BATCH_METADATA_FILENAME))
+    except (BadZipFile, KeyError, ValueError) as e:
+        err_msg = '{} Invalid batch archive: {}'.format(request_id, e)
+        logger.warning(err_msg)
+        return HttpResponseBadRequest(err_msg)
+
+    logger.debug('{} {} uploads a batch of {} models.'.format(
+        request_id, request.user.username, len(metadata)))
+
+    results = {}
+    pending = []
+    for building_id, entry in metadata.items():
+        if not building_id:
+            results[building_id] = {'status': 'failed', 'error': 'Missing building_id'}
+            continue
+
+        model_metadata = ModelFileMetadataSerializer(
+            data=_batch_metadata(building_id, entry) if isinstance(entry, dict) else None)
+        if not model_metadata.is_valid():
+            results[building_id] = {'status': 'failed', 'error': model_metadata.errors}
+            continue
+
+        filename = entry.get('filename') or '{}.zip'.format(building_id.replace('/', '_'))
+        pending.append((building_id, filename, model_metadata.validated_data))
+
+    tmp_dir = tempfile.mkdtemp(prefix='reservoir-batch-')
+    try:
+        paths = [os.path.join(tmp_dir, '{}.zip'.format(i)) for i in range(len(pending))]
+        with ThreadPoolExecutor(max_workers=max(1, model_validator.VALIDATION_WORKERS)) as executor:
+            errors = list(executor.map(
+                lambda filename, path: _extract_batch_model(zip_file, filename, path),
+                [filename for _, filename, _ in pending], paths))
+
+        uploads = []
+        building_ids = []
+        for (building_id, _, validated_data), path, error in zip(pending, paths, errors):
+            if error is not None:
+                results[building_id] = {'status': 'failed', 'error': error}
+                continue
+
+            uploads.append((path, build_new_model_options(validated_data, request.user)))
+            building_ids.append(building_id)
+
+        if uploads:
+            stored = database.bulk_upload(uploads, workers=model_validator.VALIDATION_WORKERS)
+            if stored is None:
+                err_msg = '{} Failed to store batch upload.'.format(request_id)
+                return HttpResponseServerError(err_msg)
+
+            for building_id, model in zip(building_ids, stored):
+                results[building_id] = {
+                    'status': 'created' if model.revision == 1 else 'revised',
+                    'model_id': model.model_id,
+                    'revision': model.revision,
+                }
+    finally:
+        zip_file.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logger.info('{} Stored {} of a batch of {} models.'.format(request_id, len(uploads), len(metadata)))
+
+    response_data = {
+        'request_id': request_id, # Match request to log statements.
+        'models': results,
+    }
+
+    return JsonResponse(response_data, status=status.HTTP_200_OK)
@@ -8,7 +8,19 @@ from django.db import transaction
 
 logger = logging.getLogger(__name__)
 
-MODEL_DIR = getattr(importlib.import_module('third_party.3dmr.mainapp.utils'), 'MODEL_DIR')
+mainapp_models = importlib.import_module('third_party.3dmr.mainapp.models')
+mainapp_model = getattr(mainapp_models, 'Model')
 
-def get_model_path(model_id, revision):
-    return "{}/{}/{}.zip".format(MODEL_DIR, model_id, revision)
+def get_latest_models_by_building_ids(building_ids):
+    """Returns the latest revision of each model matching any of |building_ids|.
+
+    The whole batch is resolved in a single query using Postgres'
+    DISTINCT ON (model_id), with the location joined in, so the cost in round
+    trips doesn't grow with the number of building ids. Results are ordered
+    by model_id.
+    """
+    return mainapp_model.objects \
+        .filter(building_id__in=building_ids) \
+        .select_related('location') \
+        .order_by('model_id', '-revision', '-id') \
+        .distinct('model_id')
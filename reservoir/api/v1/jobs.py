@@ -0,0 +1,198 @@
+import datetime
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.utils import timezone
+
+from .utils import build_upload_options
+
+logger = logging.getLogger(__name__)
+
+blobstore = importlib.import_module('third_party.3dmr.mainapp.blobstore')
+database = importlib.import_module('third_party.3dmr.mainapp.database')
+model_validator = importlib.import_module('third_party.3dmr.mainapp.model_validator')
+UploadJob = getattr(importlib.import_module('third_party.3dmr.mainapp.models'), 'UploadJob')
+
+# Jobs still running after this long are assumed to belong to a worker that
+# died, and are queued again.
+STALE_AFTER = datetime.timedelta(minutes=30)
+
+# Jobs are given up after being started this many times.
+MAX_ATTEMPTS = 3
+
+FAILED_MESSAGE = 'Failed to store the model.'
+
+
+# Uploads waiting for a worker are kept in the model store rather than on the
+# disk of the node that received them, as any node's worker may run the job.
+SPOOL_PREFIX = 'spool'
+
+def spool(model_file):
+    """Copies an uploaded file to the spool of the model store, and returns
+    its key.
+
+    The copy is durable before this returns, so a job is never queued for a
+    file that a crash could lose.
+    """
+    key = '{}/{}.zip'.format(SPOOL_PREFIX, uuid.uuid4().hex)
+    model_file.seek(0)
+    blobstore.get_storage().write_file(key, model_file, sync=True)
+    return key
+
+def _delete_spool(job):
+    # Jobs queued before the spool moved to the store name a local path.
+    if os.path.isabs(job.spool_path):
+        try:
+            os.unlink(job.spool_path)
+        except FileNotFoundError:
+            pass
+    else:
+        blobstore.get_storage().delete(job.spool_path)
+
+@contextmanager
+def _spooled_file(job):
+    """Yields the path of the spooled file of |job| on the local disk, which
+    is downloaded to a temporary file if the store is remote.
+    """
+    if os.path.isabs(job.spool_path):
+        yield job.spool_path
+        return
+
+    store = blobstore.get_storage()
+    path = store.path(job.spool_path)
+    if path is not None:
+        yield path
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.zip') as f:
+        with store.open(job.spool_path) as source:
+            shutil.copyfileobj(source, f)
+        f.flush()
+        yield f.name
+
+def enqueue(kind, author, model_file, options):
+    """Spools |model_file| and queues a job of |kind| to store it. |options|
+    must be serializable as JSON.
+    """
+    key = spool(model_file)
+    try:
+        return UploadJob.objects.create(
+            id=uuid.uuid4(),
+            author=author,
+            kind=kind,
+            options=options,
+            spool_path=key)
+    except:
+        blobstore.get_storage().delete(key)
+        raise
+
+def claim_next_job():
+    """Marks the oldest queued job as running and returns it, or returns None
+    if there is none. Jobs locked by concurrent workers are skipped, so each
+    job is claimed by a single worker.
+    """
+    with transaction.atomic():
+        job = UploadJob.objects \
+            .select_for_update(skip_locked=True) \
+            .filter(status=UploadJob.STATUS_QUEUED) \
+            .order_by('created') \
+            .first()
+
+        if job is None:
+            return None
+
+        job.status = UploadJob.STATUS_RUNNING
+        job.progress = 'started'
+        job.attempts += 1
+        job.started = timezone.now()
+        job.save(update_fields=['status', 'progress', 'attempts', 'started'])
+
+    return job
+
+def requeue_stale_jobs():
+    """Queues again the jobs of workers which died while running them, and
+    fails those which were already attempted MAX_ATTEMPTS times.
+    """
+    stale = UploadJob.objects.filter(
+        status=UploadJob.STATUS_RUNNING, started__lt=timezone.now() - STALE_AFTER)
+
+    for job in stale.filter(attempts__gte=MAX_ATTEMPTS):
+        _finish(job, UploadJob.STATUS_FAILED, error=FAILED_MESSAGE)
+
+    return stale.update(status=UploadJob.STATUS_QUEUED, progress='')
+
+def _set_progress(job, progress):
+    job.progress = progress
+    job.save(update_fields=['progress'])
+
+def _finish(job, status, model=None, error=''):
+    job.status = status
+    job.progress = status
+    job.error = error[:1024]
+    job.finished = timezone.now()
+    if model is not None:
+        job.model_id = model.model_id
+        job.revision = model.revision
+    job.save(update_fields=['status', 'progress', 'error', 'finished', 'model_id', 'revision'])
+
+    # Kept until the outcome commits, in case the job has to run again.
+    transaction.on_commit(lambda: _delete_spool(job))
+
+def _job_options(job, model_file):
+    if job.kind == UploadJob.KIND_REVISE:
+        return {
+            'revision': True,
+            'model_id': job.options['model_id'],
+            'author': job.author,
+        }
+
+    return build_upload_options(job.options['metadata'], model_file, job.author)
+
+def run_job(job):
+    """Validates and stores the spooled file of a claimed job, and records the
+    outcome on the job.
+    """
+    logger.debug('Running {} job {} of {}.'.format(job.kind, job.id, job.author.username))
+
+    try:
+        with _spooled_file(job) as path:
+            _set_progress(job, 'validating')
+            model_validator.validate_model_file(path)
+
+            _set_progress(job, 'storing')
+            # The revision and the outcome of the job commit together, so a
+            # worker dying in between can't have the job run, and the
+            # revision stored, twice.
+            with open(path, 'rb') as model_file, transaction.atomic():
+                model = database.upload(model_file, _job_options(job, model_file))
+                if model is not None:
+                    _finish(job, UploadJob.STATUS_DONE, model=model)
+    except model_validator.ModelValidationError as e:
+        logger.debug('Job {} failed validation: {}'.format(job.id, e))
+        _finish(job, UploadJob.STATUS_FAILED, error=str(e))
+        return job
+    except Exception:
+        logger.exception('Job {} failed.'.format(job.id))
+        model = None
+
+    if model is None:
+        _finish(job, UploadJob.STATUS_FAILED, error=FAILED_MESSAGE)
+    else:
+        logger.info('Job {} stored revision {} of model {}.'.format(job.id, model.revision, model.model_id))
+
+    return job
+
+def run_next_job():
+    """Claims and runs the oldest queued job. Returns it, or None if the queue
+    was empty.
+    """
+    job = claim_next_job()
+    if job is not None:
+        run_job(job)
+    return job
@@ -0,0 +1,516 @@
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from reservoir.profiling import QueryBudgetMixin
+
+from . import api
+from . import jobs
+
+Model = getattr(importlib.import_module('third_party.3dmr.mainapp.models'), 'Model')
+Location = getattr(importlib.import_module('third_party.3dmr.mainapp.models'), 'Location')
+UploadJob = getattr(importlib.import_module('third_party.3dmr.mainapp.models'), 'UploadJob')
+blobstore = importlib.import_module('third_party.3dmr.mainapp.blobstore')
+database = importlib.import_module('third_party.3dmr.mainapp.database')
+derivatives = importlib.import_module('third_party.3dmr.mainapp.derivatives')
+serving = importlib.import_module('third_party.3dmr.mainapp.serving')
+model_validator = importlib.import_module('third_party.3dmr.mainapp.model_validator')
+
+VALID_OBJ = 'v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n'
+
+
+def model_zip(obj=VALID_OBJ, extra_files=None):
+    """Returns a model zip with |obj| as its model.obj and the name to
+    content dict |extra_files|, as an uploaded file."""
+    model_file = io.BytesIO()
+    with zipfile.ZipFile(model_file, 'w') as zip_file:
+        zip_file.writestr('model.obj', obj)
+        for name, content in (extra_files or {}).items():
+            zip_file.writestr(name, content)
+    model_file.seek(0)
+    model_file.name = 'model.zip'
+    return model_file
+
+
+class ModelStoreMixin:
+    """TestCase mixin keeping the model store in a temporary directory, with
+    an author to own the models."""
+
+    def setUp(self):
+        super().setUp()
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.model_dir = tempfile.mkdtemp()
+        self.next_model_id = 1
+
+        self.patch(blobstore, 'MODEL_DIR', self.model_dir)
+        self.addCleanup(shutil.rmtree, self.model_dir, True)
+
+    def patch(self, target, attribute, value):
+        """Sets |attribute| of |target| to |value| until the test ends."""
+        patcher = mock.patch.object(target, attribute, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_models(self, count, revisions=2, legacy=False):
+        """Creates |count| models, each with |revisions| revisions, and returns
+        their building ids. Revisions are stored in the blob store, or as
+        whole zip files if |legacy|."""
+        building_ids = []
+        models = []
+        for i in range(count):
+            model_id = self.next_model_id
+            self.next_model_id += 1
+            building_id = 'way/{}'.format(model_id)
+            building_ids.append(building_id)
+
+            for revision in range(1, revisions + 1):
+                models.append(Model(
+                    author=self.author,
+                    model_id=model_id,
+                    revision=revision,
+                    title='Model {}/{}'.format(model_id, revision),
+                    building_id=building_id,
+                    description='',
+                    rendered_description='',
+                    license=0))
+
+                model_file = model_zip(
+                    '# {}/{}'.format(model_id, revision), {'texture.png': b'shared texture'})
+
+                if legacy:
+                    blobstore.get_storage().write(
+                        blobstore.legacy_revision_key(model_id, revision), model_file.getvalue())
+                else:
+                    blobstore.store_revision(model_id, revision, model_file)
+
+        Model.objects.bulk_create(models)
+        return building_ids
+
+
+class DownloadBatchBuildingIdTest(ModelStoreMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+
+    def download(self, building_ids):
+        request = self.factory.post(
+            '/api/v1/download/batch/building_id/',
+            json.dumps({'building_ids': building_ids}),
+            content_type='application/json')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api.download_batch_building_id(request)
+            content = b''.join(response.streaming_content)
+
+        return zipfile.ZipFile(io.BytesIO(content)), len(queries)
+
+    def assertReturnsLatestRevisions(self, building_ids):
+        archive, _ = self.download(building_ids)
+        metadata = json.loads(archive.read('metadata.json'))
+
+        self.assertEqual(set(metadata.keys()), set(building_ids))
+        for building_id in building_ids:
+            filename = '{}.zip'.format(building_id.replace('/', '_'))
+            model_id = metadata[building_id]['model_id']
+            self.assertEqual(metadata[building_id]['revision'], 2)
+            self.assertEqual(metadata[building_id]['filename'], filename)
+
+            model_zip = zipfile.ZipFile(io.BytesIO(archive.read(filename)))
+            self.assertEqual(model_zip.read('model.obj'), '# {}/2'.format(model_id).encode())
+            self.assertEqual(model_zip.read('texture.png'), b'shared texture')
+
+    def test_returns_latest_revisions(self):
+        self.assertReturnsLatestRevisions(self.create_models(3))
+
+    def test_returns_legacy_revisions(self):
+        self.assertReturnsLatestRevisions(self.create_models(3, legacy=True))
+
+    def test_revisions_share_blobs(self):
+        self.create_models(3)
+
+        blobs = len(list(blobstore.get_storage().list(blobstore.BLOB_PREFIX)))
+        # One OBJ file per revision, and a single texture.
+        self.assertEqual(blobs, 3 * 2 + 1)
+
+    def test_query_count_is_constant(self):
+        _, small_queries = self.download(self.create_models(10, legacy=True))
+        _, large_queries = self.download(self.create_models(10000, legacy=True))
+
+        self.assertEqual(small_queries, large_queries)
+
+    def post(self, building_ids, **extra):
+        request = self.factory.post(
+            '/api/v1/download/batch/building_id/',
+            json.dumps({'building_ids': building_ids}),
+            content_type='application/json', **extra)
+        response = api.download_batch_building_id(request)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_caches_bundles(self):
+        building_ids = self.create_models(3)
+
+        response, content = self.post(building_ids)
+        self.assertEqual(response.status_code, 200)
+        cached = [files for _, _, files in os.walk(serving.bundle_cache_dir()) if files]
+        self.assertEqual(len(cached), 1)
+
+        # The same revisions, requested in another order.
+        cached_response, cached_content = self.post(list(reversed(building_ids)))
+        self.assertEqual(cached_response['ETag'], response['ETag'])
+        self.assertEqual(cached_response['Content-Length'], str(len(content)))
+        self.assertEqual(cached_content, content)
+
+        # A bundle rebuilt after eviction is the same.
+        serving.evict_bundles(max_bytes=0)
+        _, rebuilt_content = self.post(building_ids)
+        self.assertEqual(rebuilt_content, content)
+
+    def test_not_modified(self):
+        building_ids = self.create_models(2)
+        response, _ = self.post(building_ids)
+
+        not_modified, _ = self.post(building_ids, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+    def test_new_revision_changes_etag(self):
+        building_ids = self.create_models(2)
+        response, _ = self.post(building_ids)
+
+        latest = Model.objects.get(building_id=building_ids[0], revision=2)
+        latest.pk = None
+        latest.revision = 3
+        latest.save()
+        revision_zip = io.BytesIO(b''.join(blobstore.revision_chunks(latest.model_id, 2)))
+        blobstore.store_revision(latest.model_id, 3, revision_zip)
+
+        revised, content = self.post(building_ids, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revised.status_code, 200)
+        self.assertNotEqual(revised['ETag'], response['ETag'])
+        metadata = json.loads(zipfile.ZipFile(io.BytesIO(content)).read('metadata.json'))
+        self.assertEqual(metadata[building_ids[0]]['revision'], 3)
+
+
+class UploadJobTest(ModelStoreMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = APIRequestFactory()
+
+        self.patch(model_validator, 'VALIDATION_WORKERS', 0)
+        # Test cases never commit, so run the spool deletions right away.
+        self.patch(jobs.transaction, 'on_commit', lambda function: function())
+        self.patch(derivatives, 'schedule', lambda model_id, revision: None)
+
+    def upload(self, model_file, building_id='way/1'):
+        request = self.factory.post('/api/v1/upload/?async=1', {
+            'model_file': model_file,
+            'metadata': json.dumps({
+                'building_id': building_id,
+                'latitude': 1.0,
+                'longitude': 2.0,
+                'license': 0,
+            }),
+        }, format='multipart')
+        force_authenticate(request, user=self.author)
+        return api.upload(request)
+
+    def get_job(self, job_id, user):
+        request = self.factory.get('/api/v1/jobs/{}/'.format(job_id))
+        force_authenticate(request, user=user)
+        return api.upload_job(request, job_id=job_id)
+
+    def test_upload_is_queued(self):
+        response = self.upload(model_zip())
+        self.assertEqual(response.status_code, 202)
+
+        data = json.loads(response.content)
+        job = UploadJob.objects.get(id=data['job_id'])
+        self.assertEqual(data['status'], UploadJob.STATUS_QUEUED)
+        self.assertTrue(response['Location'].endswith('/api/v1/jobs/{}/'.format(job.id)))
+        self.assertTrue(blobstore.get_storage().exists(job.spool_path))
+        self.assertFalse(Model.objects.exists())
+
+    def test_job_stores_model(self):
+        data = json.loads(self.upload(model_zip()).content)
+
+        job = jobs.run_next_job()
+        self.assertEqual(str(job.id), data['job_id'])
+        self.assertIsNone(jobs.run_next_job())
+        self.assertFalse(blobstore.get_storage().exists(job.spool_path))
+
+        status = json.loads(self.get_job(job.id, self.author).content)
+        self.assertEqual(status['status'], UploadJob.STATUS_DONE)
+        self.assertEqual(status['revision'], 1)
+
+        model = Model.objects.get(model_id=status['model_id'])
+        self.assertEqual(model.building_id, 'way/1')
+        self.assertTrue(blobstore.has_revision(model.model_id, 1))
+
+        # Later uploads with the same building_id revise the model.
+        self.upload(model_zip())
+        job = jobs.run_next_job()
+        self.assertEqual((job.model_id, job.revision), (model.model_id, 2))
+
+    def test_invalid_model_fails_job(self):
+        self.upload(model_zip('f 1 2 3\n'))
+
+        job = jobs.run_next_job()
+        self.assertEqual(job.status, UploadJob.STATUS_FAILED)
+        self.assertTrue(job.error)
+        self.assertIsNone(job.model_id)
+        self.assertFalse(blobstore.get_storage().exists(job.spool_path))
+        self.assertFalse(Model.objects.exists())
+
+    def test_model_commits_with_job(self):
+        self.upload(model_zip())
+        finish = jobs._finish
+
+        def fail_done(job, status, **kwargs):
+            if status == UploadJob.STATUS_DONE:
+                raise RuntimeError('Worker died')
+            finish(job, status, **kwargs)
+
+        # Failing to record the outcome rolls back the revision, so running
+        # the job again can't store it twice.
+        with mock.patch.object(jobs, '_finish', fail_done):
+            job = jobs.run_next_job()
+        self.assertEqual(job.status, UploadJob.STATUS_FAILED)
+        self.assertFalse(Model.objects.exists())
+
+    def test_jobs_are_private(self):
+        job_id = json.loads(self.upload(model_zip()).content)['job_id']
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+
+        self.assertEqual(self.get_job(job_id, other).status_code, 404)
+        self.assertEqual(self.get_job(job_id, self.author).status_code, 200)
+
+
+class UploadBatchTest(ModelStoreMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = APIRequestFactory()
+        self.patch(model_validator, 'VALIDATION_WORKERS', 0)
+
+    def upload_batch(self, models):
+        """Uploads an archive with a model per building id of |models|, which
+        maps building ids to their OBJ file, and returns the report.
+        """
+        archive = io.BytesIO()
+        metadata = {}
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for building_id, obj in models.items():
+                filename = '{}.zip'.format(building_id.replace('/', '_'))
+                zip_file.writestr(filename, model_zip(obj).getvalue())
+                metadata[building_id] = {
+                    'title': building_id,
+                    'location': {'latitude': 1.0, 'longitude': 2.0},
+                    'translation_x': -1.0,
+                    'categories': 'tall, monuments',
+                    'filename': filename,
+                }
+            zip_file.writestr('metadata.json', json.dumps(metadata))
+        archive.seek(0)
+        archive.name = 'models.zip'
+
+        request = self.factory.post(
+            '/api/v1/upload/batch/', {'archive': archive}, format='multipart')
+        force_authenticate(request, user=self.author)
+        response = api.upload_batch(request)
+        self.assertEqual(response.status_code, 200)
+
+        return json.loads(response.content)['models']
+
+    def test_creates_and_revises_models(self):
+        results = self.upload_batch({'way/1': VALID_OBJ, 'way/2': VALID_OBJ, 'way/3': 'f 1 2 3\n'})
+
+        self.assertEqual(results['way/1']['status'], 'created')
+        self.assertEqual(results['way/2']['status'], 'created')
+        self.assertEqual(results['way/3']['status'], 'failed')
+        self.assertFalse(Model.objects.filter(building_id='way/3').exists())
+
+        model = Model.objects.get(model_id=results['way/1']['model_id'])
+        self.assertEqual(model.revision, 1)
+        self.assertEqual(model.translation_x, -1.0)
+        self.assertEqual(model.location.latitude, 1.0)
+        self.assertEqual(model.location.geohash[:1], 's')
+        self.assertEqual(sorted(model.categories.values_list('name', flat=True)), ['monuments', 'tall'])
+        self.assertTrue(blobstore.has_revision(model.model_id, 1))
+
+        results = self.upload_batch({'way/1': VALID_OBJ, 'way/4': VALID_OBJ})
+
+        self.assertEqual(results['way/1'], {'status': 'revised', 'model_id': model.model_id, 'revision': 2})
+        self.assertEqual(results['way/4']['status'], 'created')
+        self.assertTrue(blobstore.has_revision(model.model_id, 2))
+        self.assertEqual(Model.objects.filter(model_id=model.model_id).count(), 2)
+
+    def test_empty_building_id_fails(self):
+        results = self.upload_batch({'': VALID_OBJ, 'way/1': VALID_OBJ})
+
+        self.assertEqual(results[''], {'status': 'failed', 'error': 'Missing building_id'})
+        self.assertEqual(results['way/1']['status'], 'created')
+        self.assertEqual(Model.objects.count(), 1)
+
+
+class LookupBatchTest(ModelStoreMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+
+    def lookup(self, **data):
+        request = self.factory.post(
+            '/api/v1/search/batch/', json.dumps(data), content_type='application/json')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api.lookup_batch(request)
+
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content), len(queries)
+
+    def test_returns_latest_revisions(self):
+        self.create_models(3)
+        result, _ = self.lookup(building_ids=['way/1', 'way/404'], model_ids=[3, 404])
+
+        self.assertEqual([model['model_id'] for model in result['models']], [1, 3])
+        self.assertEqual(result['models'][0]['revision'], 2)
+        self.assertEqual(result['models'][0]['title'], 'Model 1/2')
+        self.assertEqual(result['missing'], {'building_ids': ['way/404'], 'model_ids': [404]})
+
+    def test_projects_fields(self):
+        self.create_models(1)
+        result, _ = self.lookup(model_ids=[1], fields=['revision'], include_files=True)
+
+        model = result['models'][0]
+        self.assertEqual(set(model.keys()), {'model_id', 'building_id', 'revision', 'file'})
+        content = b''.join(blobstore.revision_chunks(1, 2))
+        self.assertEqual(model['file'], {'size': len(content), 'sha256': hashlib.sha256(content).hexdigest()})
+
+    def test_query_count_is_constant(self):
+        self.create_models(50)
+        _, small_queries = self.lookup(model_ids=[1, 2])
+        _, large_queries = self.lookup(model_ids=list(range(1, 51)))
+
+        self.assertEqual(small_queries, large_queries)
+
+
+class SearchBuildingIdTest(QueryBudgetMixin, TestCase):
+    def test_query_budget(self):
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+        for revision in range(1, 6):
+            Model.objects.create(
+                author=author,
+                model_id=1,
+                revision=revision,
+                title='Model',
+                building_id='way/1',
+                description='',
+                rendered_description='',
+                location=Location.objects.create(latitude=revision, longitude=0),
+                license=0)
+
+        request = RequestFactory().get('/api/v1/search/building_id/way/1/')
+        with self.assertQueryBudget(1):
+            response = api.search_building_id(request, 'way/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [model['latitude'] for model in json.loads(response.content)['models']], [1, 2, 3, 4, 5])
+
+
+# The feed only has changes of committed transactions, so these tests commit.
+class ChangesTest(ModelStoreMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        # Builds would outlive the test.
+        self.patch(derivatives, 'schedule', lambda model_id, revision: None)
+
+    def upload(self, building_id, revision_of=None):
+        options = {
+            'title': 'Model',
+            'building_id': building_id,
+            'description': '',
+            'latitude': None,
+            'longitude': None,
+            'categories': [],
+            'tags': {},
+            'translation': [0, 0, 0],
+            'rotation': 0,
+            'scale': 1,
+            'license': 0,
+            'author': self.author,
+        }
+        if revision_of is not None:
+            options.update(revision=True, model_id=revision_of)
+        return database.upload(model_zip(building_id + str(revision_of)), options)
+
+    def changes(self, **params):
+        response = api.changes(self.factory.get('/api/v1/changes/', params))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_lists_changes_in_order(self):
+        first = self.upload('way/1')
+        self.upload('way/1', revision_of=first.model_id)
+        second = self.upload('way/2')
+        database.set_hidden(second, True, self.author)
+        database.delete_model({'model_id': first.model_id, 'author': self.author})
+
+        result = self.changes()
+        self.assertFalse(result['has_more'])
+        self.assertEqual(
+            [(change['type'], change['model_id'], change['revision']) for change in result['changes']], [
+                ('upload', first.model_id, 1),
+                ('revise', first.model_id, 2),
+                ('upload', second.model_id, 1),
+                ('hide', second.model_id, 1),
+                ('delete', first.model_id, 2),
+            ])
+
+        self.assertNotEqual(result['changes'][1]['sha256'], result['changes'][0]['sha256'])
+        # Mirrors can check their downloads against it.
+        content = b''.join(blobstore.revision_chunks(second.model_id, 1))
+        self.assertEqual(result['changes'][2]['sha256'], hashlib.sha256(content).hexdigest())
+        self.assertEqual(result['changes'][3]['sha256'], result['changes'][2]['sha256'])
+        self.assertIsNone(result['changes'][4]['sha256'])
+        self.assertEqual(result['changes'][4]['building_id'], 'way/1')
+        self.assertEqual(result['next'], result['changes'][-1]['cursor'])
+
+    def test_pages(self):
+        for i in range(5):
+            self.upload('way/{}'.format(i))
+
+        first_page = self.changes(limit=2)
+        self.assertTrue(first_page['has_more'])
+        second_page = self.changes(since=first_page['next'], limit=10)
+        self.assertFalse(second_page['has_more'])
+
+        building_ids = [change['building_id'] for change in first_page['changes'] + second_page['changes']]
+        self.assertEqual(building_ids, ['way/{}'.format(i) for i in range(5)])
+
+    def test_waits_for_running_transactions(self):
+        self.upload('way/1')
+
+        with transaction.atomic():
+            self.upload('way/2')
+
+            # Transactions committing before this one could still add changes
+            # ordered before way/2.
+            result = self.changes()
+            self.assertEqual([change['building_id'] for change in result['changes']], ['way/1'])
+            self.assertFalse(result['has_more'])
+
+        result = self.changes(since=result['next'])
+        self.assertEqual([change['building_id'] for change in result['changes']], ['way/2'])
@@ -20,13 +20,18 @@ from . import api
 
 urlpatterns = [
     path('docs/', include_docs_urls(title='Reservoir API V1')),
+    path('changes/', api.changes, name='v1_changes'),
     path('delete/', api.delete, name='v1_delete'),
     path('health/', api.health, name='v1_health'),
+    path('metrics/', api.metrics_view, name='v1_metrics'),
+    path('jobs/<uuid:job_id>/', api.upload_job, name='v1_upload_job'),
     path('new_token/', api.new_token, name='v1_new_token'),
     # path('register/', api.register, name='v1_register'),
     path('revise/<int:model_id>/', api.revise, name='v1_revise_model'),
+    path('search/batch/', api.lookup_batch, name='v1_lookup_batch'),
     path('search/building_id/<path:building_id>/', api.search_building_id, name='v1_search_building_id'),
     path('download/building_id/<path:building_id>/', api.download_building_id, name='v1_download_building_id'),
     path('download/batch/building_id/', api.download_batch_building_id, name='v1_download_batch_building_id'),
     path('upload/', api.upload, name='v1_upload'),
+    path('upload/batch/', api.upload_batch, name='v1_upload_batch'),
 ]
@@ -49,3 +49,48 @@ def build_revision_options(model, model_file, validated_data, author):
     options['author'] = author
 
     return options
+
+def build_upload_options(validated_data, model_file, author):
+    """Build the options of database.upload() for a model uploaded with the
+    client supplied validated metadata, |validated_data|. The upload revises
+    the latest model with the same building_id if there is one, and creates a
+    new model otherwise.
+    """
+
+    building_id = validated_data.get('building_id')
+    if building_id:
+        try:
+            model = mainapp_model.objects.filter(building_id=building_id).latest('revision', 'id')
+            logger.debug('Revising model_id {} with building_id {}'.format(model.model_id, building_id))
+            return build_revision_options(model, model_file, validated_data, author)
+        except mainapp_model.DoesNotExist:
+            logger.debug('No existing model with building_id: {}'.format(building_id))
+
+    return build_new_model_options(validated_data, author)
+
+def parse_categories(categories):
+    """Splits a comma separated list of category names, as the upload form
+    does.
+    """
+    return [name.strip() for name in (categories or '').split(',') if name.strip()]
+
+def build_new_model_options(validated_data, author):
+    """Build the options of database.upload() for a new model given client
+    supplied validated metadata, |validated_data|.
+    """
+
+    return {
+        'title': validated_data.get('title'),
+        'building_id': validated_data.get('building_id'),
+        'description': validated_data.get('description'),
+        'latitude': validated_data.get('latitude'),
+        'longitude': validated_data.get('longitude'),
+        'categories': parse_categories(validated_data.get('categories')),
+        'tags': validated_data.get('tags'),
+        'origin': validated_data.get('origin'),
+        'translation': validated_data.get('translation'),
+        'rotation': validated_data.get('rotation'),
+        'scale': validated_data.get('scale'),
+        'license': validated_data.get('license', None),
+        'author': author
+    }
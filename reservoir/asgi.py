@@ -0,0 +1,18 @@
+"""
+ASGI config for reservoir project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+served e.g. with:
+
+    uvicorn reservoir.asgi:application
+
+See reservoir/asgi_handler.py for how it differs from wsgi.py.
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reservoir.settings")
+
+from reservoir.asgi_handler import get_asgi_application
+
+application = get_asgi_application()
@@ -0,0 +1,201 @@
+"""Serves the Django application over ASGI, see asgi.py.
+
+Views are synchronous, as Django 2.0 has no async views or database access,
+so each request is handled by a thread of a small pool, but only until the
+view returns its response. The response body, such as a model zip, is then
+sent from the event loop: files and streamed bodies are read a chunk at a
+time in a pool of their own, and the next chunk is only read once the server
+took the previous one. A slow client holds a coroutine and a chunk of memory
+rather than a thread for the whole transfer, which is what limits how many
+clients mod_wsgi can serve at once.
+
+Servers must apply backpressure to send(), as uvicorn does, for slow clients
+not to be buffered in memory.
+"""
+import asyncio
+import logging
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core import signals
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest, get_script_name
+from django.urls import set_script_prefix
+
+logger = logging.getLogger(__name__)
+
+# Size of the reads from files sent as response bodies. With uvicorn's write
+# buffer, each client being sent a file holds about 100 KiB.
+CHUNK_SIZE = 16 * 1024
+
+# Request bodies larger than this, e.g. uploads, are spooled to disk.
+MAX_MEMORY_BODY = 1024 * 1024
+
+def build_environ(scope, body):
+    """Returns the WSGI environ of the HTTP request |scope|, whose body is
+    the file |body|.
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+
+        value = value.decode('latin1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+
+    return environ
+
+def response_headers(response):
+    headers = [(name.encode('latin1'), str(value).encode('latin1')) for name, value in response.items()]
+    for cookie in response.cookies.values():
+        headers.append((b'Set-Cookie', cookie.output(header='').strip().encode('latin1')))
+    return headers
+
+class ASGIHandler(WSGIHandler):
+    """ASGI application running the Django middleware and views in threads,
+    and sending response bodies from the event loop.
+    """
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(
+            settings.RESERVOIR_ASGI_THREADS, thread_name_prefix='reservoir-request')
+        self.io_executor = ThreadPoolExecutor(
+            settings.RESERVOIR_ASGI_IO_THREADS, thread_name_prefix='reservoir-io')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type: {}'.format(scope['type']))
+
+        body = await self.read_body(receive)
+        if body is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(
+                self.executor, self.get_django_response, build_environ(scope, body))
+        finally:
+            body.close()
+
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, disconnected))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': response_headers(response),
+            })
+            await self.send_body(response, send, disconnected, skip=scope['method'] == 'HEAD')
+        finally:
+            watcher.cancel()
+            # Closing sends request_finished, which expects a thread that
+            # may use the database.
+            await loop.run_in_executor(self.executor, response.close)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.io_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """Returns the request body as a file, or None if the client went
+        away before sending all of it.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORY_BODY)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        body.seek(0)
+        return body
+
+    async def watch_disconnect(self, receive, disconnected):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    def get_django_response(self, environ):
+        """Runs the middleware and view for |environ|, as WSGIHandler does,
+        and returns the response without reading its body.
+        """
+        set_script_prefix(get_script_name(environ))
+        signals.request_started.send(sender=self.__class__, environ=environ)
+        request = WSGIRequest(environ)
+        response = self.get_response(request)
+        response._handler_class = self.__class__
+        return response
+
+    async def send_body(self, response, send, disconnected, skip=False):
+        if skip or not response.streaming:
+            await send({
+                'type': 'http.response.body',
+                'body': b'' if skip else response.content,
+            })
+            return
+
+        file_to_stream = getattr(response, 'file_to_stream', None)
+        if file_to_stream is not None:
+            def next_chunk():
+                return file_to_stream.read(CHUNK_SIZE) or None
+        else:
+            iterator = iter(response.streaming_content)
+
+            def next_chunk():
+                return next(iterator, None)
+
+        loop = asyncio.get_running_loop()
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(self.io_executor, next_chunk)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+
+def get_asgi_application():
+    """Returns the ASGI application, as get_wsgi_application() does for WSGI."""
+    django.setup(set_prefix=False)
+    return ASGIHandler()
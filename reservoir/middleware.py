@@ -3,34 +3,84 @@ from django.contrib.auth.models import User, AnonymousUser
 from django.utils.deprecation import MiddlewareMixin
 from django.utils.functional import SimpleLazyObject
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 
 import psycopg2
+import psycopg2.pool
 
+import hashlib
+import importlib
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+metrics = importlib.import_module('third_party.3dmr.mainapp.metrics')
+
 class EditorClient:
+    """Looks up users in the Editor database.
+
+    Connections come from a thread safe pool, opened on first use rather than
+    at import time. A connection that fails, e.g. because the database
+    restarted, is discarded and the query retried once on a new one.
+    """
     def __init__(self):
-        logging.info('Connecting to Editor database.')
-        self.conn_ = psycopg2.connect(
-            database=settings.EDITOR_DB_NAME,
-            user=settings.EDITOR_DB_USER,
-            password=settings.EDITOR_DB_PASSWORD,
-            host=settings.EDITOR_DB_HOST,
-            port=settings.EDITOR_DB_PORT
-        )
+        self.pool_ = None
+        self.pool_lock_ = threading.Lock()
+        # The pool raises rather than waits when all connections are in use.
+        self.slots_ = threading.BoundedSemaphore(settings.EDITOR_DB_MAX_CONNECTIONS)
+
+    def GetPool(self):
+        with self.pool_lock_:
+            if self.pool_ is None:
+                logging.info('Connecting to Editor database.')
+                self.pool_ = psycopg2.pool.ThreadedConnectionPool(
+                    0,
+                    settings.EDITOR_DB_MAX_CONNECTIONS,
+                    database=settings.EDITOR_DB_NAME,
+                    user=settings.EDITOR_DB_USER,
+                    password=settings.EDITOR_DB_PASSWORD,
+                    host=settings.EDITOR_DB_HOST,
+                    port=settings.EDITOR_DB_PORT
+                )
+            return self.pool_
+
+    def Query(self, query, args):
+        with self.slots_:
+            return self.QueryWithPool(self.GetPool(), query, args)
+
+    def QueryWithPool(self, pool, query, args):
+        for attempt in range(2):
+            conn = pool.getconn()
+            # The connection always goes back to the pool, and is closed
+            # unless the query succeeded, as its state is then unknown.
+            close = True
+            try:
+                # Each lookup is a transaction of its own, so the connection
+                # never idles in a transaction between requests.
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(query, args)
+                    rows = cur.fetchall()
+                close = False
+                return rows
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if attempt:
+                    raise
+                logging.warning('Editor database connection failed, reconnecting.')
+            finally:
+                pool.putconn(conn, close=close)
 
     def GetUserFromEmail(self, email):
-        with self.conn_.cursor() as cur:
-            cur.execute("SELECT display_name FROM users WHERE email = %s", (email,))
-            rows = cur.fetchall()
-            if not rows:
-                logging.debug('No rows.')
-                return None
-            display_name = rows[0][0]
-            logging.debug('Found display_name: %s', display_name)
-            return display_name
+        rows = self.Query("SELECT display_name FROM users WHERE email = %s", (email,))
+        if not rows:
+            logging.debug('No rows.')
+            return None
+        display_name = rows[0][0]
+        logging.debug('Found display_name: %s', display_name)
+        return display_name
 
 editor_client = EditorClient()
 
@@ -53,12 +103,29 @@ class DevXEmailMiddleware(MiddlewareMixin):
             logger.warning('Appending developer@example.com to X-EMAIL header - this should only happen in debug mode.')
             request.META['HTTP_X_EMAIL'] = "developer@example.com"
 
+def editor_user_cache_key(email):
+    return 'editor_user:{}'.format(hashlib.sha256(email.encode()).hexdigest())
+
 def get_or_create_authenticated_user(request):
     email = request.META.pop('HTTP_X_EMAIL', None)
     if not email:
         logger.debug('No email found in header.')
         return AnonymousUser()
 
+    # The Reservoir user id and Editor display name of recently seen emails
+    # are cached, so most requests only need to load the user.
+    cache_key = editor_user_cache_key(email)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        user_id, display_name = cached
+        try:
+            user = User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            user = None
+
+        if user is not None and user.email == email and user.username == display_name:
+            return user
+
     # Get the display name from editor DB
     display_name = editor_client.GetUserFromEmail(email)
 
@@ -68,18 +135,20 @@ def get_or_create_authenticated_user(request):
         return AnonymousUser()
 
     # If Reservoir is not aware of this user, create one
-    if not User.objects.filter(email=email).exists():
+    try:
+        user = User.objects.get(email=email)
+    except User.DoesNotExist:
         logger.debug('Found user {} in editor, but not in Reservoir, creating...'.format(display_name))
         user = User.objects.create_user(display_name, email, email)
-        user.save()
     else:
-        user = User.objects.get(email=email)
         #Check the user/display names match
         if user.username != display_name:
             user.username = display_name
             user.save()
 
-    return User.objects.get(email=email)
+    cache.set(cache_key, (user.pk, display_name), settings.EDITOR_USER_CACHE_TIMEOUT)
+
+    return user
 
 def get_user(request):
     if not hasattr(request, '_cached_user'):
@@ -96,3 +165,76 @@ class OAuthProxyAuthenticationMiddleware(MiddlewareMixin):
         )
 
         request.user = SimpleLazyObject(lambda: get_user(request))
+
+class QueryCounter:
+    """Database execute wrapper counting the queries run and their time."""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+class MetricsMiddleware:
+    """Records the latency, status, size and database queries of every
+    response, by URL name, see mainapp/metrics.py.
+
+    The bytes and queries of streamed bodies are recorded once the body has
+    been sent.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+
+        metrics.inc('reservoir_http_requests_total', {
+            'view': view,
+            'method': request.method,
+            'status': str(response.status_code),
+        })
+        metrics.observe('reservoir_http_request_duration_seconds', {'view': view}, duration)
+
+        if getattr(response, 'file_to_stream', None) is not None:
+            # Left to wsgi.file_wrapper, which sends the file without reading
+            # it in Python, so it isn't wrapped.
+            self.record_body(view, int(response.get('Content-Length') or 0), queries)
+        elif response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, view, queries)
+        else:
+            self.record_body(view, len(response.content), queries)
+
+        return response
+
+    def stream(self, content, view, queries):
+        size = 0
+        iterator = iter(content)
+        try:
+            while True:
+                with connection.execute_wrapper(queries):
+                    try:
+                        chunk = next(iterator)
+                    except StopIteration:
+                        return
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.record_body(view, size, queries)
+
+    def record_body(self, view, size, queries):
+        labels = {'view': view}
+        metrics.inc('reservoir_http_response_bytes_total', labels, size)
+        metrics.inc('reservoir_db_queries_total', labels, queries.count)
+        metrics.inc('reservoir_db_query_duration_seconds_total', labels, queries.duration)
@@ -0,0 +1,150 @@
+"""Per-request SQL profiling.
+
+SQLProfilerMiddleware records every query of a request with its time and a
+normalized fingerprint, logs requests slower than
+RESERVOIR_SLOW_REQUEST_SECONDS with their query breakdown, and warns about
+fingerprints repeated more than RESERVOIR_N_PLUS_ONE_THRESHOLD times, which
+are usually related objects loaded one at a time in a loop. It is enabled with
+RESERVOIR_SQL_PROFILING=1.
+
+The same profile is available to code and tests through profile_queries(),
+the profiled() decorator and QueryBudgetMixin.
+"""
+import functools
+import logging
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .middleware import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+# Queries listed in the breakdown of slow requests.
+REPORT_QUERIES = 10
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST_RE = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+def fingerprint(sql):
+    """Returns |sql| with its literals and parameters replaced by ?, and IN
+    lists of any length collapsed, so the queries of a loop share one
+    fingerprint.
+    """
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+class QueryProfile(QueryCounter):
+    """Database execute wrapper recording each query, see QueryCounter."""
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            self.queries.append((fingerprint(sql), sql, duration))
+
+    def fingerprints(self):
+        """Returns {fingerprint: (count, duration)}, the most frequent first."""
+        totals = {}
+        for query_fingerprint, _, duration in self.queries:
+            count, total = totals.get(query_fingerprint, (0, 0.0))
+            totals[query_fingerprint] = (count + 1, total + duration)
+
+        return OrderedDict(sorted(totals.items(), key=lambda item: (-item[1][0], -item[1][1])))
+
+    def repeated(self, threshold):
+        """Returns the fingerprints run more than |threshold| times."""
+        return OrderedDict(
+            (query_fingerprint, totals) for query_fingerprint, totals in self.fingerprints().items()
+            if totals[0] > threshold)
+
+    def report(self, limit=REPORT_QUERIES):
+        lines = ['{} queries in {:.1f} ms'.format(self.count, self.duration * 1000)]
+        for query_fingerprint, (count, duration) in list(self.fingerprints().items())[:limit]:
+            lines.append('  {:5d} x {:8.1f} ms  {}'.format(count, duration * 1000, query_fingerprint))
+        return '\n'.join(lines)
+
+@contextmanager
+def profile_queries():
+    """Records the queries of the enclosed block on the default database."""
+    profile = QueryProfile()
+    with connection.execute_wrapper(profile):
+        yield profile
+
+def log_profile(label, profile, duration):
+    threshold = settings.RESERVOIR_N_PLUS_ONE_THRESHOLD
+    for query_fingerprint, (count, _) in profile.repeated(threshold).items():
+        logger.warning('{}: possible N+1 query, run {} times: {}'.format(label, count, query_fingerprint))
+
+    if duration >= settings.RESERVOIR_SLOW_REQUEST_SECONDS:
+        logger.warning('{}: slow request, {:.1f} ms. {}'.format(label, duration * 1000, profile.report()))
+
+def profiled(view):
+    """Profiles the queries of a view, as SQLProfilerMiddleware does, whether
+    or not the middleware is enabled.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        start = time.perf_counter()
+        with profile_queries() as profile:
+            response = view(request, *args, **kwargs)
+        log_profile('{} {}'.format(request.method, request.path), profile, time.perf_counter() - start)
+        return response
+    return wrapper
+
+class SQLProfilerMiddleware:
+    """Profiles the queries of every request, see the module docstring.
+
+    Queries run while a streamed body is sent are not included.
+    """
+    def __init__(self, get_response):
+        if not settings.RESERVOIR_SQL_PROFILING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with profile_queries() as profile:
+            response = self.get_response(request)
+        log_profile('{} {}'.format(request.method, request.path), profile, time.perf_counter() - start)
+        return response
+
+class QueryBudgetMixin:
+    """TestCase mixin pinning the queries an endpoint may run."""
+
+    @contextmanager
+    def assertQueryBudget(self, max_queries, max_repeats=None):
+        """Fails if the enclosed block runs more than |max_queries| queries,
+        or, with |max_repeats|, any fingerprint more than |max_repeats| times.
+        """
+        with profile_queries() as profile:
+            yield profile
+
+        if profile.count > max_queries:
+            self.fail('Ran {} queries, the budget is {}.\n{}'.format(
+                profile.count, max_queries, profile.report()))
+
+        if max_repeats is not None:
+            repeated = profile.repeated(max_repeats)
+            if repeated:
+                self.fail('Queries repeated more than {} times, likely N+1:\n{}'.format(
+                    max_repeats, '\n'.join(
+                        '{} x {}'.format(count, query_fingerprint)
+                        for query_fingerprint, (count, _) in repeated.items())))
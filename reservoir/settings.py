@@ -89,6 +89,8 @@ AUTHENTICATION_BACKENDS = [
 ]
 
 MIDDLEWARE = [
+    'reservoir.middleware.MetricsMiddleware',
+    'reservoir.profiling.SQLProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -142,6 +144,36 @@ EDITOR_DB_PORT = os.environ.get('EDITOR_DB_PORT', '5432')
 EDITOR_DB_NAME = os.environ.get('EDITOR_DB_NAME', '')
 EDITOR_DB_USER = os.environ.get('EDITOR_DB_USER', '')
 EDITOR_DB_PASSWORD = os.environ.get('EDITOR_DB_PASSWORD', '')
+# Connections kept open to the Editor database, per process.
+EDITOR_DB_MAX_CONNECTIONS = int(os.environ.get('EDITOR_DB_MAX_CONNECTIONS', 4))
+# How long, in seconds, the Editor user matching an email is cached for.
+EDITOR_USER_CACHE_TIMEOUT = int(os.environ.get('EDITOR_USER_CACHE_TIMEOUT', 300))
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+#
+# File based by default, so entries are shared by all processes and threads
+# of the server.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('RESERVOIR_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('RESERVOIR_CACHE_LOCATION', '/tmp/reservoir-cache'),
+    }
+}
+
+# Threads running views, and reading response bodies, per process when served
+# with reservoir/asgi.py.
+RESERVOIR_ASGI_THREADS = int(os.environ.get('RESERVOIR_ASGI_THREADS', 16))
+RESERVOIR_ASGI_IO_THREADS = int(os.environ.get('RESERVOIR_ASGI_IO_THREADS', 16))
+
+# SQL profiling, see reservoir/profiling.py. Off by default, as it keeps every
+# query of a request in memory.
+RESERVOIR_SQL_PROFILING = bool(strtobool(os.environ.get('RESERVOIR_SQL_PROFILING', 'false')))
+# Requests taking longer, in seconds, are logged with their queries.
+RESERVOIR_SLOW_REQUEST_SECONDS = float(os.environ.get('RESERVOIR_SLOW_REQUEST_SECONDS', 1.0))
+# Queries run more times than this in a request are logged as N+1 queries.
+RESERVOIR_N_PLUS_ONE_THRESHOLD = int(os.environ.get('RESERVOIR_N_PLUS_ONE_THRESHOLD', 10))
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
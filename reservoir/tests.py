@@ -0,0 +1,251 @@
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import FileResponse
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+
+from . import asgi_handler
+from . import middleware
+from . import profiling
+
+metrics = importlib.import_module('third_party.3dmr.mainapp.metrics')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class GetOrCreateAuthenticatedUserTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        cache.clear()
+
+        patcher = mock.patch.object(middleware.editor_client, 'GetUserFromEmail', return_value='editor_name')
+        self.get_user_from_email = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def authenticate(self, email='user@example.com'):
+        return middleware.get_or_create_authenticated_user(self.factory.get('/', HTTP_X_EMAIL=email))
+
+    def test_creates_user(self):
+        user = self.authenticate()
+
+        self.assertEqual(user.username, 'editor_name')
+        self.assertEqual(User.objects.get(email='user@example.com'), user)
+
+    def test_cache_hit(self):
+        user = self.authenticate()
+        self.get_user_from_email.reset_mock()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(), user)
+        self.get_user_from_email.assert_not_called()
+
+    def test_renamed_user(self):
+        user = self.authenticate()
+        User.objects.filter(pk=user.pk).update(username='renamed')
+        self.get_user_from_email.reset_mock()
+
+        self.assertEqual(self.authenticate().username, 'editor_name')
+        self.get_user_from_email.assert_called()
+
+    def test_unknown_to_editor(self):
+        self.get_user_from_email.return_value = None
+
+        self.assertTrue(self.authenticate().is_anonymous)
+
+
+class EditorClientTest(SimpleTestCase):
+    def setUp(self):
+        self.pool = mock.MagicMock()
+        self.connection = self.pool.getconn.return_value
+        self.cursor = self.connection.cursor.return_value.__enter__.return_value
+        self.cursor.fetchall.return_value = [('editor_name',)]
+
+    def query(self):
+        return middleware.EditorClient().QueryWithPool(self.pool, 'SELECT 1', ())
+
+    def test_returns_connection(self):
+        self.assertEqual(self.query(), [('editor_name',)])
+        self.pool.putconn.assert_called_once_with(self.connection, close=False)
+
+    def test_retries_failed_connection(self):
+        self.cursor.execute.side_effect = [middleware.psycopg2.OperationalError(), None]
+
+        self.assertEqual(self.query(), [('editor_name',)])
+        self.assertEqual(self.pool.putconn.call_args_list, [
+            mock.call(self.connection, close=True), mock.call(self.connection, close=False)])
+
+    def test_closes_connection_on_any_error(self):
+        for error in (middleware.psycopg2.ProgrammingError(), middleware.psycopg2.DataError(), KeyboardInterrupt()):
+            self.pool.putconn.reset_mock()
+            self.cursor.execute.side_effect = error
+
+            with self.assertRaises(type(error)):
+                self.query()
+            self.pool.putconn.assert_called_once_with(self.connection, close=True)
+
+
+class MetricsMiddlewareTest(TestCase):
+    def setUp(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir, True)
+
+        for patcher in [
+                mock.patch.object(metrics, 'METRICS_DIR', metrics_dir),
+                mock.patch.object(metrics, 'store', metrics.Store())]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_records_requests(self):
+        self.client.get('/api/v1/health/')
+        self.client.get('/api/v1/health/')
+
+        text = self.client.get('/api/v1/metrics/').content.decode()
+        self.assertIn('reservoir_http_requests_total{method="GET",status="200",view="v1_health"} 2', text)
+        self.assertIn('reservoir_http_request_duration_seconds_count{view="v1_health"} 2', text)
+
+    def test_records_streamed_bytes(self):
+        response = self.client.post(
+            '/api/v1/download/batch/building_id/',
+            json.dumps({'building_ids': ['way/1']}),
+            content_type='application/json')
+        size = len(b''.join(response.streaming_content))
+
+        text = metrics.render()
+        self.assertIn('reservoir_http_response_bytes_total{{view="v1_download_batch_building_id"}} {}'.format(size), text)
+        self.assertIn('reservoir_db_queries_total{view="v1_download_batch_building_id"} 1', text)
+
+
+class SQLProfilerTest(profiling.QueryBudgetMixin, TestCase):
+    def test_fingerprint(self):
+        self.assertEqual(
+            profiling.fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'it''s'"),
+            'SELECT * FROM t WHERE id = ? AND name = ?')
+        self.assertEqual(
+            profiling.fingerprint('SELECT *\n  FROM t WHERE id IN (%s, %s, %s)'),
+            profiling.fingerprint('SELECT * FROM t WHERE id IN (%s)'))
+
+    def test_finds_repeated_queries(self):
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(3)]
+
+        with profiling.profile_queries() as profile:
+            for user in users:
+                User.objects.get(pk=user.pk)
+            User.objects.count()
+
+        self.assertEqual(profile.count, 4)
+        self.assertEqual([count for count, _ in profile.repeated(2).values()], [3])
+        self.assertIn('3 x', profile.report())
+
+    def test_query_budget(self):
+        with self.assertQueryBudget(1):
+            User.objects.count()
+
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(1):
+                User.objects.count()
+                User.objects.count()
+
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(10, max_repeats=1):
+                User.objects.count()
+                User.objects.count()
+
+    @override_settings(RESERVOIR_SQL_PROFILING=True, RESERVOIR_SLOW_REQUEST_SECONDS=0)
+    def test_middleware_logs_slow_requests(self):
+        with self.assertLogs(profiling.logger, 'WARNING') as logs:
+            self.client.get('/api/v1/health/')
+
+        self.assertIn('GET /api/v1/health/: slow request', logs.output[0])
+
+
+class ASGIHandlerTest(SimpleTestCase):
+    def setUp(self):
+        self.handler = asgi_handler.ASGIHandler()
+
+    def call(self, method, path, body=b'', headers=()):
+        sent = []
+        requests = [{'type': 'http.request', 'body': body}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # The client stays connected.
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': list(headers)}
+        asyncio.get_event_loop().run_until_complete(self.handler(scope, receive, send))
+        return sent
+
+    def file_response(self, size):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(size))
+        return FileResponse(open(path, 'rb')), path
+
+    def send_body(self, response, disconnect_after=None):
+        sent = []
+        disconnected = asyncio.Event()
+
+        async def send(message):
+            sent.append(message)
+            if disconnect_after is not None and len(sent) >= disconnect_after:
+                disconnected.set()
+
+        asyncio.get_event_loop().run_until_complete(self.handler.send_body(response, send, disconnected))
+        response.close()
+        return sent
+
+    def test_serves_django_views(self):
+        sent = self.call('GET', '/api/v1/health/')
+
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(sent[-1], {'type': 'http.response.body', 'body': b''})
+
+    def test_head_has_no_body(self):
+        sent = self.call('HEAD', '/api/v1/health/')
+
+        self.assertEqual(sent[1:], [{'type': 'http.response.body', 'body': b''}])
+
+    def test_streams_files_in_chunks(self):
+        response, path = self.file_response(3 * asgi_handler.CHUNK_SIZE + 1)
+        sent = self.send_body(response)
+
+        self.assertEqual([len(message['body']) for message in sent], [asgi_handler.CHUNK_SIZE] * 3 + [1, 0])
+        with open(path, 'rb') as f:
+            self.assertEqual(b''.join(message['body'] for message in sent), f.read())
+
+    def test_stops_when_client_disconnects(self):
+        response, _ = self.file_response(10 * asgi_handler.CHUNK_SIZE)
+        sent = self.send_body(response, disconnect_after=2)
+
+        self.assertEqual(len(sent), 2)
+
+    def test_build_environ(self):
+        environ = asgi_handler.build_environ({
+            'method': 'POST',
+            'path': '/api/v1/upload/',
+            'query_string': b'async=1',
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'x-email', b'user@example.com'),
+                (b'accept', b'text/html'),
+                (b'accept', b'application/json'),
+            ],
+        }, None)
+
+        self.assertEqual(environ['PATH_INFO'], '/api/v1/upload/')
+        self.assertEqual(environ['QUERY_STRING'], 'async=1')
+        self.assertEqual(environ['CONTENT_TYPE'], 'application/json')
+        self.assertEqual(environ['HTTP_X_EMAIL'], 'user@example.com')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html,application/json')
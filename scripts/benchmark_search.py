@@ -0,0 +1,96 @@
+import importlib
+import logging
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+
+search = importlib.import_module('third_party.3dmr.mainapp.search')
+mainapp_models = importlib.import_module('third_party.3dmr.mainapp.models')
+mainapp_model = getattr(mainapp_models, 'Model')
+mainapp_latest_model = getattr(mainapp_models, 'LatestModel')
+
+logger = logging.getLogger(__name__)
+
+# The catalogue is grown to each of these sizes in turn.
+DEFAULT_SIZES = (10 * 1000, 100 * 1000, 1000 * 1000)
+BATCH_SIZE = 10000
+QUERIES = 100
+RESULTS_PER_PAGE = 6
+
+# Benchmark models get ids from here on, so they can be told apart from real ones.
+FIRST_MODEL_ID = 1000 * 1000 * 1000
+
+WORDS = [
+    'abbey', 'arch', 'bank', 'barn', 'bell', 'bridge', 'castle', 'chapel', 'church', 'clock',
+    'court', 'dock', 'factory', 'fort', 'gate', 'hall', 'harbour', 'house', 'library', 'lighthouse',
+    'market', 'mill', 'museum', 'office', 'palace', 'school', 'station', 'theatre', 'tower', 'warehouse',
+]
+
+def words(generator, count):
+    # A long tail of rare words, as with street and building names.
+    return ' '.join(
+        generator.choice(WORDS) if generator.random() < 0.7 else
+        '{}{}'.format(generator.choice(WORDS), generator.randrange(100000))
+        for _ in range(count))
+
+def grow(author, generator, start, end):
+    with mainapp_latest_model.bulk_updates():
+        for batch_start in range(start, end, BATCH_SIZE):
+            mainapp_model.objects.bulk_create(
+                mainapp_model(
+                    author=author, model_id=FIRST_MODEL_ID + i, revision=1,
+                    title=words(generator, 3)[:32], description=words(generator, 30)[:512],
+                    rendered_description='', license=0)
+                for i in range(batch_start, min(batch_start + BATCH_SIZE, end)))
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE mainapp_latestmodel')
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000
+
+def run(*args):
+    """Measures search latency as the catalogue grows, comparing ILIKE scans
+    with the indexed search.
+
+    Example:
+    python manage.py runscript benchmark_search
+    python manage.py runscript benchmark_search --script-args 1000 10000
+    """
+    sizes = [int(arg) for arg in args] or DEFAULT_SIZES
+    generator = random.Random(0)
+    author, _ = User.objects.get_or_create(username='benchmark_search')
+    queries = [generator.choice(WORDS) if i % 2 else words(generator, 1) for i in range(QUERIES)]
+
+    def ilike_scan(text):
+        models = mainapp_latest_model.objects.filter(model_id__gte=FIRST_MODEL_ID)
+        models = models.filter(title__icontains=text) | models.filter(description__icontains=text)
+        return list(models.order_by('-pk')[:RESULTS_PER_PAGE])
+
+    def indexed_search(text):
+        return list(search.search_text(mainapp_latest_model.objects.all(), text)[:RESULTS_PER_PAGE])
+
+    try:
+        size = 0
+        for target in sizes:
+            grow(author, generator, size, target)
+            size = target
+
+            logger.info('{} models, {} queries:'.format(size, QUERIES))
+            for label, function in (('ILIKE scan', ilike_scan), ('indexed search', indexed_search)):
+                timings = []
+                for text in queries:
+                    start = time.perf_counter()
+                    function(text)
+                    timings.append(time.perf_counter() - start)
+
+                logger.info('  {:<16} p50 {:8.2f} ms  p95 {:8.2f} ms'.format(
+                    label, percentile(timings, 0.5), percentile(timings, 0.95)))
+    finally:
+        logger.info('Deleting generated models.')
+        with mainapp_latest_model.bulk_updates():
+            mainapp_model.objects.filter(model_id__gte=FIRST_MODEL_ID).delete()
+        author.delete()
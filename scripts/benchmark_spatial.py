@@ -0,0 +1,122 @@
+import importlib
+import logging
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+
+geo = importlib.import_module('third_party.3dmr.mainapp.geo')
+mainapp_models = importlib.import_module('third_party.3dmr.mainapp.models')
+mainapp_model = getattr(mainapp_models, 'Model')
+mainapp_latest_model = getattr(mainapp_models, 'LatestModel')
+mainapp_location = getattr(mainapp_models, 'Location')
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCATIONS = 1000 * 1000
+BATCH_SIZE = 10000
+QUERIES = 50
+DISTANCES = (100, 1000, 10000)
+NEAREST_K = 10
+
+# Benchmark models get ids from here on, so they can be told apart from real ones.
+FIRST_MODEL_ID = 1000 * 1000 * 1000
+
+# Locations are spread over a few dozen dense areas, as buildings are, rather
+# than uniformly over the globe.
+def random_point(generator, centers):
+    latitude, longitude = generator.choice(centers)
+    return (max(-90, min(90, latitude + generator.gauss(0, 0.5))),
+            (longitude + generator.gauss(0, 0.5) + 180) % 360 - 180)
+
+def create_locations(count, generator, centers):
+    author, _ = User.objects.get_or_create(username='benchmark_spatial')
+
+    with mainapp_latest_model.bulk_updates():
+        for start in range(0, count, BATCH_SIZE):
+            locations = []
+            for _ in range(min(BATCH_SIZE, count - start)):
+                latitude, longitude = random_point(generator, centers)
+                locations.append(mainapp_location(
+                    latitude=latitude,
+                    longitude=longitude,
+                    geohash=geo.encode(latitude, longitude)))
+
+            # Postgres sets the ids of bulk created objects.
+            mainapp_location.objects.bulk_create(locations)
+            mainapp_model.objects.bulk_create(
+                mainapp_model(
+                    author=author, model_id=FIRST_MODEL_ID + start + i, revision=1, title='',
+                    description='', rendered_description='', license=0, location=location)
+                for i, location in enumerate(locations))
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE mainapp_location')
+        cursor.execute('ANALYZE mainapp_latestmodel')
+
+    return author
+
+def delete_locations(author):
+    with mainapp_latest_model.bulk_updates():
+        # Deleting the locations deletes their models too.
+        mainapp_location.objects.filter(model__model_id__gte=FIRST_MODEL_ID).delete()
+    author.delete()
+
+# The search before the geohash index: a box around the circle, over the
+# unindexed latitude and longitude columns.
+def bounding_box_filter(models, latitude, longitude, distance):
+    min_latitude, max_latitude, min_longitude, max_longitude = \
+        geo.bounding_box(latitude, longitude, distance)
+
+    return models.filter(
+            location__latitude__gte=min_latitude,
+            location__latitude__lte=max_latitude,
+            location__longitude__gte=min_longitude,
+            location__longitude__lte=max_longitude)
+
+def time_queries(points, function):
+    timings = []
+    for latitude, longitude in points:
+        start = time.perf_counter()
+        function(latitude, longitude)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings) * 1000, max(timings) * 1000
+
+def run(*args):
+    """Compares the bounding box scan with geohash searches on generated locations.
+
+    Example:
+    python manage.py runscript benchmark_spatial
+    python manage.py runscript benchmark_spatial --script-args 100000
+    """
+    count = int(args[0]) if args else DEFAULT_LOCATIONS
+    generator = random.Random(0)
+    centers = [(generator.uniform(-60, 70), generator.uniform(-180, 180)) for _ in range(50)]
+
+    logger.info('Creating {} locations.'.format(count))
+    author = create_locations(count, generator, centers)
+
+    try:
+        points = [random_point(generator, centers) for _ in range(QUERIES)]
+        models = mainapp_latest_model.objects.all()
+
+        for distance in DISTANCES:
+            logger.info('Range search, {} m, {} queries:'.format(distance, QUERIES))
+            for label, function in (
+                    ('bounding box scan', lambda lat, lon: list(
+                        bounding_box_filter(models, lat, lon, distance).values_list('model_id', flat=True))),
+                    ('geohash index', lambda lat, lon: list(
+                        geo.within(models, lat, lon, distance).values_list('model_id', flat=True)))):
+                median, worst = time_queries(points, function)
+                logger.info('  {:<20} median {:8.2f} ms  max {:8.2f} ms'.format(label, median, worst))
+
+        logger.info('{} nearest, {} queries:'.format(NEAREST_K, QUERIES))
+        median, worst = time_queries(
+            points, lambda lat, lon: geo.nearest(models, lat, lon, NEAREST_K))
+        logger.info('  {:<20} median {:8.2f} ms  max {:8.2f} ms'.format('geohash index', median, worst))
+    finally:
+        logger.info('Deleting generated locations.')
+        delete_locations(author)
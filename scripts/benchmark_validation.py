@@ -0,0 +1,135 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import zipfile
+
+from pywavefront import Wavefront
+
+blobstore = importlib.import_module('third_party.3dmr.mainapp.blobstore')
+storage = importlib.import_module('third_party.3dmr.mainapp.storage')
+model_extractor = importlib.import_module('third_party.3dmr.mainapp.model_extractor')
+ModelExtractor = getattr(model_extractor, 'ModelExtractor')
+MAX_UNCOMPRESSED_SIZE = getattr(model_extractor, 'MAX_UNCOMPRESSED_SIZE')
+model_validator = importlib.import_module('third_party.3dmr.mainapp.model_validator')
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed sizes of the generated models.
+SIZES = {
+    'small': 100 * 1000,
+    'medium': 10 * 1000 * 1000,
+    'max': int(MAX_UNCOMPRESSED_SIZE * 0.9),
+}
+
+REPEATS = 3
+
+def write_model(path, size):
+    """Writes a textured grid mesh of roughly |size| uncompressed bytes to a zip file at |path|."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('model.mtl', 'newmtl wall\nKd 0.8 0.8 0.8\nmap_Kd texture.png\n')
+        zf.writestr('texture.png', os.urandom(64 * 1024))
+
+        # Each grid cell adds a vertex, a texture coordinate and two faces,
+        # about 125 bytes in total.
+        side = max(2, int((size / 125) ** 0.5))
+        with zf.open('model.obj', 'w') as obj:
+            obj.write(b'mtllib model.mtl\nusemtl wall\n')
+            for y in range(side):
+                obj.write(''.join(
+                    'v {:.6f} {:.6f} 0.0\nvt {:.6f} {:.6f}\n'.format(x, y, x / side, y / side)
+                    for x in range(side)).encode())
+            for y in range(side - 1):
+                lines = []
+                for x in range(side - 1):
+                    a = y * side + x + 1
+                    b, c, d = a + 1, a + side, a + side + 1
+                    lines.append('f {0}/{0} {1}/{1} {2}/{2}\nf {1}/{1} {3}/{3} {2}/{2}\n'.format(a, b, c, d))
+                obj.write(''.join(lines).encode())
+
+def extract_and_parse(path):
+    """The validation done before the streaming validator."""
+    with zipfile.ZipFile(path) as zip_file:
+        with ModelExtractor(zip_file) as extracted_location:
+            Wavefront(extracted_location['obj'])
+
+def validate_in_process(path):
+    with zipfile.ZipFile(path) as zip_file:
+        model_validator.validate_zip(zip_file)
+
+def validate_in_pool(path):
+    model_validator.validate_model_file(path)
+
+def best_of(function, path):
+    """Returns the best time of |function| over REPEATS runs, the peak RSS in MB of
+    the process running it, and the peak RSS in MB of any worker process it used."""
+    timings = []
+    for _ in range(REPEATS):
+        # Or later runs would only look up the summary of the OBJ file.
+        shutil.rmtree(blobstore.MODEL_DIR, ignore_errors=True)
+
+        start = time.perf_counter()
+        function(path)
+        timings.append(time.perf_counter() - start)
+
+    # RUSAGE_CHILDREN only counts workers once they have exited and been waited for.
+    model_validator.shutdown()
+    return (min(timings),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024)
+
+def measure(function, path):
+    """Runs best_of() in a fresh process so peak memory use is not shared between strategies."""
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+
+    def child():
+        try:
+            sender.send(best_of(function, path))
+        except Exception as e:
+            sender.send(e)
+
+    process = context.Process(target=child)
+    process.start()
+    result = receiver.recv()
+    process.join()
+
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def run(*args):
+    """Compares model validation strategies on generated models.
+
+    Example:
+    python manage.py runscript benchmark_validation
+    python manage.py runscript benchmark_validation --script-args small medium
+    """
+    sizes = args or SIZES.keys()
+    directory = tempfile.mkdtemp()
+
+    # Validation summaries are written to the model store, which is kept out
+    # of the way of the real one.
+    storage.BACKEND = 'filesystem'
+    blobstore.MODEL_DIR = os.path.join(directory, 'models')
+
+    try:
+        for name in sizes:
+            path = os.path.join(directory, '{}.zip'.format(name))
+            write_model(path, SIZES[name])
+            logger.info('{} model: {} bytes uncompressed, {} bytes compressed.'.format(
+                name, sum(info.file_size for info in zipfile.ZipFile(path).infolist()),
+                os.path.getsize(path)))
+
+            for label, function in (('extract + pywavefront', extract_and_parse),
+                                    ('streaming, in process', validate_in_process),
+                                    ('streaming, worker pool', validate_in_pool)):
+                seconds, peak_rss, worker_peak_rss = measure(function, path)
+                logger.info('  {:<24} {:8.3f}s  {:6} MB peak RSS, {:6} MB in workers'.format(
+                    label, seconds, peak_rss, worker_peak_rss))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
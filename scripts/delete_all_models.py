@@ -1,6 +1,5 @@
 import importlib
 import logging
-import glob
 import os
 import shutil
 import sys
@@ -9,9 +8,11 @@ mainapp_database = importlib.import_module('third_party.3dmr.mainapp.database')
 mainapp_upload = getattr(mainapp_database, 'upload')
 mainapp_models = importlib.import_module('third_party.3dmr.mainapp.models')
 mainapp_model = getattr(mainapp_models, 'Model')
+mainapp_latest_model = getattr(mainapp_models, 'LatestModel')
 mainapp_location = getattr(mainapp_models, 'Location')
 mainapp_change = getattr(mainapp_models, 'Change')
-MODEL_DIR = getattr(importlib.import_module('third_party.3dmr.mainapp.utils'), 'MODEL_DIR')
+blobstore = importlib.import_module('third_party.3dmr.mainapp.blobstore')
+serving = importlib.import_module('third_party.3dmr.mainapp.serving')
 
 logger = logging.getLogger(__name__)
 
@@ -23,17 +24,25 @@ def run(*args):
     logger.info('Deleting all models and data.')
 
     logger.info('Cearing database model entries.')
-    mainapp_model.objects.all().delete()
-    mainapp_location.objects.all().delete()
-    mainapp_change.objects.all().delete()
+    # Skip the per-statement LatestModel maintenance, it is rebuilt once at the end.
+    with mainapp_latest_model.bulk_updates():
+        mainapp_model.objects.all().delete()
+        mainapp_location.objects.all().delete()
+        mainapp_change.objects.all().delete()
 
 
-    model_dir_glob = os.path.join(MODEL_DIR,'[0-9]*')
-    logger.info('model_dir_glob = {}'.format(model_dir_glob))
-
-    paths_to_delete = glob.glob(model_dir_glob)
-    logger.info('Found {} paths to delete.'.format(len(paths_to_delete)))
+    logger.info('Deleting the model store.')
     failed_paths = []
+    try:
+        blobstore.delete_all()
+    except:
+        e = sys.exc_info()[0]
+        logger.error('Failed to delete the model store, reason: {}'.format(e))
+        failed_paths.append('model store')
+
+    paths_to_delete = [
+        path for path in (serving.zip_cache_dir(), serving.bundle_cache_dir()) if os.path.isdir(path)]
+    logger.info('Found {} paths to delete.'.format(len(paths_to_delete)))
     for target_dir in paths_to_delete:
         try:
             logger.info('Deleting {}'.format(target_dir))
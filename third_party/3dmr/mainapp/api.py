@@ -1,32 +1,113 @@
-import math
+import base64
+import binascii
 import json
+import hashlib
 from collections import defaultdict
-from zipfile import ZipFile
 
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.models import User
-from django.http import JsonResponse, FileResponse, Http404, HttpResponseBadRequest, HttpResponse
-from django.core.paginator import Paginator, EmptyPage
-from django.db.models import Max
+from django.http import JsonResponse, Http404, HttpResponseBadRequest, HttpResponse
+from django.db.models import Avg, Count, F, FloatField, Func, Max, Min, Sum
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 
 from .models import LatestModel, Comment, Model
-from .utils import get_kv, MODEL_DIR, admin
+from .utils import get_kv, admin
+from . import blobstore
+from . import derivatives
+from . import geo
+from . import info_cache
+from . import search
+from . import serving
 
 RESULTS_PER_API_CALL= 20
+MAX_RESULTS_PER_API_CALL = 1000
 
-# returns a paginated json response
-def api_paginate(models, page_id):
-    paginator = Paginator(models, RESULTS_PER_API_CALL)
+class InvalidPage(ValueError):
+    pass
+
+def encode_cursor(model_id):
+    return base64.urlsafe_b64encode(json.dumps({'after': model_id}).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))['after'])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise InvalidPage('Invalid cursor')
+
+def parse_limit(limit):
+    if limit is None:
+        return RESULTS_PER_API_CALL
+
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise InvalidPage('Invalid limit')
+
+    if limit < 1:
+        raise InvalidPage('Invalid limit')
+
+    return min(limit, MAX_RESULTS_PER_API_CALL)
+
+# Returns a page of |models| and the cursor of the next page, if any.
+#
+# When |cursor| is None, pages are numbered from 1 as they always were, and
+# the next cursor is None. Otherwise models are ordered by model_id and the
+# page starts after the model the cursor points at, or at the first model for
+# an empty cursor. Cursor pages cost the same however deep they are, as they
+# are found through the model_id index rather than by skipping the models
+# before them.
+def get_page(models, page_id=1, cursor=None, limit=None):
+    limit = parse_limit(limit)
+
+    if cursor is None:
+        page_id = int(page_id)
+        if page_id < 1:
+            return [], None
+
+        start = (page_id - 1) * limit
+        return list(models[start:start + limit]), None
+
+    models = models.order_by('model_id')
+    if cursor:
+        models = models.filter(model_id__gt=decode_cursor(cursor))
+
+    # Fetching one more model tells whether there is a next page.
+    results = list(models[:limit + 1])
+    if len(results) > limit:
+        return results[:limit], encode_cursor(results[limit - 1].model_id)
+
+    return results, None
+
+# Returns the page of |models| that the "cursor" and "limit" entries of
+# |params| ask for, the query string by default, see get_page().
+def request_page(request, models, page_id, params=None):
+    if params is None:
+        params = request.GET
+
+    return get_page(models, page_id, params.get('cursor'), params.get('limit'))
+
+# Turns the results of a page into a json response: the results alone for
+# numbered pages, or {"results": [...], "next": cursor} in cursor mode.
+def page_response(results, next_cursor, cursor_mode):
+    if not cursor_mode:
+        return JsonResponse(results, safe=False)
+
+    return JsonResponse({'results': results, 'next': next_cursor})
+
+# returns a paginated json response of model ids
+def api_paginate(request, models, page_id, params=None):
+    if params is None:
+        params = request.GET
 
     try:
-        model_results = paginator.page(page_id)
-    except EmptyPage:
-        model_results = []
+        model_results, next_cursor = request_page(request, models.only('model_id'), page_id, params)
+    except InvalidPage as e:
+        return HttpResponseBadRequest(str(e))
 
     results = [model.model_id for model in model_results]
 
-    return JsonResponse(results, safe=False)
+    return page_response(results, next_cursor, params.get('cursor') is not None)
 
 # decorator for returning 'Access-Control-Allow-Origin' header
 def any_origin(f):
@@ -36,13 +117,18 @@ def any_origin(f):
         return response
     return request
 
-# Create your views here.
-@any_origin
-def get_info(request, model_id):
-    model = get_object_or_404(LatestModel, model_id=model_id)
+# Reads the metadata of a model for get_info(), or returns None if it does not
+# exist or, unless |is_admin|, is hidden. Hidden comments are only included
+# for admins.
+def read_info(model_id, is_admin=False):
+    model = LatestModel.objects \
+        .select_related('author', 'location') \
+        .prefetch_related('categories') \
+        .filter(model_id=model_id) \
+        .first()
 
-    if model.is_hidden and not admin(request):
-        raise Http404('Model does not exist.')
+    if model is None or (model.is_hidden and not is_admin):
+        return None
 
     if model.location:
         latitude = model.location.latitude
@@ -52,10 +138,10 @@ def get_info(request, model_id):
         longitude = None
 
     comments = Comment.objects.filter(model__model_id=model.model_id)
-    if not admin(request):
+    if not is_admin:
         comments = comments.filter(is_hidden=False)
 
-    result = {
+    return {
         'id': model.model_id,
         'revision': model.revision,
         'title': model.title,
@@ -69,30 +155,66 @@ def get_info(request, model_id):
         'scale': model.scale,
         'translation': [model.translation_x, model.translation_y, model.translation_z],
         'tags': model.tags,
+        'categories': [category.name for category in model.categories.all()],
 
         # Note: the [::1] evaluates the query set to a list
-        'categories': model.categories.all().values_list('name', flat=True)[::1],
         'comments': comments.values_list('author__username', 'comment', 'datetime')[::1],
     }
 
+# Create your views here.
+@any_origin
+def get_info(request, model_id):
+    # What admins see is not cached, see info_cache.
+    if admin(request):
+        result = read_info(model_id, is_admin=True)
+    else:
+        result = info_cache.get_or_build(model_id, lambda: read_info(model_id))
+
+    if result is None:
+        raise Http404('Model does not exist.')
+
     return JsonResponse(result)
 
 @any_origin
 def get_model(request, model_id, revision=None):
+    cache_control = serving.IMMUTABLE_CACHE_CONTROL
     if not revision:
         revision = get_object_or_404(LatestModel, model_id=model_id).revision
+        cache_control = serving.LATEST_CACHE_CONTROL
 
     model = get_object_or_404(Model, model_id=model_id, revision=revision)
 
     if model.is_hidden and not admin(request):
         raise Http404('Model does not exist.')
 
+    if not blobstore.has_revision(model_id, revision):
+        raise Http404('Model file does not exist.')
 
-    response = FileResponse(open('{}/{}/{}.zip'.format(MODEL_DIR, model_id, revision), 'rb'))
-    response['Content-Disposition'] = 'attachment; filename={}.zip'.format(revision)
-    response['Content-Type'] = 'application/zip'
-    response['Cache-Control'] = 'public, max-age=86400'
-    return response
+    return serving.serve_revision(
+        request, model_id, revision, '{}.zip'.format(revision), cache_control=cache_control)
+
+# Serves a GLB version of a model, at level of detail |level|: 0 is the full
+# model, higher levels are simplified. See derivatives.py.
+@any_origin
+def get_glb(request, model_id, revision=None, level=0):
+    cache_control = serving.IMMUTABLE_CACHE_CONTROL
+    if not revision:
+        revision = get_object_or_404(LatestModel, model_id=model_id).revision
+        cache_control = serving.LATEST_CACHE_CONTROL
+
+    model = get_object_or_404(Model, model_id=model_id, revision=revision)
+
+    if model.is_hidden and not admin(request):
+        raise Http404('Model does not exist.')
+
+    try:
+        lod = derivatives.get_lod(model_id, revision, int(level))
+    except derivatives.DerivativesNotFound:
+        raise Http404('Model has no such level of detail, or it is still being built.')
+
+    filename = '{}_{}_lod{}.glb'.format(model_id, revision, level)
+    return serving.serve_blob(
+        request, lod['sha256'], lod['size'], filename, 'model/gltf-binary', cache_control)
 
 @any_origin
 def get_filelist(request, model_id, revision=None):
@@ -104,29 +226,31 @@ def get_filelist(request, model_id, revision=None):
     if model.is_hidden and not admin(request):
         raise Http404('Model does not exist.')
 
-    zip_file = ZipFile('{}/{}/{}.zip'.format(MODEL_DIR, model_id, revision))
+    try:
+        namelist = blobstore.get_namelist(model_id, revision)
+    except blobstore.RevisionNotFound:
+        raise Http404('Model file does not exist.')
 
-    response = HttpResponse('\n'.join(zip_file.namelist()), content_type='text/plain')
+    response = HttpResponse('\n'.join(namelist), content_type='text/plain')
     response['Cache-Control'] = 'public, max-age=86400';
     return response
 
 @any_origin
 def get_file(request, filename, model_id, revision=None):
+    cache_control = serving.IMMUTABLE_CACHE_CONTROL
     if not revision:
         revision = get_object_or_404(LatestModel, model_id=model_id).revision
+        cache_control = serving.LATEST_CACHE_CONTROL
 
     model = get_object_or_404(Model, model_id=model_id, revision=revision)
 
     if model.is_hidden and not admin(request):
         raise Http404('Model does not exist.')
 
-    zip_file = ZipFile('{}/{}/{}.zip'.format(MODEL_DIR, model_id, revision))
-
-    response = FileResponse(zip_file.open(filename))
-    response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
-    response['Content-Type'] = 'application/zip'
-    response['Cache-Control'] = 'public, max-age=86400'
-    return response
+    try:
+        return serving.serve_member(request, model_id, revision, filename, cache_control=cache_control)
+    except blobstore.RevisionNotFound:
+        raise Http404('File does not exist.')
 
 @any_origin
 def lookup_tag(request, tag, page_id=1):
@@ -136,94 +260,160 @@ def lookup_tag(request, tag, page_id=1):
     if not admin(request):
         models = models.filter(is_hidden=False)
 
-    return api_paginate(models, page_id)
+    return api_paginate(request, models, page_id)
 
 @any_origin
 def lookup_category(request, category, page_id=1):
-    models = LatestModel.objects.filter(categories__name=category)
+    models = LatestModel.objects.filter(categories__name=category).order_by('model_id')
 
     if not admin(request):
         models = models.filter(is_hidden=False)
 
-    return api_paginate(models, page_id)
+    return api_paginate(request, models, page_id)
 
 @any_origin
 def lookup_author(request, username, page_id=1):
-    models = LatestModel.objects.filter(author__username=username)
+    models = LatestModel.objects.filter(author__username=username).order_by('model_id')
 
     if not admin(request):
         models = models.filter(is_hidden=False)
 
-    return api_paginate(models, page_id)
+    return api_paginate(request, models, page_id)
 
+# Filters |models| to those within |distance| meters of a point, annotated
+# with their distance, see geo.within().
 def range_filter(models, latitude, longitude, distance):
-    # bind latitude and longitude from [min, max] to [-pi, pi] for usage in trigonometry
-    latitude = math.radians(latitude)
-    longitude = math.radians(longitude)
+    return geo.within(models, latitude, longitude, distance)
 
-    PLANETARY_RADIUS = 6371e3 # in meters
-    angular_radius = distance / PLANETARY_RADIUS
+@any_origin
+def search_range(request, latitude, longitude, distance, page_id=1):
+    # convert parameters to floats
+    latitude = float(latitude)
+    longitude = float(longitude)
+    distance = float(distance)
 
-    min_latitude = latitude - angular_radius
-    max_latitude = latitude + angular_radius
+    models = LatestModel.objects.all()
 
-    MIN_LATITUDE = -math.pi/2
-    MAX_LATITUDE = math.pi/2
-    MIN_LONGITUDE = -math.pi
-    MAX_LONGITUDE = math.pi
+    if not admin(request):
+        models = models.filter(is_hidden=False)
 
-    if min_latitude > MIN_LATITUDE and max_latitude < MAX_LATITUDE:
-        d_longitude = math.asin(math.sin(angular_radius)/math.cos(latitude))
+    models = range_filter(models, latitude, longitude, distance).order_by('distance', 'model_id')
 
-        min_longitude = longitude - d_longitude
-        if min_longitude < MIN_LONGITUDE:
-            min_longitude += 2 * math.pi
+    return api_paginate(request, models, page_id)
 
-        max_longitude = longitude + d_longitude
-        if max_longitude > MAX_LONGITUDE:
-            max_longitude -= 2 * math.pi
-    else:
-        min_latitude = max(min_latitude, MIN_LATITUDE)
-        max_latitude = min(max_latitude, MAX_LATITUDE)
-        min_longitude = MIN_LONGITUDE
-        max_longitude = MAX_LONGITUDE
-
-    # bind results back for usage in the repository
-    min_latitude = math.degrees(min_latitude)
-    max_latitude = math.degrees(max_latitude)
-    min_longitude = math.degrees(min_longitude)
-    max_longitude = math.degrees(max_longitude)
-
-    return models.filter(
-            location__latitude__gte=min_latitude,
-            location__latitude__lte=max_latitude,
-            location__longitude__gte=min_longitude,
-            location__longitude__lte=max_longitude)
+MAX_NEAREST_RESULTS = 100
 
+# returns the k models closest to a point, nearest first
 @any_origin
-def search_range(request, latitude, longitude, distance, page_id=1):
-    # convert parameters to floats
+def search_nearest(request, latitude, longitude, k=RESULTS_PER_API_CALL):
     latitude = float(latitude)
     longitude = float(longitude)
-    distance = float(distance)
+    k = min(int(k), MAX_NEAREST_RESULTS)
 
-    models = LatestModel.objects.all()
+    models = LatestModel.objects.select_related('location')
 
     if not admin(request):
         models = models.filter(is_hidden=False)
 
-    models = range_filter(models, latitude, longitude, distance)
+    results = [{
+        'id': model.model_id,
+        'lat': model.location.latitude,
+        'lon': model.location.longitude,
+        'distance': model.distance,
+    } for model in geo.nearest(models, latitude, longitude, k)]
+
+    return JsonResponse(results, safe=False)
+
+# Zoom levels from which tiles list every model, below it they are clustered.
+TILE_CLUSTER_MAX_ZOOM = 14
+MAX_TILE_ZOOM = 18
+
+# Clusters are the models in each cell of a grid of this many cells per tile side.
+TILE_CLUSTER_GRID = 8
+
+# Changes whenever the tile payload changes shape, to invalidate cached tiles.
+TILE_FORMAT_VERSION = 1
+
+def tile_models(zoom, x, y):
+    zoom, x, y = int(zoom), int(x), int(y)
+    if zoom > MAX_TILE_ZOOM or x >= 1 << zoom or y >= 1 << zoom:
+        raise Http404('Tile does not exist.')
+
+    # Tiles are the same for everyone so they can be cached publicly, hence
+    # hidden models are left out even for admins.
+    models = LatestModel.objects.filter(is_hidden=False)
+    return geo.in_box(models, *geo.tile_bounds(zoom, x, y))
+
+# The ETag of a tile changes with any change to a model in it, as those
+# rewrite its LatestModel row, and when models are removed from it.
+def tile_etag(request, zoom, x, y):
+    state = tile_models(zoom, x, y).aggregate(
+        count=Count('id'), synced_at=Max('synced_at'), model_ids=Sum('model_id'))
+
+    key = '{}/{}/{}/{}/{}/{}/{}'.format(
+        TILE_FORMAT_VERSION, zoom, x, y, state['count'], state['synced_at'], state['model_ids'])
+    return hashlib.sha1(key.encode()).hexdigest()
 
-    return api_paginate(models, page_id)
+# Returns the models in a slippy map tile as [id, lat, lon, title] lists. At
+# zoom levels below TILE_CLUSTER_MAX_ZOOM, models close to each other are
+# returned as [lat, lon, count] clusters instead.
+@any_origin
+@condition(etag_func=tile_etag)
+def get_tile(request, zoom, x, y):
+    models = tile_models(zoom, x, y)
+    zoom = int(zoom)
+
+    def model_values(models):
+        return [list(values) for values in models.values_list(
+            'model_id', 'location__latitude', 'location__longitude', 'title').order_by('model_id')]
+
+    if zoom >= TILE_CLUSTER_MAX_ZOOM:
+        result = {'models': model_values(models), 'clusters': []}
+    else:
+        min_latitude, max_latitude, min_longitude, max_longitude = geo.tile_bounds(zoom, int(x), int(y))
+        cell_height = (max_latitude - min_latitude) / TILE_CLUSTER_GRID
+        cell_width = (max_longitude - min_longitude) / TILE_CLUSTER_GRID
+
+        def grid_index(field, minimum, size):
+            return Func((F(field) - minimum) / size, function='FLOOR', output_field=FloatField())
+
+        cells = models \
+            .annotate(
+                row=grid_index('location__latitude', min_latitude, cell_height),
+                column=grid_index('location__longitude', min_longitude, cell_width)) \
+            .values('row', 'column') \
+            .annotate(
+                count=Count('id'),
+                latitude=Avg('location__latitude'),
+                longitude=Avg('location__longitude'),
+                model_id=Min('model_id')) \
+            .order_by('row', 'column')
+
+        single_ids = []
+        clusters = []
+        for cell in cells:
+            if cell['count'] == 1:
+                single_ids.append(cell['model_id'])
+            else:
+                clusters.append([cell['latitude'], cell['longitude'], cell['count']])
+
+        result = {
+            'models': model_values(LatestModel.objects.filter(model_id__in=single_ids)),
+            'clusters': clusters,
+        }
+
+    response = JsonResponse(result)
+    response['Cache-Control'] = 'public, max-age=60'
+    return response
 
 @any_origin
 def search_title(request, title, page_id=1):
-    models = LatestModel.objects.filter(title__icontains=title)
+    models = search.search_title(LatestModel.objects.all(), title)
 
     if not admin(request):
         models = models.filter(is_hidden=False)
 
-    return api_paginate(models, page_id)
+    return api_paginate(request, models, page_id)
 
 @csrf_exempt # there's no need for this, since no data is modified
 @any_origin
@@ -250,7 +440,7 @@ def search_full(request):
 
     title = data.get('title')
     if title:
-        models = models.filter(title__icontains=title)
+        models = search.match_title(models, title)
 
     tags = data.get('tags')
     if tags:
@@ -269,14 +459,12 @@ def search_full(request):
     fmt = data.get('format')
 
     if not fmt:
-        return api_paginate(models, page_id)
-
-    paginator = Paginator(models, RESULTS_PER_API_CALL)
+        return api_paginate(request, models, page_id, data)
 
     try:
-        model_results = paginator.page(page_id)
-    except EmptyPage:
-        model_results = []
+        model_results, next_cursor = request_page(request, models.select_related('location'), page_id, data)
+    except InvalidPage as e:
+        return HttpResponseBadRequest(str(e))
 
     def result(model):
         output = []
@@ -306,4 +494,4 @@ def search_full(request):
     except:
         return HttpResponseBadRequest('Invalid format specifier')
 
-    return JsonResponse(results, safe=False)
+    return page_response(results, next_cursor, data.get('cursor') is not None)
@@ -0,0 +1,647 @@
+import functools
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+from . import storage
+from .utils import MODEL_DIR
+from .zipstream import ZipStream, CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Model revisions are stored content-addressed: every zip member is stored
+# once, gzipped, as a blob named after the sha256 of its contents, and a
+# revision is a manifest listing its members and their blobs. Revisions that
+# share textures or OBJ files share the blobs.
+#
+# Files are kept in a storage backend, see storage.py, under these keys:
+#
+#   blobs/ab/cd/abcd...ef                     member contents
+#   blobs/ab/cd/abcd...ef.obj.json            OBJ validation summary
+#   models/12/34/{model_id}/{revision}.json   revision manifest
+#   models/12/34/{model_id}/{revision}.derivatives.json  GLB files, see derivatives.py
+#
+# Model directories are sharded on the sha256 of the model id, 1234... above,
+# so that no directory holds more than a few models. Models stored before
+# that are found in their flat directory, {model_id}/, until
+# migrate_model_storage moves them.
+#
+# Revisions uploaded before the blob store existed are kept as whole zip files
+# at models/12/34/{model_id}/{revision}.zip until the dedupe_models command
+# converts them. Their members are found through an index of the central
+# directory, built on first use:
+#
+#   models/12/34/{model_id}/{revision}.index.json  member offsets and sizes
+#
+# collect_garbage() moves the blobs it is about to delete to
+# garbage/ab/cd/abcd...ef first, see there.
+BLOB_PREFIX = 'blobs'
+GARBAGE_PREFIX = 'garbage'
+MODEL_PREFIX = 'models'
+# Version 2 added zip_size and zip_sha256, see store_revision().
+MANIFEST_VERSION = 2
+LEGACY_INDEX_VERSION = 2
+
+# Manifests and legacy indexes parsed by this process, see _load_json().
+JSON_CACHE_SIZE = 1024
+
+# The fixed part of a zip local file header, followed by the file name and
+# the extra field.
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+LEGACY_REVISION = re.compile(r'^(\d+)\.zip$')
+
+class RevisionNotFound(Exception):
+    pass
+
+# Returns the backend the store is kept in, see storage.BACKEND.
+def get_storage():
+    if storage.BACKEND == 's3':
+        return storage.s3_storage()
+    return storage.FileSystemStorage(MODEL_DIR)
+
+def blob_key(digest):
+    return '{}/{}/{}/{}'.format(BLOB_PREFIX, digest[:2], digest[2:4], digest)
+
+def has_blob(digest):
+    return get_storage().exists(blob_key(digest))
+
+def sharded_model_key(model_id):
+    digest = hashlib.sha256(str(model_id).encode()).hexdigest()
+    return '{}/{}/{}/{}'.format(MODEL_PREFIX, digest[:2], digest[2:4], model_id)
+
+# Returns the key under which the files of a model are, see above.
+def model_key(model_id):
+    key = sharded_model_key(model_id)
+
+    store = get_storage()
+    path = store.path(key)
+    if path is not None and not os.path.isdir(path) and os.path.isdir(store.path(str(model_id))):
+        return str(model_id)
+
+    return key
+
+def manifest_key(model_id, revision):
+    return '{}/{}.json'.format(model_key(model_id), revision)
+
+def legacy_revision_key(model_id, revision):
+    return '{}/{}.zip'.format(model_key(model_id), revision)
+
+def derivatives_key(model_id, revision):
+    return '{}/{}.derivatives.json'.format(model_key(model_id), revision)
+
+def legacy_index_key(model_id, revision):
+    return '{}/{}.index.json'.format(model_key(model_id), revision)
+
+def has_revision(model_id, revision):
+    store = get_storage()
+    return store.exists(manifest_key(model_id, revision)) or \
+        store.exists(legacy_revision_key(model_id, revision))
+
+def has_legacy_revision(model_id, revision):
+    return get_storage().exists(legacy_revision_key(model_id, revision))
+
+# Returns the path of the zip file of a legacy revision on the local disk,
+# or None, e.g. for revisions that are not legacy or are stored in S3.
+def local_legacy_revision_path(model_id, revision):
+    path = get_storage().path(legacy_revision_key(model_id, revision))
+    return path if path is not None and os.path.isfile(path) else None
+
+# Stores the contents of |fileobj| as a blob and returns its digest and size.
+# Contents already in the store are not written again, but the blob is
+# touched, so that collect_garbage() doesn't take it for an unreferenced one
+# before the manifest naming it is written. Callers still check the blob
+# exists once that manifest is written, see put_missing_blobs().
+def put_blob(fileobj):
+    store = get_storage()
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=store.temp_dir())
+    try:
+        with os.fdopen(fd, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as tmp:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                tmp.write(chunk)
+
+        digest = digest.hexdigest()
+        key = blob_key(digest)
+        try:
+            store.touch(key)
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            store.put_file(key, tmp_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return digest, size
+
+# A blob opened for reading, which also closes the file of the store it was
+# read from.
+class BlobFile(gzip.GzipFile):
+    def __init__(self, raw):
+        super().__init__(fileobj=raw, mode='rb')
+        self._raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+def open_blob(digest):
+    return BlobFile(get_storage().open(blob_key(digest)))
+
+# Puts back the blobs of |digests| that collect_garbage() deleted before the
+# manifest naming them was written, after which it keeps them. |open_content|
+# is called with a digest for a file with its contents.
+def put_missing_blobs(digests, open_content):
+    for digest in set(digests):
+        if not has_blob(digest):
+            logger.warning('Blob {} was collected while being stored, storing it again.'.format(digest))
+            with open_content(digest) as f:
+                put_blob(f)
+
+# Validation summaries of OBJ blobs, so an OBJ file that was validated before
+# does not need to be parsed again. See model_validator.
+def get_obj_summary(digest):
+    try:
+        return json.loads(get_storage().read(blob_key(digest) + '.obj.json').decode())
+    except (OSError, ValueError):
+        return None
+
+def put_obj_summary(digest, summary):
+    get_storage().write(blob_key(digest) + '.obj.json', json.dumps(summary).encode())
+
+# Returns the sha256 and size of the bytes of |chunks|.
+def _digest_chunks(chunks):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+# Stores an uploaded model zip as revision |revision| of |model_id|, and
+# returns its manifest. The manifest has the size and sha256 of the zip as
+# uploaded, and zip_size and zip_sha256, those of the zip revision_chunks()
+# serves. That zip is rebuilt the same from the blobs every time, so they are
+# computed here once, from the uploaded files.
+def store_revision(model_id, revision, model_file):
+    model_file.seek(0)
+    archive_sha256, archive_size = _digest_chunks(iter(lambda: model_file.read(CHUNK_SIZE), b''))
+    model_file.seek(0)
+
+    members = []
+    with ZipFile(model_file) as zip_file:
+        infos = zip_file.infolist()
+        for info in infos:
+            member = {
+                'name': info.filename,
+                'date_time': list(info.date_time),
+                'compress_type': info.compress_type,
+                'external_attr': info.external_attr,
+                'crc': info.CRC,
+            }
+
+            if not info.is_dir():
+                with zip_file.open(info) as src:
+                    member['sha256'], member['size'] = put_blob(src)
+
+            members.append(member)
+
+        zip_sha256, zip_size = _digest_chunks(
+            _manifest_zip_chunks(members, lambda index: zip_file.open(infos[index])))
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'size': archive_size,
+            'sha256': archive_sha256,
+            'zip_size': zip_size,
+            'zip_sha256': zip_sha256,
+            'members': members,
+        }
+
+        get_storage().write(manifest_key(model_id, revision), json.dumps(manifest).encode())
+
+        indexes = {member['sha256']: index for index, member in enumerate(members) if 'sha256' in member}
+        put_missing_blobs(indexes, lambda digest: zip_file.open(infos[indexes[digest]]))
+
+    model_file.seek(0)
+
+    return manifest
+
+# Manifests and indexes never change once written, so each process keeps the
+# most recently used ones parsed. The modification time is part of the key in
+# case a file is replaced, e.g. when an index is rebuilt. The returned
+# objects are shared and must not be modified.
+@functools.lru_cache(maxsize=JSON_CACHE_SIZE)
+def _read_json(store, key, mtime_ns):
+    return json.loads(store.read(key).decode())
+
+def _load_json(key):
+    store = get_storage()
+    return _read_json(store, key, store.stat(key).mtime_ns)
+
+def get_manifest(model_id, revision):
+    try:
+        return _load_json(manifest_key(model_id, revision))
+    except FileNotFoundError:
+        raise RevisionNotFound('No revision {} of model {}'.format(revision, model_id))
+
+# Reads the central directory of the legacy zip |f|, and the local headers to
+# find where the data of each member starts.
+def build_legacy_index(f):
+    members = []
+    with ZipFile(f) as zip_file:
+        infos = zip_file.infolist()
+
+    for info in infos:
+        f.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise ValueError('Bad local header for {}'.format(info.filename))
+
+        name_length, extra_length = header[-2:]
+        members.append({
+            'name': info.filename,
+            'compress_type': info.compress_type,
+            'encrypted': bool(info.flag_bits & 0x1),
+            'crc': info.CRC,
+            'size': info.file_size,
+            'compress_size': info.compress_size,
+            'offset': info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+        })
+
+    return {'version': LEGACY_INDEX_VERSION, 'members': members}
+
+# Returns the index of a legacy zip, building and saving it if needed.
+def get_legacy_index(model_id, revision):
+    store = get_storage()
+    legacy_key = legacy_revision_key(model_id, revision)
+    index_key = legacy_index_key(model_id, revision)
+
+    try:
+        if store.stat(index_key).mtime_ns >= store.stat(legacy_key).mtime_ns:
+            index = _load_json(index_key)
+            if index['version'] == LEGACY_INDEX_VERSION:
+                return index
+    except FileNotFoundError:
+        pass
+
+    # The size and hash of the whole zip, as manifests have them.
+    digest = hashlib.sha256()
+    size = 0
+    with store.open(legacy_key) as f:
+        index = build_legacy_index(f)
+
+        f.seek(0)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    index['size'] = size
+    index['sha256'] = digest.hexdigest()
+
+    try:
+        store.write(index_key, json.dumps(index).encode())
+    except Exception:
+        logger.exception('Failed to save the index of {}'.format(legacy_key))
+
+    return index
+
+# Returns the size and sha256 of the zip file of a revision, as served by
+# revision_chunks(), so that downloads can be checked against them.
+def get_archive_info(model_id, revision):
+    if has_legacy_revision(model_id, revision):
+        index = get_legacy_index(model_id, revision)
+        return {'size': index['size'], 'sha256': index['sha256']}
+
+    manifest = get_manifest(model_id, revision)
+    if 'zip_sha256' not in manifest:
+        manifest = _add_zip_info(model_id, revision, manifest)
+    return {'size': manifest['zip_size'], 'sha256': manifest['zip_sha256']}
+
+# Adds zip_size and zip_sha256 to a manifest written before version 2, by
+# reassembling its zip once, and returns the new manifest.
+def _add_zip_info(model_id, revision, manifest):
+    zip_sha256, zip_size = _digest_chunks(revision_chunks(model_id, revision))
+    manifest = dict(manifest, version=MANIFEST_VERSION, zip_size=zip_size, zip_sha256=zip_sha256)
+    get_storage().write(manifest_key(model_id, revision), json.dumps(manifest).encode())
+    return manifest
+
+# Returns the manifest or legacy index entry of a file of a revision.
+def get_member(model_id, revision, name):
+    if has_legacy_revision(model_id, revision):
+        members = get_legacy_index(model_id, revision)['members']
+    else:
+        members = get_manifest(model_id, revision)['members']
+
+    for member in members:
+        if member['name'] == name:
+            return member
+
+    raise RevisionNotFound('No file {} in revision {} of model {}'.format(name, revision, model_id))
+
+# Returns the names of the files in a revision.
+def get_namelist(model_id, revision):
+    if has_legacy_revision(model_id, revision):
+        members = get_legacy_index(model_id, revision)['members']
+    else:
+        members = get_manifest(model_id, revision)['members']
+
+    return [member['name'] for member in members]
+
+# Reads the data of a member of the zip file |f| straight from its offset,
+# without parsing the central directory. Deflated data is inflated in chunks
+# of at most CHUNK_SIZE bytes. |f| is closed with the member.
+class MemberFile(io.RawIOBase):
+    def __init__(self, f, member):
+        if member['compress_type'] not in (ZIP_STORED, ZIP_DEFLATED) or member['encrypted']:
+            raise ValueError('Unsupported zip member {}'.format(member['name']))
+
+        self._file = f
+        self._file.seek(member['offset'])
+        self._remaining = member['compress_size']
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS) \
+            if member['compress_type'] == ZIP_DEFLATED else None
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def _read_raw(self):
+        data = self._file.read(min(CHUNK_SIZE, self._remaining))
+        self._remaining = self._remaining - len(data) if data else 0
+        return data
+
+    def _next_chunk(self):
+        if self._inflater is None:
+            return self._read_raw() if self._remaining else b''
+
+        while True:
+            data = self._inflater.unconsumed_tail
+            if not data and self._remaining:
+                data = self._read_raw()
+            if not data:
+                return self._inflater.flush()
+
+            data = self._inflater.decompress(data, CHUNK_SIZE)
+            if data:
+                return data
+
+    def readinto(self, buffer):
+        if not self._pending:
+            self._pending = memoryview(self._next_chunk())
+
+        length = min(len(buffer), len(self._pending))
+        buffer[:length] = self._pending[:length]
+        self._pending = self._pending[length:]
+        return length
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+# A member of the legacy zip |f| read with ZipFile, for those MemberFile can't
+# read, which also closes |f|, including when the member can't be opened.
+class ZipMemberFile(io.RawIOBase):
+    def __init__(self, f, name):
+        self._file = f
+        self._zip_file = None
+        self._member = None
+        try:
+            self._zip_file = ZipFile(f)
+            self._member = self._zip_file.open(name)
+        except:
+            self.close()
+            raise
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._member.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        try:
+            if self._member is not None:
+                self._member.close()
+            if self._zip_file is not None:
+                self._zip_file.close()
+        finally:
+            self._file.close()
+            super().close()
+
+# Opens a single file of a revision for reading.
+def open_member(model_id, revision, name):
+    member = get_member(model_id, revision, name)
+
+    if 'offset' in member:
+        f = get_storage().open(legacy_revision_key(model_id, revision))
+        try:
+            return MemberFile(f, member)
+        except ValueError:
+            return ZipMemberFile(f, name)
+        except:
+            f.close()
+            raise
+
+    if 'sha256' not in member:
+        raise RevisionNotFound('{} in revision {} of model {} is a directory'.format(
+            name, revision, model_id))
+
+    return open_blob(member['sha256'])
+
+# Generates the zip file of a revision, reassembling it from its blobs.
+def revision_chunks(model_id, revision):
+    if has_legacy_revision(model_id, revision):
+        with get_storage().open(legacy_revision_key(model_id, revision)) as f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+        return
+
+    members = get_manifest(model_id, revision)['members']
+    yield from _manifest_zip_chunks(members, lambda index: open_blob(members[index]['sha256']))
+
+# Generates the zip file of the manifest |members|. |open_content| is called
+# with the index of each member that is a file, for a file with its contents.
+def _manifest_zip_chunks(members, open_content):
+    stream = ZipStream()
+
+    for index, member in enumerate(members):
+        zinfo = ZipInfo(member['name'], tuple(member['date_time']))
+        zinfo.compress_type = member['compress_type']
+        zinfo.external_attr = member['external_attr']
+
+        if 'sha256' in member:
+            zinfo.file_size = member['size']
+            with open_content(index) as f:
+                yield from stream.write_fileobj(zinfo, f)
+        else:
+            yield from stream.write_str(zinfo, b'')
+
+    yield from stream.close()
+
+# Converts a revision stored as a whole zip file into blobs and a manifest.
+def convert_legacy_revision(model_id, revision):
+    store = get_storage()
+    legacy_key = legacy_revision_key(model_id, revision)
+
+    with store.open(legacy_key) as model_file:
+        store_revision(model_id, revision, model_file)
+
+    store.delete(legacy_key)
+    store.delete(legacy_index_key(model_id, revision))
+
+def delete_model(model_id):
+    return get_storage().delete_prefix(model_key(model_id))
+
+# Returns the ids of the models of the filesystem store that are still in its
+# flat layout, see migrate_model_storage.
+def flat_model_ids():
+    root = get_storage().path('')
+    if root is None or not os.path.isdir(root):
+        return []
+
+    return sorted(int(entry.name) for entry in os.scandir(root) if entry.is_dir() and entry.name.isdigit())
+
+# Yields (model_id, name, key, stat) for every file of every model, in either
+# layout.
+def iter_model_files():
+    store = get_storage()
+    for key, stat in store.list(MODEL_PREFIX):
+        parts = key.split('/')
+        if len(parts) == 5 and parts[3].isdigit():
+            yield int(parts[3]), parts[4], key, stat
+
+    for model_id in flat_model_ids():
+        for key, stat in store.list(str(model_id)):
+            parts = key.split('/')
+            if len(parts) == 2:
+                yield model_id, parts[1], key, stat
+
+# Yields (model_id, revision, key) for every revision manifest in the store.
+def iter_manifests():
+    for model_id, name, key, _ in iter_model_files():
+        stem, ext = os.path.splitext(name)
+        if ext == '.json' and stem.isdigit():
+            yield model_id, int(stem), key
+
+# Yields the key of every derivatives manifest, of legacy revisions too.
+def iter_derivatives():
+    for _, name, key, _ in iter_model_files():
+        if name.endswith('.derivatives.json'):
+            yield key
+
+# Yields (model_id, revision, size) for every revision stored as a whole zip.
+def iter_legacy_revisions():
+    for model_id, name, _, stat in iter_model_files():
+        match = LEGACY_REVISION.match(name)
+        if match:
+            yield model_id, int(match.group(1)), stat.size
+
+# Deletes every model and blob of the store.
+def delete_all():
+    store = get_storage()
+    for model_id in flat_model_ids():
+        store.delete_prefix(str(model_id))
+    store.delete_prefix(MODEL_PREFIX)
+    store.delete_prefix(BLOB_PREFIX)
+
+# Returns the digests of the blobs named by revision and derivatives manifests,
+# only those modified after |since|, in seconds since the epoch, if given.
+def referenced_blobs(since=None):
+    store = get_storage()
+    referenced = set()
+    for _, name, key, stat in list(iter_model_files()):
+        if since is not None and stat.mtime_ns / 1e9 <= since:
+            continue
+
+        stem, ext = os.path.splitext(name)
+        if not (ext == '.json' and stem.isdigit()) and not name.endswith('.derivatives.json'):
+            continue
+
+        try:
+            manifest = json.loads(store.read(key).decode())
+        except FileNotFoundError:
+            # Deleted since listed.
+            continue
+
+        if 'lods' in manifest:
+            referenced.update(lod['sha256'] for lod in manifest['lods'])
+        else:
+            referenced.update(member['sha256'] for member in manifest['members'] if 'sha256' in member)
+
+    return referenced
+
+def _digest_of_key(key):
+    return key.rsplit('/', 1)[-1].split('.')[0]
+
+# Deletes blobs that no manifest refers to. Blobs younger than |grace_seconds|
+# are kept, as they may belong to an upload that is still being stored.
+#
+# An upload that touched a blob just before it is deleted still names it in
+# its manifest. So the blobs are first moved to GARBAGE_PREFIX, then the
+# manifests written meanwhile are read again and the blobs they name moved
+# back, and only the others are deleted. Uploads check their blobs exist once
+# their manifest is written, and put back those moved before, see
+# put_missing_blobs().
+def collect_garbage(grace_seconds=3600):
+    store = get_storage()
+
+    # Left over by a run that didn't finish. They are checked again below.
+    for key, _ in list(store.list(GARBAGE_PREFIX)):
+        store.move(key, BLOB_PREFIX + key[len(GARBAGE_PREFIX):])
+
+    cutoff = time.time() - grace_seconds
+    referenced = referenced_blobs()
+
+    garbage = []
+    for key, stat in list(store.list(BLOB_PREFIX)):
+        if _digest_of_key(key) in referenced:
+            continue
+
+        if stat.mtime_ns / 1e9 > cutoff:
+            continue
+
+        # An upload may have touched the blob since it was listed.
+        try:
+            if store.stat(key).mtime_ns / 1e9 > cutoff:
+                continue
+            garbage_key = GARBAGE_PREFIX + key[len(BLOB_PREFIX):]
+            store.move(key, garbage_key)
+        except FileNotFoundError:
+            continue
+        garbage.append((key, garbage_key, stat.size))
+
+    # Manifests written since the blobs were checked are younger than the
+    # cutoff, as are the blobs of those written before.
+    referenced = referenced_blobs(since=cutoff)
+
+    deleted = 0
+    deleted_bytes = 0
+    for key, garbage_key, size in garbage:
+        if _digest_of_key(key) in referenced:
+            store.move(garbage_key, key)
+            continue
+
+        store.delete(garbage_key)
+        deleted += 1
+        deleted_bytes += size
+
+    logger.info('Deleted {} unreferenced blob files, {} bytes.'.format(deleted, deleted_bytes))
+    return deleted, deleted_bytes
@@ -1,7 +1,6 @@
-import os
 import logging
 import mistune
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from django.db import transaction
 from django.db.models import F
@@ -10,12 +9,48 @@ from django.contrib import messages
 from sequences import get_next_value
 
 from .models import Model, LatestModel, Change, Category, Location
-from .utils import MODEL_DIR
+from .utils import MODEL_DIR, CHANGE_UPLOAD, CHANGE_REVISE, CHANGE_EDIT, CHANGE_HIDE, CHANGE_UNHIDE, CHANGE_DELETE
+from . import blobstore
+from . import derivatives
+from . import geo
+from . import info_cache
+from . import metrics
+from . import serving
 
 from .markdown import markdown
 
 logger = logging.getLogger(__name__)
 
+# Returns the sha256 of the zip file of a revision, or None if it has no files.
+def archive_sha256(model_id, revision):
+    try:
+        return blobstore.get_archive_info(model_id, revision)['sha256']
+    except OSError:
+        return None
+
+# Returns a change of |typeof| to |m| by |author|, not yet saved. The sha256
+# of the revision is looked up unless given.
+def make_change(author, m, typeof, sha256=None):
+    if sha256 is None and typeof != CHANGE_DELETE:
+        sha256 = archive_sha256(m.model_id, m.revision)
+
+    return Change(
+        author=author,
+        model=m if typeof != CHANGE_DELETE else None,
+        typeof=typeof,
+        target_model_id=m.model_id,
+        revision=m.revision,
+        building_id=m.building_id,
+        sha256=sha256
+    )
+
+# Records a change of |typeof| to |m| by |author|, see CHANGES.
+def record_change(author, m, typeof, sha256=None):
+    change = make_change(author, m, typeof, sha256)
+    change.save()
+    return change
+
+@metrics.timed('upload_store')
 def upload(model_file, options={}):
     try:
         with transaction.atomic():
@@ -87,19 +122,16 @@ def upload(model_file, options={}):
 
                 m.save()
 
-            change = Change(
-                author=options['author'],
-                model=m,
-                typeof=1 if options.get('revision') else 0
-            )
+            # Files shared with earlier revisions or other models are
+            # stored only once.
+            manifest = blobstore.store_revision(m.model_id, m.revision, model_file)
 
-            change.save()
+            record_change(
+                options['author'], m, CHANGE_REVISE if options.get('revision') else CHANGE_UPLOAD,
+                manifest['zip_sha256'])
 
-            filepath = '{}/{}/{}.zip'.format(MODEL_DIR, m.model_id, m.revision)
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            with open(filepath, 'wb+') as destination:
-                for chunk in model_file.chunks():
-                    destination.write(chunk)
+            # GLB files and levels of detail are built once this commits.
+            derivatives.schedule(m.model_id, m.revision)
 
             return m
     except:
@@ -118,6 +150,139 @@ def upload(model_file, options={}):
 
         return None
 
+# Stores many models in a single transaction. |uploads| is a list of
+# (model_path, options) pairs, with the options of upload() for new models.
+# An upload whose building_id belongs to an existing model is stored as a new
+# revision of its latest revision instead, as the API does for single uploads.
+#
+# Each table gets a single INSERT, so the latest revisions are synced once for
+# the whole batch, and the files are stored by |workers| threads. Returns the
+# stored models, in the order of |uploads|, or None if nothing was stored.
+@metrics.timed('bulk_upload_store')
+def bulk_upload(uploads, workers=1):
+    try:
+        with transaction.atomic():
+            building_ids = {options['building_id'] for _, options in uploads if options.get('building_id')}
+            # The latest revision of each building_id, and its location.
+            latest = {
+                m.building_id: (m, m.location) for m in Model.objects
+                    .filter(building_id__in=building_ids)
+                    .select_related('location')
+                    .order_by('building_id', '-revision', '-id')
+                    .distinct('building_id')
+            }
+
+            models = []
+            locations = []
+            categories = []
+            for _, options in uploads:
+                building_id = options.get('building_id')
+                previous, previous_location = latest.get(building_id, (None, None))
+
+                if previous is not None:
+                    location = None
+                    if previous_location is not None:
+                        location = Location(
+                            latitude=previous_location.latitude,
+                            longitude=previous_location.longitude)
+
+                    m = Model(
+                        model_id=previous.model_id,
+                        revision=previous.revision + 1,
+                        title=previous.title,
+                        building_id=previous.building_id,
+                        description=previous.description,
+                        rendered_description=previous.rendered_description,
+                        tags=previous.tags,
+                        license=previous.license,
+                        author=options['author'],
+                        translation_x=previous.translation_x,
+                        translation_y=previous.translation_y,
+                        translation_z=previous.translation_z,
+                        rotation=previous.rotation,
+                        scale=previous.scale,
+                        is_hidden=previous.is_hidden
+                    )
+                    category_names = []
+                else:
+                    location = None
+                    if options['latitude'] and options['longitude']:
+                        location = Location(
+                            latitude=options['latitude'],
+                            longitude=options['longitude'])
+
+                    m = Model(
+                        model_id=get_next_value('model_id'),
+                        revision=1,
+                        title=options['title'],
+                        building_id=building_id,
+                        description=options['description'],
+                        rendered_description=markdown(options['description']),
+                        tags=options['tags'],
+                        license=options['license'],
+                        author=options['author'],
+                        translation_x=-options['translation'][0],
+                        translation_y=-options['translation'][1],
+                        translation_z=-options['translation'][2],
+                        rotation=options['rotation'],
+                        scale=options['scale']
+                    )
+                    category_names = options['categories']
+
+                # bulk_create() doesn't call Location.save().
+                if location is not None:
+                    location.geohash = geo.encode(location.latitude, location.longitude)
+
+                if building_id:
+                    latest[building_id] = (m, location)
+
+                models.append(m)
+                locations.append(location)
+                categories.append(category_names)
+
+            Location.objects.bulk_create([location for location in locations if location is not None])
+            for m, location in zip(models, locations):
+                m.location = location
+
+            Model.objects.bulk_create(models)
+
+            names = {name for category_names in categories for name in category_names}
+            categories_by_name = {category.name: category for category in Category.objects.filter(name__in=names)}
+            missing = [Category(name=name) for name in names if name not in categories_by_name]
+            Category.objects.bulk_create(missing)
+            categories_by_name.update((category.name, category) for category in missing)
+
+            Model.categories.through.objects.bulk_create([
+                Model.categories.through(model_id=m.id, category_id=categories_by_name[name].id)
+                for m, category_names in zip(models, categories)
+                for name in category_names
+            ])
+
+            def store(m, model_path):
+                with open(model_path, 'rb') as model_file:
+                    return blobstore.store_revision(m.model_id, m.revision, model_file)
+
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                # list() re-raises the first failure, if any.
+                manifests = list(executor.map(store, models, [model_path for model_path, _ in uploads]))
+
+            Change.objects.bulk_create([
+                make_change(
+                    m.author, m, CHANGE_UPLOAD if m.revision == 1 else CHANGE_REVISE, manifest['zip_sha256'])
+                for m, manifest in zip(models, manifests)
+            ])
+
+            for m in models:
+                derivatives.schedule(m.model_id, m.revision)
+                # bulk_create() doesn't send the signals invalidating it.
+                info_cache.invalidate(m.model_id)
+
+            return models
+    except:
+        logger.exception('Fatal server error when uploading models.')
+
+        return None
+
 # Edits the metadata of a model, returns True when successful, and False otherwise
 def edit(options):
     try:
@@ -172,12 +337,21 @@ def edit(options):
 
             m.save()
 
+            record_change(options['author'], m, CHANGE_EDIT)
+
             return True
     except:
         logger.exception('Fatal server error when editing metadata.')
 
         return False
 
+# Hides or unhides a revision on behalf of |author|.
+def set_hidden(m, hidden, author):
+    with transaction.atomic():
+        m.is_hidden = hidden
+        m.save()
+        record_change(author, m, CHANGE_HIDE if hidden else CHANGE_UNHIDE)
+
 # TODO: Add more verbose return values to pass to client. E.g., inform them of no model with model_id found.
 def delete_model(options):
     logger.debug('MODEL_DIR: {}'.format(MODEL_DIR))
@@ -189,24 +363,27 @@ def delete_model(options):
             logger.info('Deleting model with ID: {}'.format(model_id))
 
             # Each model may have more than one entry due to revisions. Delete them all.
-            ret = Model.objects.filter(model_id=model_id)
+            latest = Model.objects.filter(model_id=model_id).order_by('-revision', '-id').first()
 
-            if not ret:
+            if latest is None:
                 msg = 'No model found with model_id: {}'.format(model_id)
                 logger.info(msg)
                 return False
 
             ret = Model.objects.filter(model_id=model_id).delete()
+
+            # Recorded against the latest revision, after the delete cleared
+            # the model of the earlier changes.
+            record_change(options['author'], latest, CHANGE_DELETE)
             logger.debug('Found Models: {}'.format(ret))
 
-            # Delete the data on disk
-            model_dir = os.path.join(MODEL_DIR, str(model_id))
-            logger.info('Deleting models in db with entries: {}'.format(model_dir))
+            # Delete the data in the store. Blobs no longer referenced by any
+            # revision are removed by dedupe_models --collect-garbage.
+            logger.info('Deleting the files of model {}'.format(model_id))
 
-            if os.path.isdir(model_dir):
-                shutil.rmtree(model_dir)
-            else:
-                logger.info('Delete requested for model id {} but model path {} does not exist.'.format(model_id, model_dir))
+            if not blobstore.delete_model(model_id):
+                logger.info('Delete requested for model id {} but it has no files.'.format(model_id))
+            serving.delete_cached_zips(model_id)
             return True
     except:
         logger.exception('Failed to delete model with id: {}'.format(model_id))
@@ -0,0 +1,154 @@
+import io
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.db import transaction
+
+from . import blobstore
+from . import mesh
+
+logger = logging.getLogger(__name__)
+
+# Binary versions of uploaded models, for renderers that would rather not
+# parse OBJ files: a GLB file of the full model (level of detail 0), and
+# simplified ones (levels 1 and up). They are built in the background after
+# an upload commits, stored as blobs, and listed in
+# {model_key}/{revision}.derivatives.json, see blobstore:
+#
+#   {"version": 1, "lods": [{"sha256": ..., "size": ..., "triangles": ...}, ...]}
+
+DERIVATIVES_VERSION = 1
+
+# Fractions of the triangles of the full model kept by each simplified level.
+LOD_RATIOS = (0.5, 0.2, 0.05)
+
+# Models with fewer triangles are not simplified.
+MIN_LOD_TRIANGLES = 1000
+
+# A simplified level is only kept if it has at most this fraction of the
+# triangles of the previous one.
+MIN_LOD_REDUCTION = 0.8
+
+# Number of worker processes building derivatives. 0 builds them in the
+# calling thread instead, which is convenient for development and tests.
+DERIVATIVE_WORKERS = int(os.environ.get('RESERVOIR_DERIVATIVE_WORKERS', 1))
+
+class DerivativesNotFound(Exception):
+    pass
+
+def get_derivatives(model_id, revision):
+    try:
+        return json.loads(blobstore.get_storage().read(blobstore.derivatives_key(model_id, revision)).decode())
+    except FileNotFoundError:
+        raise DerivativesNotFound('No derivatives of revision {} of model {}'.format(revision, model_id))
+
+def get_lod(model_id, revision, level):
+    lods = get_derivatives(model_id, revision)['lods']
+    if level >= len(lods):
+        raise DerivativesNotFound('No level of detail {} of revision {} of model {}'.format(
+            level, revision, model_id))
+
+    return lods[level]
+
+def has_derivatives(model_id, revision):
+    return blobstore.get_storage().exists(blobstore.derivatives_key(model_id, revision))
+
+# Builds the derivatives of a revision, replacing existing ones.
+def build(model_id, revision):
+    names = blobstore.get_namelist(model_id, revision)
+    objs = [name for name in names if name.endswith('.obj')]
+    if len(objs) != 1:
+        raise ValueError('Revision {} of model {} has no single OBJ file'.format(revision, model_id))
+
+    full = mesh.read_obj(
+        set(names), lambda name: blobstore.open_member(model_id, revision, name), objs[0])
+
+    lods = []
+    glbs = {}
+    lod = full
+    for ratio in (None,) + LOD_RATIOS:
+        if ratio is not None:
+            if len(full.triangles) < MIN_LOD_TRIANGLES:
+                break
+
+            simplified = mesh.simplify(full, ratio)
+            if len(simplified.triangles) > len(lod.triangles) * MIN_LOD_REDUCTION:
+                continue
+            lod = simplified
+
+        glb = mesh.to_glb(lod)
+        digest, size = blobstore.put_blob(io.BytesIO(glb))
+        glbs[digest] = glb
+        lods.append({
+            'sha256': digest,
+            'size': size,
+            'triangles': len(lod.triangles),
+            'vertices': len(lod.positions),
+        })
+
+    blobstore.get_storage().write(blobstore.derivatives_key(model_id, revision), json.dumps({
+        'version': DERIVATIVES_VERSION,
+        'lods': lods,
+    }).encode())
+    blobstore.put_missing_blobs(glbs, lambda digest: io.BytesIO(glbs[digest]))
+
+    logger.info('Built {} levels of detail of revision {} of model {}.'.format(
+        len(lods), revision, model_id))
+    return lods
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=DERIVATIVE_WORKERS,
+                mp_context=multiprocessing.get_context('fork'))
+
+        return _executor
+
+def _reset_executor(executor):
+    global _executor
+
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+    executor.shutdown(wait=False)
+
+def _log_failure(executor, model_id, revision, future):
+    try:
+        future.result()
+    except BrokenProcessPool:
+        logger.warning('Derivatives worker died, restarting the pool.')
+        _reset_executor(executor)
+    except Exception:
+        logger.exception('Failed to build the derivatives of revision {} of model {}.'.format(
+            revision, model_id))
+
+def _submit(model_id, revision):
+    if DERIVATIVE_WORKERS <= 0:
+        try:
+            build(model_id, revision)
+        except Exception:
+            logger.exception('Failed to build the derivatives of revision {} of model {}.'.format(
+                revision, model_id))
+        return
+
+    executor = _get_executor()
+    future = executor.submit(build, model_id, revision)
+    future.add_done_callback(lambda future: _log_failure(executor, model_id, revision, future))
+
+# Builds the derivatives of a revision off the request thread, once the
+# current transaction commits. Failures are logged: the revision itself is
+# already stored, and build_derivatives can retry.
+def schedule(model_id, revision):
+    transaction.on_commit(lambda: _submit(model_id, revision))
@@ -0,0 +1,200 @@
+import math
+
+from django.db.models import F, FloatField, Func, Q, Value
+
+PLANETARY_RADIUS = 6371e3 # in meters
+
+# Precision of the geohashes stored with locations, a cell is about
+# 4.8m x 4.8m at the equator.
+GEOHASH_PRECISION = 9
+
+# The largest number of geohash cells a range query is split into. More cells
+# follow the search circle more closely, but make for a longer query.
+MAX_COVERING_CELLS = 16
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# A geohash interleaves the bits of the cell indices along both axes,
+# starting with longitude, and writes them in base 32.
+def _bits(precision):
+    longitude_bits = (5 * precision + 1) // 2
+    latitude_bits = 5 * precision // 2
+    return latitude_bits, longitude_bits
+
+def _cell(latitude, longitude, precision):
+    latitude_bits, longitude_bits = _bits(precision)
+    row = int((latitude + 90) / 180 * (1 << latitude_bits))
+    column = int((longitude + 180) / 360 * (1 << longitude_bits))
+    return min(row, (1 << latitude_bits) - 1), min(column, (1 << longitude_bits) - 1)
+
+def _geohash(row, column, precision):
+    latitude_bits, longitude_bits = _bits(precision)
+
+    value = 0
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            longitude_bits -= 1
+            bit = (column >> longitude_bits) & 1
+        else:
+            latitude_bits -= 1
+            bit = (row >> latitude_bits) & 1
+        value = (value << 1) | bit
+
+    return ''.join(BASE32[(value >> shift) & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    latitude = float(latitude)
+    longitude = float(longitude)
+    return _geohash(*_cell(latitude, longitude, precision), precision)
+
+# Returns the box around a circle as (min_latitude, max_latitude,
+# min_longitude, max_longitude), in degrees. min_longitude is larger than
+# max_longitude when the box crosses the antimeridian.
+def bounding_box(latitude, longitude, distance):
+    # bind latitude and longitude from [min, max] to [-pi, pi] for usage in trigonometry
+    latitude = math.radians(latitude)
+    longitude = math.radians(longitude)
+
+    angular_radius = distance / PLANETARY_RADIUS
+
+    min_latitude = latitude - angular_radius
+    max_latitude = latitude + angular_radius
+
+    MIN_LATITUDE = -math.pi/2
+    MAX_LATITUDE = math.pi/2
+    MIN_LONGITUDE = -math.pi
+    MAX_LONGITUDE = math.pi
+
+    if min_latitude > MIN_LATITUDE and max_latitude < MAX_LATITUDE:
+        d_longitude = math.asin(min(1, math.sin(angular_radius)/math.cos(latitude)))
+
+        min_longitude = longitude - d_longitude
+        if min_longitude < MIN_LONGITUDE:
+            min_longitude += 2 * math.pi
+
+        max_longitude = longitude + d_longitude
+        if max_longitude > MAX_LONGITUDE:
+            max_longitude -= 2 * math.pi
+    else:
+        min_latitude = max(min_latitude, MIN_LATITUDE)
+        max_latitude = min(max_latitude, MAX_LATITUDE)
+        min_longitude = MIN_LONGITUDE
+        max_longitude = MAX_LONGITUDE
+
+    return (math.degrees(min_latitude), math.degrees(max_latitude),
+            math.degrees(min_longitude), math.degrees(max_longitude))
+
+# Returns the geohash prefixes of the cells covering a box, using the finest
+# precision that needs at most MAX_COVERING_CELLS cells, or None when the box
+# is so large that it would need a filter on the whole world anyway.
+def covering_prefixes(min_latitude, max_latitude, min_longitude, max_longitude):
+    best = None
+
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        _, longitude_bits = _bits(precision)
+        columns = 1 << longitude_bits
+
+        min_row, min_column = _cell(min_latitude, min_longitude, precision)
+        max_row, max_column = _cell(max_latitude, max_longitude, precision)
+        if max_column < min_column or \
+           (max_column == min_column and max_longitude < min_longitude):
+            max_column += columns
+
+        cell_count = (max_row - min_row + 1) * (max_column - min_column + 1)
+        if cell_count > MAX_COVERING_CELLS:
+            break
+
+        best = [
+            _geohash(row, column % columns, precision)
+            for row in range(min_row, max_row + 1)
+            for column in range(min_column, max_column + 1)]
+
+    return best
+
+# Great-circle distance in meters between the location at |prefix|, e.g.
+# 'location__', and a point.
+def haversine_distance(latitude, longitude, prefix='location__'):
+    def function(name, *expressions):
+        return Func(*expressions, function=name, output_field=FloatField())
+
+    def radians(expression):
+        return function('RADIANS', expression)
+
+    latitude = Value(float(latitude))
+    longitude = Value(float(longitude))
+    location_latitude = F(prefix + 'latitude')
+    location_longitude = F(prefix + 'longitude')
+
+    a = function('POWER', function('SIN', (radians(location_latitude) - radians(latitude)) / 2), 2) + \
+        function('COS', radians(latitude)) * function('COS', radians(location_latitude)) * \
+        function('POWER', function('SIN', (radians(location_longitude) - radians(longitude)) / 2), 2)
+
+    # Rounding can take a little above 1 for antipodal points.
+    return 2 * PLANETARY_RADIUS * function('ASIN', function('LEAST', function('SQRT', a), 1))
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    a = math.sin(math.radians(latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(math.radians(latitude1)) * math.cos(math.radians(latitude2)) * \
+        math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * PLANETARY_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+# Returns the bounds of a slippy map tile as (min_latitude, max_latitude,
+# min_longitude, max_longitude), in degrees.
+def tile_bounds(zoom, x, y):
+    tiles = 1 << zoom
+
+    def latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / tiles))))
+
+    return latitude(y + 1), latitude(y), x / tiles * 360 - 180, (x + 1) / tiles * 360 - 180
+
+# Filters |models| to those located in a box, excluding its north and east
+# edges so that adjacent boxes don't share models.
+def in_box(models, min_latitude, max_latitude, min_longitude, max_longitude, prefix='location__'):
+    prefixes = covering_prefixes(min_latitude, max_latitude, min_longitude, max_longitude)
+
+    if prefixes is not None:
+        models = models.filter(_prefix_filter(prefixes, prefix))
+
+    return models.filter(**{
+        prefix + 'latitude__gte': min_latitude,
+        prefix + 'latitude__lt': max_latitude,
+        prefix + 'longitude__gte': min_longitude,
+        prefix + 'longitude__lt': max_longitude,
+    })
+
+def _prefix_filter(prefixes, prefix):
+    cells = Q()
+    for cell in prefixes:
+        cells |= Q(**{prefix + 'geohash__startswith': cell})
+    return cells
+
+# Filters |models| to those located within |distance| meters of a point, and
+# annotates them with their distance. The geohash index narrows the search to
+# the cells around the point before distances are computed.
+def within(models, latitude, longitude, distance, prefix='location__'):
+    prefixes = covering_prefixes(*bounding_box(latitude, longitude, distance))
+
+    if prefixes is not None:
+        models = models.filter(_prefix_filter(prefixes, prefix))
+
+    return models \
+        .annotate(distance=haversine_distance(latitude, longitude, prefix)) \
+        .filter(distance__lte=distance)
+
+# Returns the |k| models closest to a point, nearest first, annotated with
+# their distance. Searches circles of growing radius until one holds |k|
+# models, so only the cells around the point are read when models are dense.
+def nearest(models, latitude, longitude, k, prefix='location__', initial_distance=1000):
+    distance = initial_distance
+    while distance < math.pi * PLANETARY_RADIUS:
+        results = list(within(models, latitude, longitude, distance, prefix)
+                       .order_by('distance', 'model_id')[:k])
+        if len(results) == k:
+            return results
+        distance *= 4
+
+    return list(models
+                .filter(**{prefix + 'isnull': False})
+                .annotate(distance=haversine_distance(latitude, longitude, prefix))
+                .order_by('distance', 'model_id')[:k])
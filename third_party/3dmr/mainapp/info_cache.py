@@ -0,0 +1,49 @@
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+# Cache of the public metadata of models, as served by api.get_info().
+#
+# Every model has a version token in the cache, replaced after each committed
+# write to its revisions or comments (see the receivers in models.py). The
+# metadata is cached under the token current when it was read, so a write
+# makes older entries unreachable instead of having to find and delete them,
+# and a reader racing a write can only store its result under the old token.
+# Writes that bypass signals, such as bulk_create() and update(), are picked
+# up within CACHE_TIMEOUT.
+CACHE_TIMEOUT = 60 * 60
+
+def _version_key(model_id):
+    return 'model_info_version:{}'.format(model_id)
+
+def _info_key(model_id, version):
+    return 'model_info:{}:{}'.format(model_id, version)
+
+def get_version(model_id):
+    key = _version_key(model_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+
+    return version
+
+# Returns the cached metadata of |model_id|, or calls |build| to read it. Its
+# result is cached unless it is None.
+def get_or_build(model_id, build):
+    version = get_version(model_id)
+    key = _info_key(model_id, version)
+
+    info = cache.get(key)
+    if info is None:
+        info = build()
+        if info is not None:
+            cache.set(key, info, CACHE_TIMEOUT)
+
+    return info
+
+# Makes the cached metadata of |model_id| stale once the current transaction
+# commits, so no reader can cache what it read before the commit as current.
+def invalidate(model_id):
+    transaction.on_commit(lambda: cache.set(_version_key(model_id), uuid.uuid4().hex, None))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from mainapp import blobstore, derivatives
+from mainapp.models import LatestModel, Model
+
+class Command(BaseCommand):
+    help = 'Builds the GLB files of models uploaded before they existed, or whose build failed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all-revisions', action='store_true',
+            help='Build every revision, not only the latest one of each model.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Rebuild revisions that already have derivatives.')
+
+    def handle(self, *args, **options):
+        models = Model.objects if options['all_revisions'] else LatestModel.objects
+        revisions = models.order_by('model_id', 'revision').values_list('model_id', 'revision')
+
+        built, failed = 0, 0
+        for model_id, revision in revisions.iterator():
+            if not blobstore.has_revision(model_id, revision):
+                continue
+            if derivatives.has_derivatives(model_id, revision) and not options['force']:
+                continue
+
+            try:
+                derivatives.build(model_id, revision)
+                built += 1
+            except Exception as e:
+                self.stderr.write('Revision {} of model {}: {}'.format(revision, model_id, e))
+                failed += 1
+
+        self.stdout.write('Built {} revisions, {} failed.'.format(built, failed))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from mainapp import blobstore
+
+class Command(BaseCommand):
+    help = 'Moves models stored as whole zip files into the deduplicated blob store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--collect-garbage', action='store_true',
+            help='Also delete blobs no revision refers to, e.g. after models were deleted.')
+        parser.add_argument(
+            '--grace-seconds', type=int, default=3600,
+            help='Keep unreferenced blobs younger than this, as uploads in progress may need them.')
+
+    def handle(self, *args, **options):
+        converted = 0
+        saved_bytes = 0
+        blob_bytes_before = self.blob_bytes()
+
+        for model_id, revision, size in list(blobstore.iter_legacy_revisions()):
+            saved_bytes += size
+            blobstore.convert_legacy_revision(model_id, revision)
+            converted += 1
+
+        saved_bytes -= self.blob_bytes() - blob_bytes_before
+        self.stdout.write('Converted {} revisions, saving {} bytes.'.format(converted, saved_bytes))
+
+        if options['collect_garbage']:
+            deleted, deleted_bytes = blobstore.collect_garbage(options['grace_seconds'])
+            self.stdout.write('Deleted {} unreferenced blob files, {} bytes.'.format(deleted, deleted_bytes))
+
+    def blob_bytes(self):
+        return sum(stat.size for _, stat in blobstore.get_storage().list(blobstore.BLOB_PREFIX))
@@ -0,0 +1,102 @@
+import itertools
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from mainapp import blobstore, storage
+
+# Moves the files of a model of the local |store| from its flat directory to
+# the sharded one. Files already there, e.g. moved by an interrupted run, are
+# kept and their flat copies dropped. Returns the number of files moved.
+def move_model(store, model_id):
+    source = store.path(str(model_id))
+    target = store.path(blobstore.sharded_model_key(model_id))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    if not os.path.isdir(target):
+        # Renaming is atomic, so readers find the model in either layout.
+        count = len(os.listdir(source))
+        os.rename(source, target)
+        return count
+
+    moved = 0
+    for entry in os.scandir(source):
+        destination = os.path.join(target, entry.name)
+        if not os.path.exists(destination):
+            os.replace(entry.path, destination)
+            moved += 1
+    shutil.rmtree(source)
+    return moved
+
+# Copies |key| from |source| to |target| unless a file of the same size is
+# already there, and returns the bytes copied.
+def copy_key(source, target, key, stat, delete):
+    try:
+        copy = target.stat(key).size != stat.size
+    except FileNotFoundError:
+        copy = True
+
+    if copy:
+        with source.open(key) as f:
+            target.write_file(key, f)
+    if delete:
+        source.delete(key)
+
+    return stat.size if copy else 0
+
+# Calls |function| on every item of |items| in |workers| threads, with a
+# bounded number of calls pending, and returns the results in order.
+def run_parallel(function, items, workers):
+    results = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(function, *item))
+            while len(pending) > workers * 4:
+                results.append(pending.popleft().result())
+
+        while pending:
+            results.append(pending.popleft().result())
+
+    return results
+
+class Command(BaseCommand):
+    help = ('Moves the models of MODEL_DIR from the flat layout to the sharded one, and optionally copies '
+            'the store to S3. Run it again once done to move revisions uploaded meanwhile.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=16,
+            help='Files moved or copied at once.')
+        parser.add_argument(
+            '--to-s3', action='store_true',
+            help='Then copy the store to the bucket named by RESERVOIR_S3_BUCKET, before the servers are '
+                 'switched to RESERVOIR_STORAGE=s3.')
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='With --to-s3, delete the local files once copied.')
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        local = storage.FileSystemStorage(blobstore.MODEL_DIR)
+
+        model_ids = []
+        if os.path.isdir(blobstore.MODEL_DIR):
+            model_ids = [
+                int(entry.name) for entry in os.scandir(blobstore.MODEL_DIR)
+                if entry.is_dir() and entry.name.isdigit()]
+
+        moved = run_parallel(move_model, ((local, model_id) for model_id in model_ids), workers)
+        self.stdout.write('Moved {} files of {} models to the sharded layout.'.format(sum(moved), len(model_ids)))
+
+        if not options['to_s3']:
+            return
+
+        target = storage.s3_storage()
+        keys = itertools.chain(local.list(blobstore.BLOB_PREFIX), local.list(blobstore.MODEL_PREFIX))
+        copied = run_parallel(
+            copy_key, ((local, target, key, stat, options['delete']) for key, stat in keys), workers)
+        self.stdout.write('Copied {} of {} files, {} bytes, to s3://{}/{}.'.format(
+            sum(1 for size in copied if size), len(copied), sum(copied), target.bucket, target.prefix))
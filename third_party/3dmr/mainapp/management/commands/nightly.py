@@ -1,63 +1,254 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
 from django.utils.dateformat import format
-from mainapp.models import LatestModel
-from json import dumps
-from mainapp.utils import MODEL_DIR
-from zipfile import ZipFile
+from django.utils.dateparse import parse_datetime
+from mainapp.models import LatestModel, Change
+from json import dumps, loads
+from mainapp import blobstore
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, BadZipFile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import time
+
+INFO_FILENAME = 'info.json'
+NIGHTLY_FILENAME = '3dmr-nightly.zip'
+
+# Models whose metadata is fetched per query, with their relations.
+BATCH_SIZE = 2000
+
+# Stored in the zip comment, to know what the next incremental run can reuse.
+STATE_VERSION = 1
+
+def model_info(model):
+    if model.location:
+        latitude = model.location.latitude
+        longitude = model.location.longitude
+    else:
+        latitude = None
+        longitude = None
+
+    return {
+        'author': model.author.username,
+        'revision': model.revision,
+        'title': model.title,
+        'description': model.description,
+        'upload_date': format(model.upload_date, 'U'),
+        'latitude': latitude,
+        'longitude': longitude,
+        'license': model.license,
+        'categories': [category.name for category in model.categories.all()],
+        'tags': model.tags,
+        'rotation': model.rotation,
+        'scale': model.scale,
+        'translation': [
+            model.translation_x,
+            model.translation_y,
+            model.translation_z
+        ]
+    }
+
+# Yields the visible latest models with their author, location and categories,
+# a batch of queries per BATCH_SIZE models instead of three per model.
+def iter_models():
+    models = LatestModel.objects \
+        .filter(is_hidden=False) \
+        .select_related('author', 'location') \
+        .prefetch_related('categories') \
+        .order_by('model_id')
+
+    last_model_id = None
+    while True:
+        batch = models if last_model_id is None else models.filter(model_id__gt=last_model_id)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            return
+
+        yield from batch
+        last_model_id = batch[-1].model_id
+
+# The revisions of the models in a previous dump, from its info.json, and
+# the time that dump was started, from its comment.
+def read_previous(zip_file):
+    try:
+        state = loads(zip_file.comment.decode())
+        if state.get('version') != STATE_VERSION:
+            return None, {}
+        started = parse_datetime(state['started'])
+    except (ValueError, KeyError, AttributeError):
+        return None, {}
+
+    with zip_file.open(INFO_FILENAME) as f:
+        info = loads(f.read().decode())
+
+    return started, {int(model_id): model['revision'] for model_id, model in info.items()}
+
+def model_zinfo(model_id, date_time):
+    zinfo = ZipInfo('models/{}.zip'.format(model_id), date_time)
+    zinfo.external_attr = 0o644 << 16
+    zinfo.compress_type = ZIP_STORED
+    return zinfo
+
+# Returns the path of the zip of a revision, reassembling it from its blobs
+# into |tmp_dir| if needed. Runs in the worker threads.
+def build_revision(model_id, revision, tmp_dir):
+    legacy_path = blobstore.local_legacy_revision_path(model_id, revision)
+    if legacy_path is not None:
+        return legacy_path, False
+
+    fd, path = tempfile.mkstemp(dir=tmp_dir, suffix='.zip')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in blobstore.revision_chunks(model_id, revision):
+            f.write(chunk)
+
+    return path, True
+
+def copy_fileobj(source, destination):
+    for chunk in iter(lambda: source.read(blobstore.CHUNK_SIZE), b''):
+        destination.write(chunk)
 
 class Command(BaseCommand):
     help = 'Updates the nightly dump'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', default=NIGHTLY_FILENAME,
+            help='Path of the dump, replaced atomically once complete.')
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Reuse the models of the previous dump whose revision has not changed since.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of threads reassembling model zips.')
+
     def handle(self, *args, **options):
-        INFO_FILENAME = 'info.json'
-        NIGHTLY_FILENAME = '3dmr-nightly.zip'
-
-        info_file = open(INFO_FILENAME, 'w')
-        zip_file = ZipFile(NIGHTLY_FILENAME, 'w')
-
-        models = LatestModel.objects.filter(is_hidden=False)
-
-        info_file.write('{\n')
-
-        first = True
-        for model in models.iterator():
-            model_id = model.model_id
-
-            if not first:
-                info_file.write(',')
-            first = False
-
-            if model.location:
-                latitude = model.location.latitude
-                longitude = model.location.longitude
-            else:
-                latitude = None
-                longitude = None
-
-            output = dumps({
-                'author': model.author.username,
-                'revision': model.revision,
-                'title': model.title,
-                'description': model.description,
-                'upload_date': format(model.upload_date, 'U'),
-                'latitude': latitude,
-                'longitude': longitude,
-                'license': model.license,
-                'categories': model.categories.all().values_list('name', flat=True)[::1],
-                'tags': model.tags,
-                'rotation': model.rotation,
-                'scale': model.scale,
-                'translation': [
-                    model.translation_x,
-                    model.translation_y,
-                    model.translation_z
-                ]
-            })
-
-            info_file.write('"{}": {}\n'.format(model_id, output))
-            zip_file.write('{}/{}/{}.zip'.format(MODEL_DIR, model_id, model.revision), 'models/{}.zip'.format(model_id))
-
-        info_file.write('}')
-        info_file.close()
-        zip_file.write(INFO_FILENAME)
-        zip_file.close()
+        output = os.path.abspath(options['output'])
+        workers = max(1, options['workers'])
+        started = timezone.now()
+        date_time = time.localtime(time.time())[:6]
+
+        previous = None
+        previous_started, previous_revisions, previous_members = None, {}, {}
+        if options['incremental'] and os.path.isfile(output):
+            try:
+                previous = ZipFile(output)
+                previous_started, previous_revisions = read_previous(previous)
+                with open(output, 'rb') as f:
+                    previous_members = {
+                        member['name']: member for member in blobstore.build_legacy_index(f)['members']}
+            except (BadZipFile, ValueError, KeyError) as e:
+                self.stderr.write('Ignoring the previous dump: {}'.format(e))
+                previous_started = None
+
+        if previous_started is None:
+            previous_revisions = {}
+        else:
+            self.stdout.write('Reusing models unchanged since {}.'.format(previous_started))
+
+        # Models with a new revision since the previous dump. Revisions are also
+        # compared below, so models missing from the previous dump are rebuilt.
+        changed = set()
+        if previous_started is not None:
+            changed = set(
+                Change.objects.filter(datetime__gte=previous_started)
+                .values_list('target_model_id', flat=True))
+
+        output_dir = os.path.dirname(output)
+        tmp_dir = tempfile.mkdtemp(dir=output_dir, prefix='.nightly-')
+        fd, tmp_output = tempfile.mkstemp(dir=output_dir, prefix='.tmp-', suffix='.zip')
+        os.close(fd)
+
+        try:
+            with ZipFile(tmp_output, 'w', allowZip64=True) as zip_file:
+                revisions = self.write_info(zip_file, date_time)
+                counts = self.write_models(
+                    zip_file, revisions, previous, previous_members, previous_revisions,
+                    changed, date_time, workers, tmp_dir)
+
+                zip_file.comment = dumps({
+                    'version': STATE_VERSION,
+                    'started': started.isoformat(),
+                }).encode()
+
+            os.chmod(tmp_output, 0o644)
+            os.replace(tmp_output, output)
+        except:
+            os.unlink(tmp_output)
+            raise
+        finally:
+            if previous is not None:
+                previous.close()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.stdout.write('Wrote {} models, {} reused from the previous dump.'.format(*counts))
+
+    # Streams info.json into the dump, and returns the (model_id, revision) of
+    # every model in it.
+    def write_info(self, zip_file, date_time):
+        zinfo = ZipInfo(INFO_FILENAME, date_time)
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = ZIP_DEFLATED
+
+        revisions = []
+        with zip_file.open(zinfo, 'w', force_zip64=True) as info_file:
+            info_file.write(b'{\n')
+
+            for model in iter_models():
+                if revisions:
+                    info_file.write(b',')
+
+                info_file.write('"{}": {}\n'.format(model.model_id, dumps(model_info(model))).encode())
+                revisions.append((model.model_id, model.revision))
+
+            info_file.write(b'}')
+
+        return revisions
+
+    # Writes the zip of every model, in order. Unchanged models are copied from
+    # the previous dump; the others are reassembled by |workers| threads, a
+    # bounded number of models ahead of the one being written.
+    def write_models(self, zip_file, revisions, previous, previous_members, previous_revisions,
+                     changed, date_time, workers, tmp_dir):
+        written, reused = 0, 0
+        pending = deque()
+
+        def write_next():
+            model_id, reuse, future = pending.popleft()
+            zinfo = model_zinfo(model_id, date_time)
+
+            if reuse is not None:
+                with blobstore.MemberFile(open(previous.filename, 'rb'), reuse) as source, \
+                     zip_file.open(zinfo, 'w', force_zip64=True) as destination:
+                    copy_fileobj(source, destination)
+                return True
+
+            path, is_temporary = future.result()
+            with open(path, 'rb') as source, \
+                 zip_file.open(zinfo, 'w', force_zip64=True) as destination:
+                copy_fileobj(source, destination)
+            if is_temporary:
+                os.unlink(path)
+            return False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for model_id, revision in revisions:
+                reuse = None
+                if previous_revisions.get(model_id) == revision and model_id not in changed:
+                    reuse = previous_members.get('models/{}.zip'.format(model_id))
+
+                future = None
+                if reuse is None:
+                    future = executor.submit(build_revision, model_id, revision, tmp_dir)
+                pending.append((model_id, reuse, future))
+
+                while len(pending) > workers * 4:
+                    reused += write_next()
+                    written += 1
+
+            while pending:
+                reused += write_next()
+                written += 1
+
+        return written, reused
@@ -0,0 +1,357 @@
+import io
+import json
+import posixpath
+import struct
+
+import numpy as np
+
+# Conversion of validated OBJ models into binary glTF (GLB) files, and
+# simplification of their meshes into levels of detail.
+#
+# A model becomes a single mesh with one primitive per material. All
+# primitives share the vertex buffers (float32 positions, normals and texture
+# coordinates) and have their own uint32 index buffer. Textures referenced
+# with map_Kd are embedded when they are PNG or JPEG images.
+
+GLB_MAGIC = b'glTF'
+GLB_VERSION = 2
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+# glTF constants.
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+FLOAT = 5126
+UNSIGNED_INT = 5125
+
+IMAGE_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+}
+
+DEFAULT_MATERIAL = {'name': None, 'color': [0.8, 0.8, 0.8, 1.0], 'texture': None}
+
+class Mesh(object):
+    def __init__(self, positions, normals, texcoords, triangles, materials, triangle_materials, textures):
+        # float32 arrays of shape (vertices, 3), (vertices, 3) and (vertices, 2).
+        # texcoords is None when the OBJ file doesn't give them for every face.
+        self.positions = positions
+        self.normals = normals
+        self.texcoords = texcoords
+        # uint32 array of shape (triangles, 3), and the index in |materials| of
+        # the material of each triangle.
+        self.triangles = triangles
+        self.materials = materials
+        self.triangle_materials = triangle_materials
+        # Image file contents, by name.
+        self.textures = textures
+
+def _resolve(referrer, reference):
+    reference = reference.replace('\\', '/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(referrer), reference))
+
+def _statements(open_member, name):
+    with open_member(name) as member:
+        for line in io.TextIOWrapper(member, encoding='utf-8'):
+            values = line.split()
+            if values and not values[0].startswith('#'):
+                yield values
+
+def _read_mtl(open_member, names, mtl, materials):
+    material = None
+    for values in _statements(open_member, mtl):
+        statement = values[0]
+        if statement == 'newmtl':
+            material = dict(DEFAULT_MATERIAL, color=list(DEFAULT_MATERIAL['color']))
+            materials[' '.join(values[1:])] = material
+        elif material is None:
+            continue
+        elif statement == 'Kd':
+            material['color'][:3] = [float(value) for value in values[1:4]]
+        elif statement == 'd':
+            material['color'][3] = float(values[-1])
+        elif statement == 'Tr':
+            material['color'][3] = 1.0 - float(values[-1])
+        elif statement == 'map_Kd':
+            # The file name may follow options, as in the validator.
+            for reference in (' '.join(values[1:]), values[-1]):
+                texture = _resolve(mtl, reference)
+                if texture in names:
+                    material['texture'] = texture
+                    break
+
+# Reads the OBJ file |obj| and its MTL files. |names| are the files of the
+# model and |open_member| opens one of them, see blobstore.open_member().
+# Polygons are split into triangle fans.
+def read_obj(names, open_member, obj):
+    positions = []
+    texcoords = []
+    normals = []
+    corners = []
+    face_materials = []
+
+    material_names = {}
+    materials = [DEFAULT_MATERIAL]
+    library = {}
+    current = 0
+
+    for values in _statements(open_member, obj):
+        statement = values[0]
+        if statement == 'v':
+            positions.append(values[1:4])
+        elif statement == 'vt':
+            texcoords.append((values[1], values[2] if len(values) > 2 else 0))
+        elif statement == 'vn':
+            normals.append(values[1:4])
+        elif statement == 'f':
+            face = []
+            for vertex in values[1:]:
+                parts = vertex.split('/') + ['', '']
+                indices = []
+                for part, count in zip(parts[:3], (len(positions), len(texcoords), len(normals))):
+                    if part:
+                        index = int(part)
+                        indices.append(index - 1 if index > 0 else count + index)
+                    else:
+                        indices.append(-1)
+                face.append(indices)
+
+            for i in range(1, len(face) - 1):
+                corners.extend((face[0], face[i], face[i + 1]))
+                face_materials.append(current)
+        elif statement == 'mtllib':
+            _read_mtl(open_member, names, _resolve(obj, ' '.join(values[1:])), library)
+        elif statement in ('usemtl', 'usemat'):
+            name = ' '.join(values[1:])
+            if name not in material_names:
+                material_names[name] = len(materials)
+                materials.append(dict(library.get(name, DEFAULT_MATERIAL), name=name))
+            current = material_names[name]
+
+    positions = np.array(positions, dtype=np.float32).reshape(-1, 3)
+    texcoords = np.array(texcoords, dtype=np.float32).reshape(-1, 2)
+    normals = np.array(normals, dtype=np.float32).reshape(-1, 3)
+    corners = np.array(corners, dtype=np.int64).reshape(-1, 3)
+
+    # Each distinct position/texcoord/normal combination becomes a vertex.
+    has_texcoords = len(corners) > 0 and bool((corners[:, 1] >= 0).all())
+    has_normals = len(corners) > 0 and bool((corners[:, 2] >= 0).all())
+    if not has_texcoords:
+        corners[:, 1] = -1
+    if not has_normals:
+        corners[:, 2] = -1
+
+    unique, inverse = np.unique(corners, axis=0, return_inverse=True)
+    triangles = inverse.reshape(-1, 3).astype(np.uint32)
+    vertex_positions = positions[unique[:, 0]] if len(unique) else positions[:0]
+
+    if has_texcoords:
+        # glTF texture coordinates start at the top left corner.
+        vertex_texcoords = texcoords[unique[:, 1]] * np.float32([1, -1]) + np.float32([0, 1])
+    else:
+        vertex_texcoords = None
+
+    if has_normals:
+        vertex_normals = normals[unique[:, 2]]
+    else:
+        vertex_normals = compute_normals(vertex_positions, triangles)
+
+    # Textures need texture coordinates.
+    textures = {}
+    for material in materials if has_texcoords else ():
+        texture = material['texture']
+        if texture is not None and posixpath.splitext(texture)[1].lower() in IMAGE_TYPES:
+            with open_member(texture) as f:
+                textures[texture] = f.read()
+
+    return Mesh(
+        vertex_positions, vertex_normals, vertex_texcoords, triangles, materials,
+        np.array(face_materials, dtype=np.uint32), textures)
+
+# Area weighted vertex normals.
+def compute_normals(positions, triangles):
+    corners = positions[triangles.astype(np.int64)]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+    # Sum the normals of the faces around each vertex.
+    vertices = triangles.astype(np.int64).reshape(-1)
+    face_normals = np.repeat(face_normals, 3, axis=0)
+    normals = np.stack([
+        np.bincount(vertices, weights=face_normals[:, i], minlength=len(positions)) for i in range(3)
+    ], axis=1)
+
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0] = 1
+    return (normals / lengths).astype(np.float32)
+
+def _cluster(mesh, resolution):
+    lower = mesh.positions.min(axis=0)
+    extent = float((mesh.positions.max(axis=0) - lower).max()) or 1.0
+    cells = np.minimum(
+        ((mesh.positions - lower) / extent * resolution).astype(np.int64), resolution - 1)
+    keys = (cells[:, 0] * resolution + cells[:, 1]) * resolution + cells[:, 2]
+
+    _, first, clusters = np.unique(keys, return_index=True, return_inverse=True)
+    clusters = clusters.reshape(-1)
+    counts = np.bincount(clusters).astype(np.float32)
+    positions = np.stack([
+        np.bincount(clusters, weights=mesh.positions[:, i]) / counts for i in range(3)
+    ], axis=1).astype(np.float32)
+
+    triangles = clusters[mesh.triangles.astype(np.int64)]
+    triangle_materials = mesh.triangle_materials
+
+    # Drop the triangles that collapsed into a line or a point, and those that
+    # became duplicates of another.
+    keep = (triangles[:, 0] != triangles[:, 1]) & \
+           (triangles[:, 1] != triangles[:, 2]) & \
+           (triangles[:, 0] != triangles[:, 2])
+    triangles = triangles[keep]
+    triangle_materials = triangle_materials[keep]
+
+    _, unique_triangles = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    unique_triangles.sort()
+    triangles = triangles[unique_triangles]
+    triangle_materials = triangle_materials[unique_triangles]
+
+    # Only keep the clusters still in use.
+    used, triangles = np.unique(triangles, return_inverse=True)
+    triangles = triangles.reshape(-1, 3).astype(np.uint32)
+    positions = positions[used]
+
+    # A cluster takes the texture coordinates of its first vertex.
+    texcoords = None
+    if mesh.texcoords is not None:
+        texcoords = mesh.texcoords[first[used]]
+
+    return Mesh(
+        positions, compute_normals(positions, triangles), texcoords, triangles,
+        mesh.materials, triangle_materials, mesh.textures)
+
+# Simplifies |mesh| to about |ratio| of its triangles by vertex clustering:
+# vertices in the same cell of a grid over the bounding box are merged into
+# their average. The grid is coarsened until the mesh is small enough.
+def simplify(mesh, ratio, max_attempts=8):
+    target = max(1, int(len(mesh.triangles) * ratio))
+
+    # A closed mesh has about twice as many triangles as vertices, and the
+    # vertices of a building mostly lie on its surface.
+    resolution = max(2, int((target / 2) ** 0.5 * 2))
+    for _ in range(max_attempts):
+        simplified = _cluster(mesh, resolution)
+        if len(simplified.triangles) <= target or resolution == 2:
+            return simplified
+        resolution = max(2, int(resolution * 0.7))
+
+    return simplified
+
+def _padded(data, padding=b'\0'):
+    return data + padding * (-len(data) % 4)
+
+# Encodes |mesh| as a GLB file.
+def to_glb(mesh):
+    binary = bytearray()
+    buffer_views = []
+    accessors = []
+
+    def add_view(data, target=None):
+        binary.extend(b'\0' * (-len(binary) % 4))
+        view = {'buffer': 0, 'byteOffset': len(binary), 'byteLength': len(data)}
+        if target is not None:
+            view['target'] = target
+        buffer_views.append(view)
+        binary.extend(data)
+        return len(buffer_views) - 1
+
+    def add_accessor(array, accessor_type, component_type, target, bounds=False):
+        accessor = {
+            'bufferView': add_view(array.tobytes(), target),
+            'componentType': component_type,
+            'count': len(array),
+            'type': accessor_type,
+        }
+        if bounds:
+            accessor['min'] = array.min(axis=0).tolist()
+            accessor['max'] = array.max(axis=0).tolist()
+        accessors.append(accessor)
+        return len(accessors) - 1
+
+    attributes = {}
+    if len(mesh.positions):
+        attributes['POSITION'] = add_accessor(
+            np.ascontiguousarray(mesh.positions, dtype=np.float32), 'VEC3', FLOAT, ARRAY_BUFFER, True)
+        attributes['NORMAL'] = add_accessor(
+            np.ascontiguousarray(mesh.normals, dtype=np.float32), 'VEC3', FLOAT, ARRAY_BUFFER)
+        if mesh.texcoords is not None:
+            attributes['TEXCOORD_0'] = add_accessor(
+                np.ascontiguousarray(mesh.texcoords, dtype=np.float32), 'VEC2', FLOAT, ARRAY_BUFFER)
+
+    images = []
+    textures = []
+    texture_indices = {}
+    for name, data in sorted(mesh.textures.items()):
+        texture_indices[name] = len(textures)
+        textures.append({'source': len(images), 'sampler': 0})
+        images.append({
+            'bufferView': add_view(data),
+            'mimeType': IMAGE_TYPES[posixpath.splitext(name)[1].lower()],
+        })
+
+    materials = []
+    primitives = []
+    for index, material in enumerate(mesh.materials):
+        triangles = mesh.triangles[mesh.triangle_materials == index]
+        if not len(triangles):
+            continue
+
+        pbr = {
+            'baseColorFactor': material['color'],
+            'metallicFactor': 0.0,
+            'roughnessFactor': 1.0,
+        }
+        if material['texture'] in texture_indices:
+            pbr['baseColorTexture'] = {'index': texture_indices[material['texture']]}
+
+        gltf_material = {'pbrMetallicRoughness': pbr, 'doubleSided': True}
+        if material['name'] is not None:
+            gltf_material['name'] = material['name']
+        if material['color'][3] < 1:
+            gltf_material['alphaMode'] = 'BLEND'
+
+        primitives.append({
+            'attributes': attributes,
+            'indices': add_accessor(
+                np.ascontiguousarray(triangles, dtype=np.uint32).reshape(-1),
+                'SCALAR', UNSIGNED_INT, ELEMENT_ARRAY_BUFFER),
+            'material': len(materials),
+        })
+        materials.append(gltf_material)
+
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'reservoir'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0}] if primitives else [{}],
+    }
+    if binary:
+        gltf['buffers'] = [{'byteLength': len(_padded(bytes(binary)))}]
+        gltf['bufferViews'] = buffer_views
+    if accessors:
+        gltf['accessors'] = accessors
+    if primitives:
+        gltf['meshes'] = [{'primitives': primitives}]
+        gltf['materials'] = materials
+    if images:
+        gltf['images'] = images
+        gltf['textures'] = textures
+        gltf['samplers'] = [{}]
+
+    chunks = [(GLB_CHUNK_JSON, _padded(json.dumps(gltf, separators=(',', ':')).encode(), b' '))]
+    if binary:
+        chunks.append((GLB_CHUNK_BIN, _padded(bytes(binary))))
+
+    length = 12 + sum(8 + len(data) for _, data in chunks)
+    return b''.join(
+        [struct.pack('<4sII', GLB_MAGIC, GLB_VERSION, length)] +
+        [struct.pack('<II', len(data), chunk_type) + data for chunk_type, data in chunks])
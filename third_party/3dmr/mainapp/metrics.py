@@ -0,0 +1,265 @@
+import atexit
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Counters and histograms of what the server does, exported in the Prometheus
+# text format by the /api/v1/metrics/ endpoint.
+#
+# Each process keeps its metrics in memory and writes them at most every
+# FLUSH_INTERVAL seconds to a file of its own in METRICS_DIR, which the
+# endpoint adds up, so every mod_wsgi process and job worker is counted
+# whichever one serves the scrape. The files of processes that exited are
+# merged into a single one, keeping counters monotonic across restarts.
+METRICS_DIR = os.environ.get(
+    'RESERVOIR_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'reservoir-metrics'))
+
+FLUSH_INTERVAL = 1.0
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+METRICS = {
+    'reservoir_http_requests_total': (
+        'counter', 'HTTP requests, by URL name, method and status code.'),
+    'reservoir_http_request_duration_seconds': (
+        'histogram', 'Time until the response is returned, by URL name. Streamed bodies are not included.'),
+    'reservoir_http_response_bytes_total': (
+        'counter', 'Bytes of response bodies, streamed ones included, by URL name.'),
+    'reservoir_db_queries_total': (
+        'counter', 'Database queries, by URL name.'),
+    'reservoir_db_query_duration_seconds_total': (
+        'counter', 'Time spent in database queries, by URL name.'),
+    'reservoir_operation_duration_seconds': (
+        'histogram', 'Duration of internal operations, such as upload validation, by operation.'),
+}
+
+DEAD_FILENAME = 'dead.json'
+LOCK_FILENAME = '.lock'
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+class Store(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = 0.0
+        self.filename = '{}-{}.json'.format(os.getpid(), uuid.uuid4().hex[:8])
+        self.pid = os.getpid()
+
+    def inc(self, name, labels, value=1):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.flush()
+
+    def observe(self, name, labels, value):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [
+                    [name, dict(labels), list(histogram['buckets']), histogram['sum'], histogram['count']]
+                    for (name, labels), histogram in self.histograms.items()],
+            }
+
+    # Writes the metrics of this process, unless they were written less than
+    # FLUSH_INTERVAL seconds ago.
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < FLUSH_INTERVAL:
+            return
+
+        # Processes forked after the store was created write a file of their own.
+        if os.getpid() != self.pid:
+            with self.lock:
+                self.counters, self.histograms = {}, {}
+                self.filename = '{}-{}.json'.format(os.getpid(), uuid.uuid4().hex[:8])
+                self.pid = os.getpid()
+
+        self.last_flush = now
+        try:
+            _write_json(os.path.join(METRICS_DIR, self.filename), self.snapshot())
+        except OSError:
+            logger.warning('Failed to write metrics to {}.'.format(METRICS_DIR), exc_info=True)
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+store = Store()
+atexit.register(store.flush, True)
+
+def inc(name, labels, value=1):
+    store.inc(name, labels, value)
+
+def observe(name, labels, value):
+    store.observe(name, labels, value)
+
+# Records how long the enclosed block takes as |operation|.
+@contextmanager
+def timed(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('reservoir_operation_duration_seconds', {'operation': operation}, time.perf_counter() - start)
+
+def _merge(total, snapshot):
+    for name, labels, value in snapshot['counters']:
+        key = (name, _labels_key(labels))
+        total['counters'][key] = total['counters'].get(key, 0) + value
+
+    for name, labels, buckets, sum_, count in snapshot['histograms']:
+        key = (name, _labels_key(labels))
+        histogram = total['histograms'].setdefault(
+            key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, bucket in enumerate(buckets):
+            histogram['buckets'][i] += bucket
+        histogram['sum'] += sum_
+        histogram['count'] += count
+
+def _as_snapshot(total):
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in total['counters'].items()],
+        'histograms': [
+            [name, dict(labels), histogram['buckets'], histogram['sum'], histogram['count']]
+            for (name, labels), histogram in total['histograms'].items()],
+    }
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Merges the files of processes that exited into DEAD_FILENAME.
+def _merge_dead_processes():
+    with open(os.path.join(METRICS_DIR, LOCK_FILENAME), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        dead = []
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.endswith('.json') or filename == DEAD_FILENAME:
+                continue
+            try:
+                pid = int(filename.split('-', 1)[0])
+            except ValueError:
+                continue
+            if not _is_alive(pid):
+                dead.append(filename)
+
+        if not dead:
+            return
+
+        dead_path = os.path.join(METRICS_DIR, DEAD_FILENAME)
+        total = {'counters': {}, 'histograms': {}}
+        for path in [dead_path] + [os.path.join(METRICS_DIR, filename) for filename in dead]:
+            snapshot = _read_json(path)
+            if snapshot is not None:
+                _merge(total, snapshot)
+
+        _write_json(dead_path, _as_snapshot(total))
+        for filename in dead:
+            os.unlink(os.path.join(METRICS_DIR, filename))
+
+# Returns the metrics of every process, added up.
+def collect():
+    store.flush(force=True)
+    try:
+        _merge_dead_processes()
+    except OSError:
+        logger.warning('Failed to merge the metrics of exited processes.', exc_info=True)
+
+    total = {'counters': {}, 'histograms': {}}
+    for filename in os.listdir(METRICS_DIR):
+        if filename.endswith('.json') and not filename.startswith('.'):
+            snapshot = _read_json(os.path.join(METRICS_DIR, filename))
+            if snapshot is not None:
+                _merge(total, snapshot)
+
+    return total
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Renders the metrics of every process in the Prometheus text format.
+def render():
+    total = collect()
+    lines = []
+
+    for name, (kind, help_text) in METRICS.items():
+        counters = sorted((labels, value) for (key, labels), value in total['counters'].items() if key == name)
+        histograms = sorted(
+            (labels, histogram) for (key, labels), histogram in total['histograms'].items() if key == name)
+        if not counters and not histograms:
+            continue
+
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        for labels, value in counters:
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+
+        for labels, histogram in histograms:
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, histogram['buckets']):
+                cumulative += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels + (('le', _format_value(bound)),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(histogram['sum'])))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
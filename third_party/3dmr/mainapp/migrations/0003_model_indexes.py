@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0002_model_building_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='model',
+            index=models.Index(fields=['building_id'], name='mainapp_model_building_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='model',
+            index=models.Index(fields=['model_id', 'revision'], name='mainapp_model_revision_idx'),
+        ),
+    ]
@@ -0,0 +1,155 @@
+# Replaces the mainapp_latestmodel materialized view, which had to be fully
+# refreshed after every write to mainapp_model, with a table that statement
+# level triggers keep up to date for just the model_ids each statement touches.
+#
+# A row of mainapp_model is in mainapp_latestmodel iff no other row with the
+# same model_id has a higher revision, exactly as in the view it replaces.
+
+from django.db import migrations
+
+LATEST_MODEL_COLUMNS = """
+    id,
+    model_id,
+    building_id,
+    revision,
+    title,
+    description,
+    rendered_description,
+    upload_date,
+    location_id,
+    license,
+    rotation,
+    scale,
+    translation_x,
+    translation_y,
+    translation_z,
+    author_id,
+    tags,
+    is_hidden
+"""
+
+FORWARD_SQL = """
+DROP MATERIALIZED VIEW IF EXISTS mainapp_latestmodel;
+
+CREATE TABLE mainapp_latestmodel (
+    id integer PRIMARY KEY,
+    model_id integer NOT NULL,
+    building_id varchar(1024) NULL,
+    revision integer NOT NULL,
+    title varchar(32) NOT NULL,
+    description varchar(512) NOT NULL,
+    rendered_description varchar(1024) NOT NULL,
+    upload_date date NOT NULL,
+    location_id integer NULL,
+    license integer NOT NULL,
+    rotation double precision NOT NULL,
+    scale double precision NOT NULL,
+    translation_x double precision NOT NULL,
+    translation_y double precision NOT NULL,
+    translation_z double precision NOT NULL,
+    author_id integer NOT NULL,
+    tags hstore NOT NULL,
+    is_hidden boolean NOT NULL
+);
+
+CREATE INDEX mainapp_latestmodel_model_id ON mainapp_latestmodel (model_id);
+CREATE INDEX mainapp_latestmodel_building_id ON mainapp_latestmodel (building_id);
+CREATE INDEX mainapp_latestmodel_author_id ON mainapp_latestmodel (author_id);
+CREATE INDEX mainapp_latestmodel_location_id ON mainapp_latestmodel (location_id);
+
+-- Replaces the rows of the given model_ids with their latest revisions.
+CREATE FUNCTION mainapp_latestmodel_sync(model_ids integer[]) RETURNS void AS $$
+BEGIN
+    DELETE FROM mainapp_latestmodel WHERE model_id = ANY(model_ids);
+
+    INSERT INTO mainapp_latestmodel ({columns})
+        SELECT {columns}
+        FROM mainapp_model model
+        WHERE model.model_id = ANY(model_ids) AND
+              model.revision = (
+                  SELECT max(newer.revision)
+                  FROM mainapp_model newer
+                  WHERE newer.model_id = model.model_id);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rebuilds the whole table, e.g. after a LatestModel.bulk_updates() block.
+CREATE FUNCTION mainapp_latestmodel_refresh() RETURNS void AS $$
+BEGIN
+    DELETE FROM mainapp_latestmodel;
+
+    INSERT INTO mainapp_latestmodel ({columns})
+        SELECT {columns}
+        FROM mainapp_model model
+            LEFT JOIN mainapp_model newer
+                ON model.model_id = newer.model_id AND
+                   model.revision < newer.revision
+        WHERE newer.revision IS NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION mainapp_latestmodel_changed() RETURNS trigger AS $$
+DECLARE
+    changed integer[];
+BEGIN
+    IF current_setting('mainapp.latestmodel_bulk', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT model_id) INTO changed FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT model_id) INTO changed FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT model_id) INTO changed FROM (
+            SELECT model_id FROM old_rows
+            UNION
+            SELECT model_id FROM new_rows) changed_rows;
+    END IF;
+
+    IF changed IS NOT NULL THEN
+        PERFORM mainapp_latestmodel_sync(changed);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mainapp_latestmodel_insert
+    AFTER INSERT ON mainapp_model
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE mainapp_latestmodel_changed();
+
+CREATE TRIGGER mainapp_latestmodel_update
+    AFTER UPDATE ON mainapp_model
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE mainapp_latestmodel_changed();
+
+CREATE TRIGGER mainapp_latestmodel_delete
+    AFTER DELETE ON mainapp_model
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE mainapp_latestmodel_changed();
+
+SELECT mainapp_latestmodel_refresh();
+""".format(columns=LATEST_MODEL_COLUMNS)
+
+REVERSE_SQL = """
+DROP TRIGGER mainapp_latestmodel_insert ON mainapp_model;
+DROP TRIGGER mainapp_latestmodel_update ON mainapp_model;
+DROP TRIGGER mainapp_latestmodel_delete ON mainapp_model;
+DROP FUNCTION mainapp_latestmodel_changed();
+DROP FUNCTION mainapp_latestmodel_refresh();
+DROP FUNCTION mainapp_latestmodel_sync(integer[]);
+DROP TABLE mainapp_latestmodel;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0003_model_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+from .. import geo
+
+BATCH_SIZE = 1000
+
+def fill_geohashes(apps, schema_editor):
+    Location = apps.get_model('mainapp', 'Location')
+
+    batch = []
+    def flush():
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE mainapp_location SET geohash = v.geohash '
+                'FROM (VALUES {}) AS v(id, geohash) '
+                'WHERE mainapp_location.id = v.id'.format(', '.join(['(%s, %s)'] * len(batch))),
+                [value for row in batch for value in row])
+        batch.clear()
+
+    for location in Location.objects.only('id', 'latitude', 'longitude').iterator():
+        batch.append((location.id, geo.encode(location.latitude, location.longitude)))
+        if len(batch) == BATCH_SIZE:
+            flush()
+
+    if batch:
+        flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0004_latestmodel_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geohash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=9),
+        ),
+        migrations.RunPython(fill_geohashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Records when each row of mainapp_latestmodel was last written. The sync
+# functions of migration 0004 list the columns they insert, so rows get the
+# time they were rewritten at. clock_timestamp() rather than now(), so that
+# each statement of a transaction gets its own time.
+
+from django.db import migrations
+
+FORWARD_SQL = """
+ALTER TABLE mainapp_latestmodel
+    ADD COLUMN synced_at timestamp with time zone NOT NULL DEFAULT clock_timestamp();
+"""
+
+REVERSE_SQL = """
+ALTER TABLE mainapp_latestmodel DROP COLUMN synced_at;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0005_location_geohash'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
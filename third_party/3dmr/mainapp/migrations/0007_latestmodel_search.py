@@ -0,0 +1,38 @@
+# Indexes the latest revisions for search. mainapp_latestmodel gets a
+# generated tsvector of the title and description for full-text matches, and
+# trigram indexes on the upper-cased title and description, which is what
+# Django's icontains lookups compare, so substring searches are indexed too.
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+FORWARD_SQL = """
+ALTER TABLE mainapp_latestmodel
+    ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', title), 'A') ||
+        setweight(to_tsvector('simple', description), 'B')
+    ) STORED;
+
+CREATE INDEX mainapp_latestmodel_search_vector ON mainapp_latestmodel USING gin (search_vector);
+CREATE INDEX mainapp_latestmodel_title_trgm ON mainapp_latestmodel USING gin (upper(title::text) gin_trgm_ops);
+CREATE INDEX mainapp_latestmodel_description_trgm ON mainapp_latestmodel USING gin (upper(description::text) gin_trgm_ops);
+"""
+
+REVERSE_SQL = """
+DROP INDEX mainapp_latestmodel_description_trgm;
+DROP INDEX mainapp_latestmodel_title_trgm;
+DROP INDEX mainapp_latestmodel_search_vector;
+ALTER TABLE mainapp_latestmodel DROP COLUMN search_vector;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0006_latestmodel_synced_at'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.0.5 on 2026-10-18 12:00
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mainapp', '0007_latestmodel_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('upload', 'Upload'), ('revise', 'Revise')], max_length=16)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('progress', models.CharField(default='', max_length=64)),
+                ('options', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('spool_path', models.CharField(max_length=1024)),
+                ('model_id', models.IntegerField(null=True)),
+                ('revision', models.IntegerField(null=True)),
+                ('error', models.CharField(default='', max_length=1024)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='uploadjob',
+            index=models.Index(fields=['status', 'created'], name='mainapp_uploadjob_queue_idx'),
+        ),
+    ]
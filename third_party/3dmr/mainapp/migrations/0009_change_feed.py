@@ -0,0 +1,51 @@
+# Generated by Django 2.0.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0008_uploadjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='change',
+            name='model',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='mainapp.Model'),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='target_model_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='revision',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='building_id',
+            field=models.CharField(max_length=1024, null=True),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        # Earlier changes get the revision they were made to. Their sha256 is
+        # left unset rather than read from every manifest.
+        migrations.RunSQL(
+            '''
+            UPDATE mainapp_change
+            SET target_model_id = mainapp_model.model_id,
+                revision = mainapp_model.revision,
+                building_id = mainapp_model.building_id
+            FROM mainapp_model
+            WHERE mainapp_change.model_id = mainapp_model.id
+            ''',
+            migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,115 @@
+# Makes concurrent writes to the revisions of a model safe for
+# mainapp_latestmodel. Under READ COMMITTED, the DELETE of one transaction's
+# sync could miss the row another transaction's sync had just inserted, and
+# both rows were kept. Syncs now take a transaction level advisory lock on
+# each model_id first, so syncs of the same model run one after the other,
+# each seeing the rows of the previous one.
+#
+# mainapp_model has no unique (model_id, revision), so the latest revision of
+# a model is now the one with the highest id among its highest revisions, and
+# mainapp_latestmodel.model_id is unique, so that any other slip fails rather
+# than duplicating search results.
+
+from django.db import migrations
+
+LATEST_MODEL_COLUMNS = """
+    id,
+    model_id,
+    building_id,
+    revision,
+    title,
+    description,
+    rendered_description,
+    upload_date,
+    location_id,
+    license,
+    rotation,
+    scale,
+    translation_x,
+    translation_y,
+    translation_z,
+    author_id,
+    tags,
+    is_hidden
+"""
+
+FORWARD_SQL = """
+-- Replaces the rows of the given model_ids with their latest revisions. The
+-- locks are taken in model_id order, so that syncs of overlapping sets of
+-- models can't deadlock, and are namespaced by the oid of the table.
+CREATE OR REPLACE FUNCTION mainapp_latestmodel_sync(model_ids integer[]) RETURNS void AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock('mainapp_latestmodel'::regclass::oid::integer, ids.model_id)
+    FROM (SELECT DISTINCT unnest(model_ids) AS model_id ORDER BY 1) ids;
+
+    DELETE FROM mainapp_latestmodel WHERE model_id = ANY(model_ids);
+
+    INSERT INTO mainapp_latestmodel ({columns})
+        SELECT DISTINCT ON (model_id) {columns}
+        FROM mainapp_model
+        WHERE model_id = ANY(model_ids)
+        ORDER BY model_id, revision DESC, id DESC;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mainapp_latestmodel_refresh() RETURNS void AS $$
+BEGIN
+    DELETE FROM mainapp_latestmodel;
+
+    INSERT INTO mainapp_latestmodel ({columns})
+        SELECT DISTINCT ON (model_id) {columns}
+        FROM mainapp_model
+        ORDER BY model_id, revision DESC, id DESC;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT mainapp_latestmodel_refresh();
+
+DROP INDEX mainapp_latestmodel_model_id;
+CREATE UNIQUE INDEX mainapp_latestmodel_model_id ON mainapp_latestmodel (model_id);
+""".format(columns=LATEST_MODEL_COLUMNS)
+
+REVERSE_SQL = """
+DROP INDEX mainapp_latestmodel_model_id;
+CREATE INDEX mainapp_latestmodel_model_id ON mainapp_latestmodel (model_id);
+
+CREATE OR REPLACE FUNCTION mainapp_latestmodel_sync(model_ids integer[]) RETURNS void AS $$
+BEGIN
+    DELETE FROM mainapp_latestmodel WHERE model_id = ANY(model_ids);
+
+    INSERT INTO mainapp_latestmodel ({columns})
+        SELECT {columns}
+        FROM mainapp_model model
+        WHERE model.model_id = ANY(model_ids) AND
+              model.revision = (
+                  SELECT max(newer.revision)
+                  FROM mainapp_model newer
+                  WHERE newer.model_id = model.model_id);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mainapp_latestmodel_refresh() RETURNS void AS $$
+BEGIN
+    DELETE FROM mainapp_latestmodel;
+
+    INSERT INTO mainapp_latestmodel ({columns})
+        SELECT {columns}
+        FROM mainapp_model model
+            LEFT JOIN mainapp_model newer
+                ON model.model_id = newer.model_id AND
+                   model.revision < newer.revision
+        WHERE newer.revision IS NULL;
+END;
+$$ LANGUAGE plpgsql;
+""".format(columns=LATEST_MODEL_COLUMNS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0009_change_feed'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0010_latestmodel_sync_lock'),
+    ]
+
+    operations = [
+        # Changes recorded so far have the sha256 of the zip as uploaded, which
+        # downloads don't match. They are left unset, as before 0009.
+        migrations.RunSQL(
+            'UPDATE mainapp_change SET sha256 = NULL',
+            migrations.RunSQL.noop),
+    ]
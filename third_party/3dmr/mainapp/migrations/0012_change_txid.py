@@ -0,0 +1,45 @@
+# Orders the change feed by transaction rather than by insert time. Each
+# change gets the id of the transaction that recorded it, set by a trigger so
+# that every way of inserting changes, bulk_create() included, sets it.
+
+from django.db import migrations, models
+
+FORWARD_SQL = """
+UPDATE mainapp_change SET txid = 0;
+
+CREATE OR REPLACE FUNCTION mainapp_change_set_txid() RETURNS trigger AS $$
+BEGIN
+    NEW.txid := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mainapp_change_set_txid
+    BEFORE INSERT ON mainapp_change
+    FOR EACH ROW EXECUTE PROCEDURE mainapp_change_set_txid();
+"""
+
+REVERSE_SQL = """
+DROP TRIGGER mainapp_change_set_txid ON mainapp_change;
+DROP FUNCTION mainapp_change_set_txid();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0011_change_served_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='txid',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['txid', 'id'], name='mainapp_change_feed_idx'),
+        ),
+    ]
@@ -0,0 +1,331 @@
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import posixpath
+import resource
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from zipfile import ZipFile, BadZipFile
+
+from . import blobstore
+from . import metrics
+from .model_extractor import MAX_UNCOMPRESSED_SIZE
+from .zipstream import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Number of worker processes validating uploads. 0 validates in the calling
+# thread instead, which is convenient for development and tests.
+VALIDATION_WORKERS = int(os.environ.get('RESERVOIR_VALIDATION_WORKERS', 2))
+
+# Limits applied to each validation job.
+VALIDATION_CPU_SECONDS = int(os.environ.get('RESERVOIR_VALIDATION_CPU_SECONDS', 30))
+VALIDATION_MEMORY_BYTES = int(os.environ.get('RESERVOIR_VALIDATION_MEMORY_BYTES', 1024 * 1024 * 1024))
+VALIDATION_TIMEOUT = int(os.environ.get('RESERVOIR_VALIDATION_TIMEOUT', 60))
+
+# MTL statements referencing a texture file.
+TEXTURE_STATEMENTS = {
+    'map_Kd', 'map_Ka', 'map_Ks', 'map_Ns', 'map_d', 'map_bump', 'bump',
+    'map_Bump', 'disp', 'decal', 'refl',
+}
+
+# MTL statements whose arguments must all be numbers.
+NUMERIC_MTL_STATEMENTS = {'Kd', 'Ka', 'Ks', 'Ke', 'Ns', 'Ni', 'd', 'Tr', 'illum'}
+
+class ModelValidationError(ValueError):
+    pass
+
+# Checks that a model zip file holds a single OBJ file, that the OBJ and the
+# MTL files it references parse, that every face index refers to an existing
+# vertex, texture coordinate or normal, and that referenced materials and
+# textures exist. Members are read straight from the zip file, line by line,
+# keeping only counts and names in memory. An OBJ file identical to one that
+# passed before is not parsed again, only its MTL files and textures are
+# checked.
+#
+# Returns a summary of the model, and raises ModelValidationError with a
+# message meant for the uploader if the model is invalid.
+def validate_zip(zip_file):
+    names = set()
+    total_size_uncompressed = 0
+    for info in zip_file.infolist():
+        if '..' in info.filename or info.filename.startswith('/'):
+            raise ModelValidationError('Invalid path in zip file: {}'.format(info.filename))
+
+        total_size_uncompressed += info.file_size
+        names.add(info.filename)
+
+    if total_size_uncompressed >= MAX_UNCOMPRESSED_SIZE:
+        raise ModelValidationError('Uncompressed model is larger than {} bytes.'.format(
+            int(MAX_UNCOMPRESSED_SIZE)))
+
+    objs = [name for name in names if name.endswith('.obj')]
+    if len(objs) != 1:
+        raise ModelValidationError('No single .obj file found in your uploaded zip file.')
+
+    return _ObjValidator(zip_file, names, objs[0]).validate()
+
+class _ObjValidator(object):
+    def __init__(self, zip_file, names, obj):
+        self.zip_file = zip_file
+        self.names = names
+        self.obj = obj
+
+        self.vertices = 0
+        self.texcoords = 0
+        self.normals = 0
+        self.faces = 0
+        self.materials = set()
+        self.textures = set()
+
+        # What the MTL files must provide for the OBJ file to be valid.
+        self.mtllibs = []
+        self.used_materials = set()
+
+    def validate(self):
+        digest = self.__digest(self.obj)
+        obj_summary = blobstore.get_obj_summary(digest)
+
+        if obj_summary is None:
+            self.__validate_obj()
+            self.__save_obj_summary(digest)
+        else:
+            self.__validate_known_obj(obj_summary)
+
+        return {
+            'obj': self.obj,
+            'vertices': self.vertices,
+            'faces': self.faces,
+            'materials': len(self.materials),
+            'textures': sorted(self.textures),
+        }
+
+    def __validate_obj(self):
+        for line_number, values in self.__statements(self.obj):
+            try:
+                self.__parse_obj_statement(values)
+            except ModelValidationError:
+                raise
+            except (ValueError, IndexError) as e:
+                raise ModelValidationError(
+                    'Error parsing OBJ/MTL files: {} line {}: {}'.format(self.obj, line_number, e))
+
+    def __validate_known_obj(self, obj_summary):
+        self.vertices = obj_summary['vertices']
+        self.texcoords = obj_summary['texcoords']
+        self.normals = obj_summary['normals']
+        self.faces = obj_summary['faces']
+
+        for reference in obj_summary['mtllibs']:
+            self.__parse_mtl(self.__resolve(self.obj, reference))
+
+        for name in obj_summary['used_materials']:
+            if name not in self.materials:
+                raise ModelValidationError(
+                    'Error parsing OBJ/MTL files: {}: unknown material: {}'.format(self.obj, name))
+
+    def __save_obj_summary(self, digest):
+        try:
+            blobstore.put_obj_summary(digest, {
+                'vertices': self.vertices,
+                'texcoords': self.texcoords,
+                'normals': self.normals,
+                'faces': self.faces,
+                'mtllibs': self.mtllibs,
+                'used_materials': sorted(self.used_materials),
+            })
+        except OSError:
+            logger.warning('Failed to save the validation summary of OBJ file {}.'.format(digest), exc_info=True)
+
+    def __digest(self, name):
+        digest = hashlib.sha256()
+        with self.zip_file.open(name) as member:
+            for chunk in iter(lambda: member.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def __parse_obj_statement(self, values):
+        statement = values[0]
+
+        if statement == 'v':
+            if len(values) < 4:
+                raise ValueError('vertex needs 3 coordinates')
+            [float(value) for value in values[1:]]
+            self.vertices += 1
+        elif statement == 'vt':
+            if len(values) < 2:
+                raise ValueError('texture coordinate needs a value')
+            [float(value) for value in values[1:]]
+            self.texcoords += 1
+        elif statement == 'vn':
+            if len(values) != 4:
+                raise ValueError('normal needs 3 coordinates')
+            [float(value) for value in values[1:]]
+            self.normals += 1
+        elif statement == 'f':
+            if len(values) < 4:
+                raise ValueError('face needs at least 3 vertices')
+            for vertex in values[1:]:
+                self.__check_face_vertex(vertex)
+            self.faces += 1
+        elif statement == 'mtllib':
+            reference = ' '.join(values[1:])
+            self.mtllibs.append(reference)
+            self.__parse_mtl(self.__resolve(self.obj, reference))
+        elif statement in ('usemtl', 'usemat'):
+            name = ' '.join(values[1:])
+            if name not in self.materials:
+                raise ValueError('unknown material: {}'.format(name))
+            self.used_materials.add(name)
+
+    def __check_face_vertex(self, vertex):
+        parts = vertex.split('/')
+        if len(parts) > 3:
+            raise ValueError('invalid face vertex: {}'.format(vertex))
+
+        counts = (self.vertices, self.texcoords, self.normals)
+        for i, part in enumerate(parts):
+            if part == '' and i > 0:
+                continue
+
+            index = int(part)
+            if index == 0 or index > counts[i] or -index > counts[i]:
+                raise ValueError('face index out of range: {}'.format(vertex))
+
+    def __parse_mtl(self, mtl):
+        if mtl not in self.names:
+            raise ModelValidationError('Error parsing OBJ/MTL files: missing material file {}'.format(mtl))
+
+        for line_number, values in self.__statements(mtl):
+            statement = values[0]
+            try:
+                if statement == 'newmtl':
+                    self.materials.add(' '.join(values[1:]))
+                elif statement in NUMERIC_MTL_STATEMENTS:
+                    if len(values) < 2:
+                        raise ValueError('{} needs a value'.format(statement))
+                    [float(value) for value in values[1:]]
+                elif statement in TEXTURE_STATEMENTS:
+                    self.textures.add(self.__texture(mtl, values))
+            except ValueError as e:
+                raise ModelValidationError(
+                    'Error parsing OBJ/MTL files: {} line {}: {}'.format(mtl, line_number, e))
+
+    # Texture statements may carry options before the file name, e.g.
+    # "map_Kd -s 1 1 1 texture.png", so fall back to the last value.
+    def __texture(self, mtl, values):
+        for reference in (' '.join(values[1:]), values[-1]):
+            texture = self.__resolve(mtl, reference)
+            if texture in self.names:
+                return texture
+
+        raise ValueError('missing texture {}'.format(' '.join(values[1:])))
+
+    # References are relative to the directory of the referencing file.
+    def __resolve(self, referrer, reference):
+        reference = reference.replace('\\', '/')
+        return posixpath.normpath(posixpath.join(posixpath.dirname(referrer), reference))
+
+    def __statements(self, name):
+        try:
+            with self.zip_file.open(name) as member:
+                for line_number, line in enumerate(io.TextIOWrapper(member, encoding='utf-8'), 1):
+                    values = line.split()
+                    if values and not values[0].startswith('#'):
+                        yield line_number, values
+        except UnicodeDecodeError:
+            raise ModelValidationError('Error parsing OBJ/MTL files: {} is not valid UTF-8.'.format(name))
+
+# Runs in a worker process: the address space limit is set once per worker,
+# the CPU time limit is renewed for every job since it counts the worker's
+# total CPU time. Exceeding it kills the worker with SIGXCPU.
+def _init_worker():
+    resource.setrlimit(resource.RLIMIT_AS, (VALIDATION_MEMORY_BYTES, VALIDATION_MEMORY_BYTES))
+
+def _validate_job(source):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_limit = int(usage.ru_utime + usage.ru_stime) + VALIDATION_CPU_SECONDS
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, hard))
+
+    try:
+        return _validate_source(source)
+    except MemoryError:
+        raise ModelValidationError('Model needs too much memory to validate.')
+
+# |source| is either the path of a zip file or its contents.
+def _validate_source(source):
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    try:
+        with ZipFile(source) as zip_file:
+            return validate_zip(zip_file)
+    except BadZipFile:
+        raise ModelValidationError('Uploaded file was not a valid zip file.')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=VALIDATION_WORKERS,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_worker)
+
+        return _executor
+
+# Stops the worker pool, if any. The next validation starts a new one.
+def shutdown():
+    global _executor
+
+    with _executor_lock:
+        executor, _executor = _executor, None
+
+    if executor is not None:
+        executor.shutdown()
+
+def _reset_executor(executor):
+    global _executor
+
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+    executor.shutdown(wait=False)
+
+# Validates an uploaded model file in the worker pool, see validate_zip().
+# |model_file| is an uploaded file, as found in request.FILES, or a path.
+@metrics.timed('upload_validation')
+def validate_model_file(model_file):
+    if isinstance(model_file, str):
+        source = model_file
+    elif hasattr(model_file, 'temporary_file_path'):
+        source = model_file.temporary_file_path()
+    else:
+        # Small uploads are kept in memory by Django.
+        model_file.seek(0)
+        source = model_file.read()
+        model_file.seek(0)
+
+    if VALIDATION_WORKERS <= 0:
+        return _validate_source(source)
+
+    executor = _get_executor()
+    try:
+        return executor.submit(_validate_job, source).result(timeout=VALIDATION_TIMEOUT)
+    except TimeoutError:
+        logger.warning('Model validation timed out after {} seconds.'.format(VALIDATION_TIMEOUT))
+        raise ModelValidationError('Model took too long to validate.')
+    except BrokenProcessPool:
+        # The worker was killed, most likely for exceeding its CPU time.
+        logger.warning('Model validation worker died, restarting the pool.')
+        _reset_executor(executor)
+        raise ModelValidationError('Model took too long to validate.')
@@ -1,5 +1,8 @@
-from django.db import models
+from contextlib import contextmanager
+
+from django.db import models, connection, transaction
 from django.contrib.postgres import fields
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
@@ -9,6 +12,9 @@ from django_pgviews import view as pg
 import logging
 
 from .utils import CHANGES
+from . import geo
+from . import info_cache
+from . import metrics
 
 from rest_framework.authtoken.models import Token
 
@@ -45,6 +51,12 @@ class Category(models.Model):
 class Location(models.Model):
     latitude = models.FloatField()
     longitude = models.FloatField()
+    # Indexed for prefix searches, see geo.within().
+    geohash = models.CharField(max_length=geo.GEOHASH_PRECISION, db_index=True, default='', editable=False)
+
+    def save(self, *args, **kwargs):
+        self.geohash = geo.encode(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
 
 class Model(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -68,8 +80,16 @@ class Model(models.Model):
 
     class Meta:
         app_label = 'mainapp'
+        indexes = [
+            models.Index(fields=['building_id'], name='mainapp_model_building_idx'),
+            models.Index(fields=['model_id', 'revision'], name='mainapp_model_revision_idx'),
+        ]
 
-class LatestModel(pg.MaterializedView):
+# The latest revision of every model. This is a plain table kept up to date by
+# statement-level triggers on mainapp_model (see migration 0004), so each write
+# to Model only touches the rows of the model_ids it changed, instead of
+# re-running the whole latest-revision anti-join.
+class LatestModel(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     model_id = models.IntegerField()
     building_id = models.CharField(max_length=1024)
@@ -88,40 +108,41 @@ class LatestModel(pg.MaterializedView):
     translation_y = models.FloatField(default=0.0)
     translation_z = models.FloatField(default=0.0)
     is_hidden = models.BooleanField(default=False)
-
-    concurrent_index = 'id'
-    sql = """
-        SELECT
-            model.id AS id,
-            model.model_id AS model_id,
-            model.building_id AS building_id,
-            model.revision AS revision,
-            model.title AS title,
-            model.description AS description,
-            model.rendered_description AS rendered_description,
-            model.upload_date AS upload_date,
-            model.location_id as location_id,
-            model.license AS license,
-            model.rotation AS rotation,
-            model.scale AS scale,
-            model.translation_x AS translation_x,
-            model.translation_y AS translation_y,
-            model.translation_z AS translation_z,
-            model.author_id AS author_id,
-            model.tags AS tags,
-            model.is_hidden AS is_hidden
-        FROM mainapp_model model
-            LEFT JOIN mainapp_model newer
-                ON model.model_id = newer.model_id AND
-                   model.revision < newer.revision
-        WHERE newer.revision is NULL
-    """
+    # When the row was last written by the triggers, for cache validation.
+    synced_at = models.DateTimeField()
+    # Generated from the title and description, see search.py.
+    search_vector = SearchVectorField()
 
     class Meta:
         app_label = 'mainapp'
         db_table = 'mainapp_latestmodel'
         managed = False
 
+    # Rebuilds the whole table from mainapp_model. Writes to Model keep the
+    # table up to date by themselves, so this is only needed after bulk_updates().
+    @classmethod
+    @metrics.timed('latestmodel_refresh')
+    def refresh(cls):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT mainapp_latestmodel_refresh()')
+
+    # Suspends the per-statement maintenance for the current transaction and
+    # rebuilds the table once at the end. Use this for scripts that write or
+    # delete large numbers of models at once.
+    @classmethod
+    @contextmanager
+    def bulk_updates(cls):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL mainapp.latestmodel_bulk = 'on'")
+
+            yield
+
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL mainapp.latestmodel_bulk = 'off'")
+
+            cls.refresh()
+
 # View for the categories field above
 class ModelCategories(pg.View):
     sql = """
@@ -137,25 +158,80 @@ class ModelCategories(pg.View):
         db_table = 'mainapp_latestmodel_categories'
         managed = False
 
-@receiver(post_save, sender=Model)
-def model_saved(sender, action=None, instance=None, **kwargs):
-    LatestModel.refresh(concurrently=True)
-
-@receiver(post_delete, sender=Model)
-def model_deleted(sender, action=None, instance=None, **kwargs):
-    logger.debug('Refreshing LatestModel after Model delete.')
-    LatestModel.refresh(concurrently=True)
-
+# A change to a revision, in the order they were made, see CHANGES. The
+# revision is copied so that changes outlive deleted models, which clear
+# |model|, and can be listed by the change feed without joining.
 class Change(models.Model):
     author = models.ForeignKey(User, models.CASCADE)
-    model = models.ForeignKey(Model, models.CASCADE)
+    model = models.ForeignKey(Model, models.SET_NULL, null=True)
     typeof = models.IntegerField()
     datetime = models.DateTimeField(auto_now_add=True)
+    # The model_id of |model|. Named apart as |model| is stored as model_id.
+    target_model_id = models.IntegerField(null=True)
+    revision = models.IntegerField(null=True)
+    building_id = models.CharField(max_length=1024, null=True)
+    # The sha256 of the zip file of the revision as served, see
+    # blobstore.get_archive_info(), None for deletions and changes recorded
+    # before it was.
+    sha256 = models.CharField(max_length=64, null=True)
+    # The id of the transaction that recorded the change, txid_current(), set
+    # by a trigger on insert, see migration 0012. 0 for changes recorded
+    # before. The change feed is ordered by (txid, id), which follows the
+    # order transactions commit in closely enough for its cursors, see
+    # reservoir/api/v1/api.py.
+    txid = models.BigIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['txid', 'id'], name='mainapp_change_feed_idx'),
+        ]
 
     @property
     def typeof_text(self):
         return CHANGES[self.typeof]
 
+# An upload accepted by the API and processed later, see
+# reservoir/api/v1/jobs.py. The uploaded file is kept in the model store,
+# under the key |spool_path|, until the job finishes.
+class UploadJob(models.Model):
+    KIND_UPLOAD = 'upload'
+    KIND_REVISE = 'revise'
+    KIND_CHOICES = [
+        (KIND_UPLOAD, 'Upload'),
+        (KIND_REVISE, 'Revise'),
+    ]
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True)
+    author = models.ForeignKey(User, models.CASCADE)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    progress = models.CharField(max_length=64, default='')
+    options = fields.JSONField(default=dict)
+    spool_path = models.CharField(max_length=1024)
+    model_id = models.IntegerField(null=True)
+    revision = models.IntegerField(null=True)
+    error = models.CharField(max_length=1024, default='')
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created'], name='mainapp_uploadjob_queue_idx'),
+        ]
+
 class Comment(models.Model):
     author = models.ForeignKey(User, models.CASCADE)
     model = models.ForeignKey(Model, models.CASCADE)
@@ -164,6 +240,23 @@ class Comment(models.Model):
     datetime = models.DateTimeField(auto_now_add=True)
     is_hidden = models.BooleanField(default=False)
 
+# Keep the cached get_info() payloads up to date. Edits, hiding and new
+# revisions all save a Model row; location and category changes are always
+# followed by one.
+@receiver(post_save, sender=Model)
+@receiver(post_delete, sender=Model)
+def invalidate_model_info(sender, instance, **kwargs):
+    info_cache.invalidate(instance.model_id)
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_model_info(sender, instance, **kwargs):
+    try:
+        info_cache.invalidate(instance.model.model_id)
+    except Model.DoesNotExist:
+        # Deleted along with the model, which invalidated it already.
+        pass
+
 class Ban(models.Model):
     # note: the models.PROTECT means that admin accounts who
     # have banned other users cannot be removed from the database.
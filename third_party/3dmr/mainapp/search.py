@@ -0,0 +1,41 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+
+# Text search configuration of LatestModel.search_vector, see migration 0007.
+# 'simple' doesn't stem, as titles and descriptions are in many languages.
+SEARCH_CONFIG = 'simple'
+
+# Text search over the latest revisions of models.
+#
+# Models match on whole words through the search_vector GIN index, or on
+# substrings through the trigram indexes on the title and description, which
+# Postgres combines with a bitmap OR instead of scanning the table. Trigram
+# indexes can't help with strings shorter than 3 characters, so search_text()
+# only matches those on whole words.
+
+def _query(text):
+    return SearchQuery(text, config=SEARCH_CONFIG)
+
+# Filters |models| to those whose title contains |text|.
+def match_title(models, text):
+    return models.filter(title__icontains=text)
+
+# Filters |models| to those whose title contains |text|, best matches first.
+def search_title(models, text):
+    return match_title(models, text) \
+        .annotate(rank=TrigramSimilarity('title', text)) \
+        .order_by('-rank', 'model_id')
+
+# Filters |models| to those whose title or description contains |text|, or
+# the words of |text|, best matches first. Title matches weigh more than
+# description matches.
+def search_text(models, text):
+    query = _query(text)
+    matches = Q(search_vector=query)
+    if len(text) >= 3:
+        matches |= Q(title__icontains=text) | Q(description__icontains=text)
+
+    return models \
+        .filter(matches) \
+        .annotate(rank=SearchRank(F('search_vector'), query) + TrigramSimilarity('title', text)) \
+        .order_by('-rank', 'model_id')
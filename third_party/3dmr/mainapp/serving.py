@@ -0,0 +1,428 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+
+from . import blobstore
+from .zipstream import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Serving of model revision zips. A revision never changes once uploaded, so
+# its zip is built once from the blob store into an on-disk cache, and served
+# from there with a strong ETag, conditional GET and byte range support. The
+# web server can be left to send the bytes, see SENDFILE.
+
+# Least recently served zips are evicted once the cache is larger than this.
+ZIP_CACHE_MAX_BYTES = int(os.environ.get('RESERVOIR_ZIP_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+
+# The same, for bundles of many revisions, see serve_bundle().
+BUNDLE_CACHE_MAX_BYTES = int(os.environ.get('RESERVOIR_BUNDLE_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Date of the members of bundles, which are rebuilt identical after eviction.
+BUNDLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Temporary files older than this are left over from crashes, and evicted.
+STALE_TMP_SECONDS = 3600
+
+# Each process walks a cache to evict from it at most this often, unless the
+# files it added since would take the cache over its limit.
+EVICT_INTERVAL_SECONDS = int(os.environ.get('RESERVOIR_EVICT_INTERVAL_SECONDS', 60))
+
+# 'x-sendfile' (Apache mod_xsendfile) or 'x-accel-redirect' (nginx) to have
+# the web server send the files, which then handles ranges itself. For
+# x-accel-redirect, SENDFILE_PREFIX is the internal location of MODEL_DIR.
+SENDFILE = os.environ.get('RESERVOIR_SENDFILE', '').lower()
+SENDFILE_PREFIX = os.environ.get('RESERVOIR_SENDFILE_PREFIX', '/protected-models/')
+
+# Changes whenever reassembled zips change, to invalidate cached copies.
+ZIP_FORMAT_VERSION = 1
+
+# For URLs naming a revision, which can be cached forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# For URLs of the latest revision, which are revalidated with the ETag.
+LATEST_CACHE_CONTROL = 'public, max-age=300'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Cache directory -> [bytes in it when last walked plus those added since,
+# time.monotonic() of that walk], see _evict_after_write().
+_cache_sizes = {}
+_cache_sizes_lock = threading.Lock()
+
+def zip_cache_dir():
+    return os.path.join(blobstore.MODEL_DIR, 'cache', 'zips')
+
+def bundle_cache_dir():
+    return os.path.join(blobstore.MODEL_DIR, 'cache', 'bundles')
+
+def _cached_zip_path(model_id, revision):
+    return os.path.join(zip_cache_dir(), str(model_id), '{}.zip'.format(revision))
+
+# Returns the strong ETag of a revision's zip. Manifests are immutable, so
+# their hash identifies the reassembled zip; legacy zips are identified by
+# their size and modification time.
+def revision_etag(model_id, revision):
+    store = blobstore.get_storage()
+    try:
+        stat = store.stat(blobstore.legacy_revision_key(model_id, revision))
+        key = 'legacy/{}/{}/{}/{}'.format(model_id, revision, stat.size, stat.mtime_ns)
+    except FileNotFoundError:
+        manifest = store.read(blobstore.manifest_key(model_id, revision))
+        key = 'manifest/{}/{}'.format(ZIP_FORMAT_VERSION, hashlib.sha256(manifest).hexdigest())
+
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+# Returns the path of a complete zip file of a revision, reassembling it into
+# the cache if needed. Legacy zips are copied to the cache too when the store
+# is not on the local disk.
+def revision_zip_path(model_id, revision):
+    legacy_path = blobstore.local_legacy_revision_path(model_id, revision)
+    if legacy_path is not None:
+        return legacy_path
+
+    path = _cached_zip_path(model_id, revision)
+    try:
+        # The modification time orders the cache entries for eviction.
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in blobstore.revision_chunks(model_id, revision):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    _evict_after_write(zip_cache_dir(), ZIP_CACHE_MAX_BYTES, os.path.getsize(path))
+    return path
+
+# Deletes the least recently served files of |cache_dir| until it fits in
+# |max_bytes|. Files being written are left alone.
+def _evict(cache_dir, max_bytes):
+    walked = time.monotonic()
+    entries = []
+    total = 0
+    now = time.time()
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.startswith('.tmp-') and now - stat.st_mtime < STALE_TMP_SECONDS:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+    with _cache_sizes_lock:
+        _cache_sizes[cache_dir] = [total, walked]
+
+# Evicts from |cache_dir| after |added| bytes were written to it. Walking the
+# cache costs a stat() per file, so this is only done every
+# EVICT_INTERVAL_SECONDS, or sooner once the running total of the cache size
+# goes over |max_bytes|. Files added by other processes are only counted by
+# the walks.
+def _evict_after_write(cache_dir, max_bytes, added):
+    with _cache_sizes_lock:
+        size = _cache_sizes.get(cache_dir)
+        if size is not None:
+            size[0] += added
+            if size[0] <= max_bytes and time.monotonic() - size[1] < EVICT_INTERVAL_SECONDS:
+                return
+
+    _evict(cache_dir, max_bytes)
+
+# Deletes the least recently served zips until the cache fits in
+# ZIP_CACHE_MAX_BYTES. They are rebuilt from the blob store when next needed.
+def evict_zips(max_bytes=None):
+    _evict(zip_cache_dir(), ZIP_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+
+# Deletes the least recently served bundles until the cache fits in
+# BUNDLE_CACHE_MAX_BYTES.
+def evict_bundles(max_bytes=None):
+    _evict(bundle_cache_dir(), BUNDLE_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+
+def delete_cached_zips(model_id):
+    shutil.rmtree(os.path.join(zip_cache_dir(), str(model_id)), ignore_errors=True)
+
+# Parses a single byte range header against a file of |size| bytes. Returns
+# (start, end) with an inclusive end, None for no or unsupported ranges, and
+# raises ValueError for unsatisfiable ranges.
+def parse_range(header, size):
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.group(0) == 'bytes=-':
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # The last |last| bytes.
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range: {}'.format(header))
+
+    return start, end
+
+def _file_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def _sendfile_response(path):
+    if SENDFILE == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = path
+        return response
+
+    if SENDFILE == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, blobstore.MODEL_DIR)
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = SENDFILE_PREFIX.rstrip('/') + '/' + relative_path
+        return response
+
+    return None
+
+# Serves a file that never changes under |etag|: answers conditional
+# requests with 304 and byte range requests with 206, or hands the file to
+# the web server when SENDFILE is set.
+def serve_immutable_file(request, path, etag, filename, content_type='application/zip',
+                         cache_control=IMMUTABLE_CACHE_CONTROL):
+    etag = quote_etag(etag)
+
+    # There is no Last-Modified: cached zips are touched whenever they are
+    # served, and the ETag is enough to revalidate.
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = _sendfile_response(path) or _range_response(request, path, etag)
+
+    if response.status_code in (200, 206):
+        response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+        response['Content-Type'] = content_type
+
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+def _range_response(request, path, etag):
+    size = os.path.getsize(path)
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    # A range is only valid for the representation named by If-Range.
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+
+        if byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(_file_range(path, start, end), status=206)
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+            response['Content-Length'] = end - start + 1
+            response['Accept-Ranges'] = 'bytes'
+            return response
+
+    response = FileResponse(open(path, 'rb'))
+    response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+# Serves the zip of a model revision, see serve_immutable_file().
+def serve_revision(request, model_id, revision, filename, cache_control=IMMUTABLE_CACHE_CONTROL):
+    etag = revision_etag(model_id, revision)
+
+    # Don't build the zip only to answer "not modified".
+    conditional = get_conditional_response(request, etag=quote_etag(etag))
+    if conditional is not None:
+        conditional['ETag'] = quote_etag(etag)
+        conditional['Cache-Control'] = cache_control
+        return conditional
+
+    path = revision_zip_path(model_id, revision)
+    return serve_immutable_file(request, path, etag, filename, cache_control=cache_control)
+
+# Returns the strong ETag of a bundle of revisions, identified by the
+# (model_id, revision) pairs |members| and the bytes |extra| the bundle adds,
+# such as its metadata. A new revision of any member, or new metadata, gives
+# a new ETag, so cached bundles never need to be invalidated: those no longer
+# requested are evicted as they age.
+def bundle_etag(members, extra=b''):
+    digest = hashlib.sha256('bundle/{}\n'.format(ZIP_FORMAT_VERSION).encode())
+    for model_id, revision in sorted(members):
+        digest.update('{}/{}\n'.format(model_id, revision).encode())
+    digest.update(extra)
+    return digest.hexdigest()[:32]
+
+def _cached_bundle_path(etag):
+    return os.path.join(bundle_cache_dir(), etag[:2], '{}.zip'.format(etag))
+
+# Returns whether the If-None-Match header of |request| names |etag|.
+def _none_match(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+
+    etags = [value[2:] if value.startswith('W/') else value for value in parse_etags(header)]
+    return '*' in etags or quote_etag(etag) in etags
+
+# Yields |chunks| while writing them to |path|, where they are moved once
+# complete. Chunks are still yielded if the cache can't be written.
+def _write_through(path, chunks):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    except OSError:
+        logger.warning('Failed to cache {}.'.format(path), exc_info=True)
+        yield from chunks
+        return
+
+    complete = False
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+                yield chunk
+        os.replace(tmp_path, path)
+        complete = True
+    finally:
+        # Also when the client went away before the end.
+        if not complete:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    _evict_after_write(bundle_cache_dir(), BUNDLE_CACHE_MAX_BYTES, size)
+
+# Serves a bundle of revisions under |etag|, see bundle_etag(). |build| is
+# called for the bytes of the bundle the first time it is requested, which
+# are streamed to the client as they are written to the cache. Later
+# requests are served from the cached file, with serve_immutable_file().
+#
+# Bundles are requested with POST, the list of building ids being too long for
+# a URL, but the request is a query, so If-None-Match is answered with 304 as
+# it would be for GET.
+def serve_bundle(request, etag, build, filename, cache_control=LATEST_CACHE_CONTROL, cache=True):
+    if _none_match(request, etag):
+        response = HttpResponse(status=304)
+        response['ETag'] = quote_etag(etag)
+        response['Cache-Control'] = cache_control
+        return response
+
+    path = _cached_bundle_path(etag)
+    if cache:
+        try:
+            # The modification time orders the cache entries for eviction.
+            os.utime(path)
+            return serve_immutable_file(request, path, etag, filename, cache_control=cache_control)
+        except FileNotFoundError:
+            pass
+
+    chunks = _write_through(path, build()) if cache else build()
+    response = StreamingHttpResponse(chunks, content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    response['ETag'] = quote_etag(etag)
+    response['Cache-Control'] = cache_control
+    return response
+
+# Returns whether the Accept-Encoding header of |request| accepts gzip. A
+# q-value of 0 refuses it, and '*' covers it when it isn't named.
+def accepts_gzip(request):
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, *params = [value.strip().lower() for value in coding.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+# Serves a blob, see blobstore.put_blob(). Blobs are gzipped, so clients that
+# accept gzip get the blob file itself. The two encodings are different bytes,
+# so they get different strong ETags.
+def serve_blob(request, digest, size, filename, content_type, cache_control=IMMUTABLE_CACHE_CONTROL):
+    gzipped = accepts_gzip(request)
+    etag = quote_etag(digest[:32] + ('-gz' if gzipped else ''))
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if gzipped:
+            response = FileResponse(blobstore.get_storage().open(blobstore.blob_key(digest)))
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = FileResponse(blobstore.open_blob(digest))
+            response['Content-Length'] = size
+
+        response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+        response['Content-Type'] = content_type
+
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response['Cache-Control'] = cache_control
+    return response
+
+# Serves a single file of a model revision. Files in the blob store are served
+# with serve_blob(); files of legacy zips are read from their offset in the
+# zip, see blobstore.MemberFile.
+def serve_member(request, model_id, revision, name, cache_control=IMMUTABLE_CACHE_CONTROL):
+    member = blobstore.get_member(model_id, revision, name)
+    if 'sha256' in member:
+        return serve_blob(request, member['sha256'], member['size'], name, 'application/zip', cache_control)
+
+    response = FileResponse(blobstore.open_member(model_id, revision, name))
+    response['Content-Length'] = member['size']
+    response['Content-Disposition'] = 'attachment; filename={}'.format(name)
+    response['Content-Type'] = 'application/zip'
+    response['Cache-Control'] = cache_control
+    return response
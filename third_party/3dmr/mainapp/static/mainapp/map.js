@@ -1,71 +1,92 @@
 var map;
 
-function rangeSearch(latitude, longitude, range, callback, page) {
+// Layers of the tiles on display, by "z/x/y".
+var tileLayers = {};
+
+function getTile(z, x, y, callback) {
 	var xhr = new XMLHttpRequest();
 	xhr.addEventListener("load", function() {
-		callback(JSON.parse(xhr.responseText));
+		if(xhr.status == 200)
+			callback(JSON.parse(xhr.responseText));
 	});
 
-	xhr.open("POST", "/api/search/full");
+	xhr.open("GET", "/api/tiles/" + z + "/" + x + "/" + y);
+	xhr.send();
+}
 
-	var requestBody = 
-		'{' +
-		'"lat":' + latitude + ',' +
-		'"lon":' + longitude + ',' +
-		'"range":' + range + ',' +
-		'"page":' + page + ',' +
-		'"format": ["id", "title", "latitude", "longitude"]' +
-		'}';
+function addPin(layer, model) {
+	var latitude = model[1];
+	var longitude = model[2];
 
-	xhr.send(requestBody);
+	L.marker([latitude, longitude])
+		.bindPopup('<a href="/model/' + model[0] + '">' + model[3] + '</a>')
+		.addTo(layer);
 }
 
-var model_ids = new Set();
-var page = 1;
-function queryModels(response) {
-	if(typeof response !== 'undefined') {
-		if(response.length == 0)
-			return;
-		else for(var i in response) {
-			var model = response[i];
-			var model_id = model[0];
-
-			if(model_ids.has(model_id))
-				continue;
-
-			var title = model[1];
-			var latitude = model[2];
-			var longitude = model[3];
-
-			addPin({
-				id: model_id,
-				title: title,
-				lat: latitude,
-				lon: longitude
-			});
-		}
-	}
+function addCluster(layer, cluster) {
+	var latitude = cluster[0];
+	var longitude = cluster[1];
+	var count = cluster[2];
+
+	var size = count < 10 ? 30 : count < 100 ? 36 : 44;
+	L.marker([latitude, longitude], {
+		icon: L.divIcon({
+			html: '<span>' + count + '</span>',
+			className: 'map-cluster',
+			iconSize: [size, size]
+		})
+	}).on("click", function() {
+		map.setView([latitude, longitude], map.getZoom() + 2);
+	}).addTo(layer);
+}
 
-	var center = map.getCenter();
+function loadTile(z, x, y) {
+	var key = z + "/" + x + "/" + y;
+	if(key in tileLayers)
+		return;
 
-	var bounds = map.getBounds();
-	var corner = bounds.getNorthEast();
+	var layer = L.layerGroup().addTo(map);
+	tileLayers[key] = layer;
+
+	getTile(z, x, y, function(tile) {
+		if(tileLayers[key] !== layer)
+			return;
 
-	var distance = map.distance(center, corner);
+		for(var i in tile.models)
+			addPin(layer, tile.models[i]);
 
-	rangeSearch(center.lat, center.lng, distance, queryModels, page);
-	page++;
+		for(var i in tile.clusters)
+			addCluster(layer, tile.clusters[i]);
+	});
 }
 
-function addPin(model) {
-	var latitude = model["lat"];
-	var longitude = model["lon"];
+// Loads the tiles in view at the current zoom level, and removes the others.
+function queryModels() {
+	var z = map.getZoom();
+	var tiles = 1 << z;
+	var bounds = map.getPixelBounds();
 
-	L.marker([latitude, longitude])
-		.bindPopup('<a href="/model/' + model["id"] + '">' + model["title"] + '</a>')
-		.addTo(map);
+	var min = bounds.min.divideBy(256).floor();
+	var max = bounds.max.divideBy(256).floor();
+
+	var visible = {};
+	for(var y = Math.max(min.y, 0); y <= Math.min(max.y, tiles - 1); y++) {
+		for(var x = min.x; x <= max.x; x++) {
+			// Wrap around the antimeridian.
+			var wrappedX = ((x % tiles) + tiles) % tiles;
+			var key = z + "/" + wrappedX + "/" + y;
 
-	model_ids.add(model["id"]);
+			visible[key] = true;
+			loadTile(z, wrappedX, y);
+		}
+	}
+
+	for(var key in tileLayers) {
+		if(!(key in visible)) {
+			map.removeLayer(tileLayers[key]);
+			delete tileLayers[key];
+		}
+	}
 }
 
 function initMap(id, latitude, longitude, width, height) {
@@ -89,9 +110,7 @@ function initMap(id, latitude, longitude, width, height) {
 	}).addTo(map);
 
 	map.on("moveend", function() {
-		page = 1;
 		queryModels();
-
 	});
 
 	queryModels();
@@ -0,0 +1,322 @@
+import functools
+import io
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+# Backends the model store can be kept in, see blobstore. Files are named by
+# keys, '/' separated paths such as 'blobs/ab/cd/abcd...ef'.
+#
+# RESERVOIR_STORAGE=filesystem, the default, keeps them under MODEL_DIR.
+# RESERVOIR_STORAGE=s3 keeps them in RESERVOIR_S3_BUCKET, under
+# RESERVOIR_S3_PREFIX, so that several nodes can share the store. Any
+# S3-compatible server, e.g. a local MinIO, can be named with
+# RESERVOIR_S3_ENDPOINT_URL. boto3 is only needed by this backend, and finds
+# its credentials as usual, e.g. in AWS_ACCESS_KEY_ID and
+# AWS_SECRET_ACCESS_KEY.
+#
+# Either way the caches of reassembled zips stay in MODEL_DIR, on the local
+# disk of each node.
+BACKEND = os.environ.get('RESERVOIR_STORAGE', 'filesystem').lower()
+S3_BUCKET = os.environ.get('RESERVOIR_S3_BUCKET', 'reservoir')
+S3_PREFIX = os.environ.get('RESERVOIR_S3_PREFIX', '')
+S3_ENDPOINT_URL = os.environ.get('RESERVOIR_S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('RESERVOIR_S3_REGION') or None
+
+# Keys deleted per DeleteObjects request, the most S3 allows.
+S3_DELETE_BATCH = 1000
+
+# The size of a file and its modification time, in nanoseconds.
+Stat = namedtuple('Stat', ['size', 'mtime_ns'])
+
+class FileSystemStorage:
+    def __init__(self, root):
+        self.root = root
+
+    # Storages of the same directory are interchangeable, e.g. as cache keys.
+    def __eq__(self, other):
+        return isinstance(other, FileSystemStorage) and other.root == self.root
+
+    def __hash__(self):
+        return hash(self.root)
+
+    # Returns the local path of |key|. Backends without one return None.
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def stat(self, key):
+        stat = os.stat(self.path(key))
+        return Stat(stat.st_size, stat.st_mtime_ns)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def read(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    # Writes |data| to |key| atomically, so readers never see partial files.
+    def write(self, key, data):
+        self.write_file(key, io.BytesIO(data))
+
+    # With |sync|, the file is flushed to disk before this returns, so a
+    # crash can't lose it.
+    def write_file(self, key, fileobj, sync=False):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        if sync:
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    # Returns a directory for temporary files that put_file() can move into
+    # the store.
+    def temp_dir(self):
+        path = os.path.join(self.root, 'tmp')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # Moves the local file |path| to |key|.
+    def put_file(self, key, path):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    # Sets the modification time of |key| to now.
+    def touch(self, key):
+        os.utime(self.path(key))
+
+    # Renames |key| to |target|.
+    def move(self, key, target):
+        path = self.path(target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path(key), path)
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    # Deletes every key under |prefix|, and returns whether there were any.
+    def delete_prefix(self, prefix):
+        path = self.path(prefix)
+        if not os.path.isdir(path):
+            return False
+        shutil.rmtree(path)
+        return True
+
+    # Yields (key, stat) for every key under |prefix|, leaving out files
+    # being written.
+    def list(self, prefix):
+        for root, _, files in os.walk(self.path(prefix)):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                yield key, Stat(stat.st_size, stat.st_mtime_ns)
+
+def _not_found(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+# Reads an S3 object from any offset. Sequential reads share a single ranged
+# GET, which is only restarted when the file is seeked elsewhere, e.g. to the
+# central directory of a zip.
+class S3File(io.RawIOBase):
+    def __init__(self, storage, key, size):
+        self._storage = storage
+        self._key = key
+        self._size = size
+        self._position = 0
+        self._body = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+
+        if offset != self._position:
+            self._close_body()
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self._position >= self._size:
+            return 0
+
+        if self._body is None:
+            self._body = self._storage.get_object(self._key, 'bytes={}-'.format(self._position))['Body']
+
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+class S3Storage:
+    def __init__(self, bucket, prefix='', client=None, **client_options):
+        if client is None:
+            # Only needed with this backend.
+            import boto3
+            client = boto3.client('s3', **client_options)
+
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _name(self, key):
+        return self.prefix + key
+
+    def path(self, key):
+        return None
+
+    def exists(self, key):
+        try:
+            self.stat(key)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stat(self, key):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self._name(key))
+        except Exception as e:
+            if _not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+        return Stat(head['ContentLength'], int(head['LastModified'].timestamp() * 1e9))
+
+    def get_object(self, key, byte_range=None):
+        options = {'Range': byte_range} if byte_range else {}
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._name(key), **options)
+        except Exception as e:
+            if _not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def open(self, key):
+        return io.BufferedReader(S3File(self, key, self.stat(key).size))
+
+    def read(self, key):
+        body = self.get_object(key)['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    # Objects are replaced atomically by S3 itself.
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._name(key), Body=data)
+
+    # Objects are durable once uploaded, whether or not |sync| is set.
+    def write_file(self, key, fileobj, sync=False):
+        self.client.upload_fileobj(fileobj, self.bucket, self._name(key))
+
+    def temp_dir(self):
+        return None
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as f:
+            self.write_file(key, f)
+        os.unlink(path)
+
+    # Objects can't be modified, so this copies |key| onto itself, which
+    # S3 only allows when replacing its metadata.
+    def touch(self, key):
+        name = self._name(key)
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket, Key=name, CopySource={'Bucket': self.bucket, 'Key': name},
+                MetadataDirective='REPLACE')
+        except Exception as e:
+            if _not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    # Objects can't be renamed, so this copies |key| to |target| and deletes
+    # it.
+    def move(self, key, target):
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket, Key=self._name(target),
+                CopySource={'Bucket': self.bucket, 'Key': self._name(key)})
+        except Exception as e:
+            if _not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+        self.delete(key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._name(key))
+
+    def delete_prefix(self, prefix):
+        keys = [key for key, _ in self.list(prefix)]
+        for start in range(0, len(keys), S3_DELETE_BATCH):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self._name(key)} for key in keys[start:start + S3_DELETE_BATCH]],
+                'Quiet': True,
+            })
+        return bool(keys)
+
+    def list(self, prefix):
+        options = {'Bucket': self.bucket, 'Prefix': self._name(prefix + '/' if prefix else '')}
+        while True:
+            page = self.client.list_objects_v2(**options)
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], Stat(
+                    item['Size'], int(item['LastModified'].timestamp() * 1e9))
+
+            if not page.get('IsTruncated'):
+                return
+            options['ContinuationToken'] = page['NextContinuationToken']
+
+# The S3 backend configured by the RESERVOIR_S3_* settings. Clients are thread
+# safe, so the process shares one.
+@functools.lru_cache(maxsize=None)
+def s3_storage():
+    return S3Storage(
+        S3_BUCKET, S3_PREFIX, endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
@@ -1,3 +1,755 @@
-from django.test import TestCase
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import Http404
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+
+from . import api
+from . import blobstore
+from . import derivatives
+from . import geo
+from . import info_cache
+from . import search
+from . import serving
+from . import storage
+from .models import Comment, Model, LatestModel, Location
+
+# The definition of the latest revisions that LatestModel must match.
+LATEST_REVISIONS_SQL = """
+    SELECT model.id
+    FROM mainapp_model model
+        LEFT JOIN mainapp_model newer
+            ON model.model_id = newer.model_id AND
+               model.revision < newer.revision
+    WHERE newer.revision IS NULL
+"""
+
+class LatestModelTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+
+    def create_model(self, model_id, revision, **kwargs):
+        return Model.objects.create(
+            author=self.author,
+            model_id=model_id,
+            revision=revision,
+            title='Model {}'.format(model_id),
+            description='',
+            rendered_description='',
+            license=0,
+            **kwargs)
+
+    def assertLatestRevisions(self):
+        with connection.cursor() as cursor:
+            cursor.execute(LATEST_REVISIONS_SQL)
+            expected = sorted(row[0] for row in cursor.fetchall())
+
+        self.assertEqual(sorted(LatestModel.objects.values_list('id', flat=True)), expected)
+
+    def test_tracks_inserts_updates_and_deletes(self):
+        self.create_model(1, 1)
+        second = self.create_model(1, 2)
+        self.create_model(2, 1)
+        self.assertLatestRevisions()
+        self.assertEqual(LatestModel.objects.get(model_id=1).revision, 2)
+
+        second.title = 'Renamed'
+        second.save()
+        self.assertEqual(LatestModel.objects.get(model_id=1).title, 'Renamed')
+
+        second.delete()
+        self.assertLatestRevisions()
+        self.assertEqual(LatestModel.objects.get(model_id=1).revision, 1)
+
+        Model.objects.filter(model_id=1).delete()
+        self.assertLatestRevisions()
+        self.assertFalse(LatestModel.objects.filter(model_id=1).exists())
+
+    def test_bulk_updates(self):
+        with LatestModel.bulk_updates():
+            Model.objects.bulk_create(
+                Model(author=self.author, model_id=model_id, revision=revision,
+                      title='', description='', rendered_description='', license=0)
+                for model_id in range(1, 51) for revision in range(1, 4))
+
+        self.assertLatestRevisions()
+        self.assertEqual(LatestModel.objects.count(), 50)
+
+    def test_one_row_per_model(self):
+        self.create_model(1, 1)
+        self.create_model(1, 2)
+        duplicate = self.create_model(1, 2)
+        self.assertEqual(list(LatestModel.objects.values_list('id', flat=True)), [duplicate.id])
+
+        # A second row for a model_id is refused rather than duplicating results.
+        columns = ('model_id, building_id, revision, title, description, rendered_description, upload_date, '
+                   'location_id, license, rotation, scale, translation_x, translation_y, translation_z, '
+                   'author_id, tags, is_hidden')
+        with self.assertRaises(IntegrityError), transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('INSERT INTO mainapp_latestmodel (id, {0}) SELECT id + 1000, {0} '
+                           'FROM mainapp_latestmodel WHERE model_id = 1'.format(columns))
+
+class GeoSearchTest(TestCase):
+    def setUp(self):
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+        generator = random.Random(42)
+
+        # Clustered around a city, and around the antimeridian.
+        self.points = {}
+        for model_id in range(1, 201):
+            if model_id % 2:
+                latitude, longitude = 48.85 + generator.uniform(-0.5, 0.5), 2.35 + generator.uniform(-0.5, 0.5)
+            else:
+                latitude, longitude = generator.uniform(-1, 1), (180 + generator.uniform(-1, 1) + 180) % 360 - 180
+
+            location = Location(latitude=latitude, longitude=longitude)
+            location.save()
+            Model.objects.create(
+                author=author, model_id=model_id, revision=1, title='', description='',
+                rendered_description='', license=0, location=location)
+            self.points[model_id] = (latitude, longitude)
+
+    def distances(self, latitude, longitude):
+        return sorted(
+            (geo.haversine(latitude, longitude, *point), model_id)
+            for model_id, point in self.points.items())
+
+    def test_within(self):
+        for latitude, longitude, distance in ((48.85, 2.35, 10000), (0, 180, 50000), (0, -179.9, 80000)):
+            expected = [model_id for d, model_id in self.distances(latitude, longitude) if d <= distance]
+            models = geo.within(LatestModel.objects.all(), latitude, longitude, distance) \
+                .order_by('distance', 'model_id')
+
+            self.assertEqual([model.model_id for model in models], expected)
+
+    def test_nearest(self):
+        for latitude, longitude in ((48.85, 2.35), (0, 179.95), (-45, 90)):
+            expected = [model_id for _, model_id in self.distances(latitude, longitude)[:10]]
+            models = geo.nearest(LatestModel.objects.all(), latitude, longitude, 10)
+
+            self.assertEqual([model.model_id for model in models], expected)
+
+class TileTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+
+        # Three models within a few hundred meters of each other.
+        self.models = []
+        for model_id, (latitude, longitude) in enumerate(((51.500, -0.120), (51.501, -0.121), (51.502, -0.119)), 1):
+            location = Location(latitude=latitude, longitude=longitude)
+            location.save()
+            self.models.append(Model.objects.create(
+                author=self.author, model_id=model_id, revision=1, title='Model {}'.format(model_id),
+                description='', rendered_description='', license=0, location=location))
+
+    def tile(self, zoom, etag=None):
+        tiles = 1 << zoom
+        x = int((-0.12 + 180) / 360 * tiles)
+        y = int((1 - math.asinh(math.tan(math.radians(51.501))) / math.pi) / 2 * tiles)
+
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        request = self.factory.get('/api/tiles/{}/{}/{}'.format(zoom, x, y), **headers)
+        return api.get_tile(request, str(zoom), str(x), str(y))
+
+    def test_models_and_clusters(self):
+        tile = json.loads(self.tile(14).content)
+        self.assertEqual([model[0] for model in tile['models']], [1, 2, 3])
+        self.assertEqual(tile['clusters'], [])
+
+        tile = json.loads(self.tile(5).content)
+        self.assertEqual(tile['models'], [])
+        self.assertEqual(len(tile['clusters']), 1)
+        self.assertEqual(tile['clusters'][0][2], 3)
+
+    def test_etag(self):
+        etag = self.tile(10)['ETag']
+        self.assertEqual(self.tile(10, etag).status_code, 304)
+
+        self.models[0].title = 'Renamed'
+        self.models[0].save()
+        self.assertEqual(self.tile(10, etag).status_code, 200)
+        etag = self.tile(10)['ETag']
+
+        self.models[1].is_hidden = True
+        self.models[1].save()
+        self.assertEqual(self.tile(10, etag).status_code, 200)
+
+class PaginationTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+
+        with LatestModel.bulk_updates():
+            Model.objects.bulk_create(
+                Model(author=author, model_id=model_id, revision=1, title='', description='',
+                      rendered_description='', license=0, tags={'building': 'yes'})
+                for model_id in range(45, 0, -1))
+
+    def lookup(self, page_id=1, **params):
+        request = self.factory.get('/api/tag/building=yes', params)
+        return json.loads(api.lookup_tag(request, 'building=yes', page_id).content)
+
+    def test_page_numbers(self):
+        self.assertEqual(self.lookup(1), list(range(1, 21)))
+        self.assertEqual(self.lookup(3), list(range(41, 46)))
+        self.assertEqual(self.lookup(4), [])
+        self.assertEqual(self.lookup(1, limit=50), list(range(1, 46)))
+
+    def test_cursors(self):
+        results = []
+        page = self.lookup(cursor='', limit=20)
+        while True:
+            results += page['results']
+            if page['next'] is None:
+                break
+            page = self.lookup(cursor=page['next'], limit=20)
+
+        self.assertEqual(results, list(range(1, 46)))
+
+    def test_invalid_cursor(self):
+        request = self.factory.get('/api/tag/building=yes', {'cursor': 'nonsense'})
+        self.assertEqual(api.lookup_tag(request, 'building=yes').status_code, 400)
+
+class SearchTest(TestCase):
+    def setUp(self):
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+
+        for model_id, title, description in (
+                (1, 'Old town hall', 'A hall with a clock tower.'),
+                (2, 'Clock tower', 'Built in 1890.'),
+                (3, 'Bell tower', 'Next to the town hall.'),
+                (4, 'Warehouse', 'Brick warehouse by the harbour.')):
+            Model.objects.create(
+                author=author, model_id=model_id, revision=1, title=title, description=description,
+                rendered_description='', license=0)
+
+        # Only the latest revision is searched.
+        Model.objects.create(
+            author=author, model_id=4, revision=2, title='Harbour office', description='',
+            rendered_description='', license=0)
+
+    def search(self, text):
+        return [model.model_id for model in search.search_text(LatestModel.objects.all(), text)]
+
+    def test_search_text(self):
+        # Title matches rank above description matches.
+        self.assertEqual(self.search('clock'), [2, 1])
+        self.assertEqual(self.search('town hall'), [1, 3])
+        self.assertEqual(self.search('harb'), [4])
+        self.assertEqual(self.search('warehouse'), [])
+
+    def test_search_title(self):
+        models = search.search_title(LatestModel.objects.all(), 'tower')
+        self.assertEqual([model.model_id for model in models], [3, 2])
+
+    def test_search_view(self):
+        response = self.client.get(reverse('search'), {'query': 'clock'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([model.model_id for model in response.context['models']], [2, 1])
+
+class ServingTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.model_dir = tempfile.mkdtemp()
+
+        patcher = mock.patch.object(blobstore, 'MODEL_DIR', self.model_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.model_dir, True)
+
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+        Model.objects.create(
+            author=author, model_id=1, revision=1, title='Model', description='',
+            rendered_description='', license=0)
+
+        model_file = io.BytesIO()
+        with zipfile.ZipFile(model_file, 'w') as zip_file:
+            zip_file.writestr('model.obj', 'v 0 0 0\n' * 1000)
+        blobstore.store_revision(1, 1, model_file)
+
+        self.content = b''.join(blobstore.revision_chunks(1, 1))
+
+    def get(self, revision=1, **headers):
+        request = self.factory.get('/api/model/1/{}'.format(revision), **headers)
+        response = api.get_model(request, 1, revision)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_etag(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response, body = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"')[0].status_code, 200)
+
+    def test_ranges(self):
+        etag = self.get()[0]['ETag']
+        size = len(self.content)
+
+        response, body = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/{}'.format(size))
+        self.assertEqual(body, self.content[10:20])
+
+        response, body = self.get(HTTP_RANGE='bytes=-5', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[-5:])
+
+        response, body = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(body, self.content[100:])
+
+        # A stale If-Range gets the whole file.
+        response, body = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+        response, body = self.get(HTTP_RANGE='bytes={}-'.format(size))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */{}'.format(size))
+
+    def test_sendfile(self):
+        with mock.patch.object(serving, 'SENDFILE', 'x-accel-redirect'):
+            response, body = self.get()
+
+        self.assertEqual(body, b'')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-models/cache/zips/1/1.zip')
+
+    def test_evict_zips(self):
+        path = serving.revision_zip_path(1, 1)
+        serving.evict_zips(max_bytes=len(self.content))
+        self.assertTrue(os.path.isfile(path))
+
+        serving.evict_zips(max_bytes=0)
+        self.assertFalse(os.path.isfile(path))
+
+        # The zip is rebuilt when next served.
+        self.assertEqual(self.get()[1], self.content)
+
+    def test_evict_after_write(self):
+        walk = mock.Mock(wraps=os.walk)
+        with mock.patch.object(serving.os, 'walk', walk):
+            serving.revision_zip_path(1, 1)
+            self.assertEqual(walk.call_count, 1)
+
+            # Misses are only counted until the cache is walked again.
+            serving.delete_cached_zips(1)
+            serving.revision_zip_path(1, 1)
+            self.assertEqual(walk.call_count, 1)
+
+            # Unless they take the cache over its limit.
+            serving.delete_cached_zips(1)
+            with mock.patch.object(serving, 'ZIP_CACHE_MAX_BYTES', len(self.content)):
+                serving.revision_zip_path(1, 1)
+            self.assertEqual(walk.call_count, 2)
+
+            # Or the interval is up.
+            serving.delete_cached_zips(1)
+            with mock.patch.object(serving, 'EVICT_INTERVAL_SECONDS', 0):
+                serving.revision_zip_path(1, 1)
+            self.assertEqual(walk.call_count, 3)
+
+    def get_file(self, revision, name, **headers):
+        request = self.factory.get('/api/model/1/{}/{}'.format(revision, name), **headers)
+        response = api.get_file(request, name, 1, revision)
+        return response, b''.join(response.streaming_content)
+
+    def test_get_file(self):
+        obj = b'v 0 0 0\n' * 1000
+
+        response, body = self.get_file(1, 'model.obj', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), obj)
+        gzip_etag = response['ETag']
+
+        response, body = self.get_file(1, 'model.obj')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(body, obj)
+        self.assertNotEqual(response['ETag'], gzip_etag)
+
+        response, _ = self.get_file(1, 'model.obj', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # The ETag of the gzipped body doesn't validate the identity one.
+        response, _ = self.get_file(1, 'model.obj', HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_accepts_gzip(self):
+        for header, accepted in [
+                ('', False),
+                ('gzip', True),
+                ('deflate, gzip;q=0.5', True),
+                ('gzip;q=0', False),
+                ('gzip; q=0.0, deflate', False),
+                ('*', True),
+                ('*;q=0', False),
+                ('gzip;q=0, *', False),
+                ('identity, *;q=0.1', True),
+                ('x-gzip', True)]:
+            request = self.factory.get('/', HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(serving.accepts_gzip(request), accepted, header)
+
+    def test_get_legacy_file(self):
+        Model.objects.create(
+            author=User.objects.get(), model_id=1, revision=2, title='Model', description='',
+            rendered_description='', license=0)
+
+        texture = bytes(range(256)) * 100
+        store = blobstore.get_storage()
+        with zipfile.ZipFile(store.path(blobstore.legacy_revision_key(1, 2)), 'w') as zip_file:
+            zip_file.writestr('model.obj', 'v 1 1 1\n' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+            zip_file.writestr('texture.png', texture, compress_type=zipfile.ZIP_STORED)
+
+        self.assertEqual(blobstore.get_namelist(1, 2), ['model.obj', 'texture.png'])
+        self.assertTrue(store.exists(blobstore.legacy_index_key(1, 2)))
+
+        self.assertEqual(self.get_file(2, 'model.obj')[1], b'v 1 1 1\n' * 1000)
+        self.assertEqual(self.get_file(2, 'texture.png', HTTP_ACCEPT_ENCODING='gzip')[1], texture)
+
+        with self.assertRaises(Http404):
+            self.get_file(2, 'missing.png')
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class InfoCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.model = Model.objects.create(
+            author=self.author, model_id=1, revision=1, title='Model', description='',
+            rendered_description='', license=0)
+
+        # Test cases never commit, so run the invalidations right away.
+        patcher = mock.patch.object(info_cache.transaction, 'on_commit', lambda function: function())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_info(self):
+        request = self.factory.get('/api/info/1')
+        request.user = AnonymousUser()
+        return json.loads(api.get_info(request, 1).content)
+
+    def test_cached(self):
+        self.assertEqual(self.get_info()['title'], 'Model')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_info()['title'], 'Model')
+
+    def test_invalidation(self):
+        self.get_info()
+
+        self.model.title = 'Renamed'
+        self.model.save()
+        self.assertEqual(self.get_info()['title'], 'Renamed')
+
+        Model.objects.create(
+            author=self.author, model_id=1, revision=2, title='Second', description='',
+            rendered_description='', license=0)
+        self.assertEqual(self.get_info()['revision'], 2)
+
+        comment = Comment.objects.create(
+            author=self.author, model=self.model, comment='Nice', rendered_comment='<p>Nice</p>')
+        self.assertEqual([c[1] for c in self.get_info()['comments']], ['Nice'])
+
+        comment.is_hidden = True
+        comment.save()
+        self.assertEqual(self.get_info()['comments'], [])
+
+        Model.objects.filter(model_id=1, revision=2).get().delete()
+        self.assertEqual(self.get_info()['revision'], 1)
+
+class DerivativesTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.model_dir = tempfile.mkdtemp()
+
+        patcher = mock.patch.object(blobstore, 'MODEL_DIR', self.model_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.model_dir, True)
+
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+        Model.objects.create(
+            author=author, model_id=1, revision=1, title='Model', description='',
+            rendered_description='', license=0)
+
+        # A finely divided 1x1 square, so it can be simplified.
+        size = 40
+        lines = ['mtllib model.mtl', 'usemtl wall']
+        lines += ['v {} {} 0'.format(x / size, y / size) for y in range(size + 1) for x in range(size + 1)]
+        for y in range(size):
+            for x in range(size):
+                first = y * (size + 1) + x + 1
+                lines.append('f {} {} {} {}'.format(first, first + 1, first + size + 2, first + size + 1))
+
+        model_file = io.BytesIO()
+        with zipfile.ZipFile(model_file, 'w') as zip_file:
+            zip_file.writestr('model.obj', '\n'.join(lines))
+            zip_file.writestr('model.mtl', 'newmtl wall\nKd 1 0 0\n')
+        blobstore.store_revision(1, 1, model_file)
+
+    def get_glb(self, *args):
+        request = self.factory.get('/api/model/1/1/glb')
+        response = api.get_glb(request, 1, 1, *args)
+        return b''.join(response.streaming_content)
+
+    def test_build(self):
+        lods = derivatives.build(1, 1)
+        self.assertEqual(lods[0]['triangles'], 2 * 40 * 40)
+        self.assertGreater(len(lods), 1)
+        for previous, lod in zip(lods, lods[1:]):
+            self.assertLess(lod['triangles'], previous['triangles'])
+
+        glb = self.get_glb()
+        magic, version, length = struct.unpack('<4sII', glb[:12])
+        self.assertEqual((magic, version, length), (b'glTF', 2, len(glb)))
+
+        json_length, _ = struct.unpack('<II', glb[12:20])
+        gltf = json.loads(glb[20:20 + json_length].decode())
+        self.assertEqual(gltf['materials'][0]['pbrMetallicRoughness']['baseColorFactor'], [1, 0, 0, 1])
+        self.assertEqual(gltf['accessors'][0]['min'], [0, 0, 0])
+        self.assertEqual(gltf['accessors'][0]['max'], [1, 1, 0])
+
+        self.assertNotEqual(self.get_glb(len(lods) - 1), glb)
+        with self.assertRaises(Http404):
+            self.get_glb(len(lods))
+
+        # The GLB files are referenced, and so kept by the garbage collector.
+        blobstore.collect_garbage(grace_seconds=0)
+        self.assertEqual(self.get_glb(), glb)
+
+    def test_not_built(self):
+        with self.assertRaises(Http404):
+            self.get_glb()
+
+class FakeS3Error(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+# The part of the S3 API that storage.S3Storage uses, in memory.
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+
+    def _get(self, Key):
+        if Key not in self.objects:
+            raise FakeS3Error('NoSuchKey')
+        return self.objects[Key]
+
+    def head_object(self, Bucket, Key):
+        data, modified = self._get(Key)
+        return {'ContentLength': len(data), 'LastModified': modified}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.gets += 1
+        data, _ = self._get(Key)
+        if Range:
+            data = data[int(Range[len('bytes='):].rstrip('-')):]
+        return {'Body': io.BytesIO(data)}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective=None):
+        self.put_object(Bucket, Key, self._get(CopySource['Key'])[0])
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = (bytes(Body), datetime.datetime.now(datetime.timezone.utc))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.put_object(Bucket, Key, Fileobj.read())
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.delete_object(Bucket, item['Key'])
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        return {'Contents': [
+            {'Key': key, 'Size': len(self.objects[key][0]), 'LastModified': self.objects[key][1]}
+            for key in keys]}
+
+class StorageTest(TestCase):
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+
+        patcher = mock.patch.object(blobstore, 'MODEL_DIR', self.model_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.model_dir, True)
+
+        self.model_file = io.BytesIO()
+        with zipfile.ZipFile(self.model_file, 'w') as zip_file:
+            zip_file.writestr('model.obj', 'v 0 0 0\n' * 1000)
+            zip_file.writestr('texture.png', bytes(range(256)) * 100)
+
+    def test_sharded_layout(self):
+        blobstore.store_revision(1234, 1, self.model_file)
+
+        key = blobstore.manifest_key(1234, 1)
+        self.assertRegex(key, r'^models/[0-9a-f]{2}/[0-9a-f]{2}/1234/1\.json$')
+        self.assertTrue(os.path.isfile(os.path.join(self.model_dir, *key.split('/'))))
+        self.assertFalse(os.path.exists(os.path.join(self.model_dir, '1234')))
+        self.assertEqual([(model_id, revision) for model_id, revision, _ in blobstore.iter_manifests()], [(1234, 1)])
+
+    def test_put_blob_touches_existing_blob(self):
+        digest, _ = blobstore.put_blob(io.BytesIO(b'shared texture'))
+        path = blobstore.get_storage().path(blobstore.blob_key(digest))
+        os.utime(path, (0, 0))
+
+        # Stored again by an upload whose manifest isn't written yet.
+        blobstore.put_blob(io.BytesIO(b'shared texture'))
+        self.assertEqual(blobstore.collect_garbage(grace_seconds=3600), (0, 0))
+        self.assertTrue(blobstore.has_blob(digest))
+
+    def age_blobs(self):
+        store = blobstore.get_storage()
+        for key, _ in store.list(blobstore.BLOB_PREFIX):
+            os.utime(store.path(key), (0, 0))
+
+    def test_collect_garbage_keeps_blobs_of_new_manifests(self):
+        store = blobstore.get_storage()
+        blobstore.store_revision(1, 1, self.model_file)
+        content = b''.join(blobstore.revision_chunks(1, 1))
+        manifest = store.read(blobstore.manifest_key(1, 1))
+        blobstore.delete_model(1)
+        self.age_blobs()
+
+        # An upload of the same files, whose manifest is written once the
+        # collector has already taken their blobs for unreferenced ones.
+        move = storage.FileSystemStorage.move
+        def move_during_upload(self, key, target):
+            move(self, key, target)
+            store.write(blobstore.manifest_key(2, 1), manifest)
+
+        with mock.patch.object(storage.FileSystemStorage, 'move', move_during_upload):
+            self.assertEqual(blobstore.collect_garbage(grace_seconds=3600), (0, 0))
+        self.assertEqual(b''.join(blobstore.revision_chunks(2, 1)), content)
+        self.assertEqual(list(store.list(blobstore.GARBAGE_PREFIX)), [])
+
+        blobstore.delete_model(2)
+        self.age_blobs()
+        self.assertEqual(blobstore.collect_garbage(grace_seconds=3600)[0], 2)
+
+    def test_store_revision_puts_back_collected_blobs(self):
+        store = blobstore.get_storage()
+        write = storage.FileSystemStorage.write
+        def collect_before_manifest(self, key, data):
+            # Blobs deleted between being touched and named by the manifest.
+            if key == blobstore.manifest_key(1, 1):
+                store.delete_prefix(blobstore.BLOB_PREFIX)
+            write(self, key, data)
+
+        with mock.patch.object(storage.FileSystemStorage, 'write', collect_before_manifest):
+            manifest = blobstore.store_revision(1, 1, self.model_file)
+
+        for member in manifest['members']:
+            self.assertTrue(blobstore.has_blob(member['sha256']))
+
+    def test_archive_info_matches_served_zip(self):
+        blobstore.store_revision(1, 1, self.model_file)
+        content = b''.join(blobstore.revision_chunks(1, 1))
+
+        self.assertEqual(blobstore.get_archive_info(1, 1), {
+            'size': len(content), 'sha256': hashlib.sha256(content).hexdigest()})
+
+        # Manifests written before version 2 get it added.
+        store = blobstore.get_storage()
+        manifest = json.loads(store.read(blobstore.manifest_key(1, 1)).decode())
+        del manifest['zip_size'], manifest['zip_sha256']
+        manifest['version'] = 1
+        store.write(blobstore.manifest_key(1, 2), json.dumps(manifest).encode())
+
+        self.assertEqual(blobstore.get_archive_info(1, 2), blobstore.get_archive_info(1, 1))
+        self.assertEqual(blobstore.get_manifest(1, 2)['zip_sha256'], hashlib.sha256(content).hexdigest())
+
+    def test_migrate_flat_models(self):
+        blobstore.store_revision(1, 1, self.model_file)
+        content = b''.join(blobstore.revision_chunks(1, 1))
+
+        # As stored before the layout was sharded.
+        os.rename(os.path.join(self.model_dir, *blobstore.sharded_model_key(1).split('/')),
+                  os.path.join(self.model_dir, '1'))
+        self.assertEqual(blobstore.model_key(1), '1')
+        self.assertEqual(b''.join(blobstore.revision_chunks(1, 1)), content)
+        self.assertEqual(len(list(blobstore.iter_manifests())), 1)
+
+        call_command('migrate_model_storage', stdout=io.StringIO())
+
+        self.assertEqual(blobstore.model_key(1), blobstore.sharded_model_key(1))
+        self.assertFalse(os.path.exists(os.path.join(self.model_dir, '1')))
+        self.assertEqual(b''.join(blobstore.revision_chunks(1, 1)), content)
+
+    def test_open_member_closes_legacy_zip(self):
+        legacy = io.BytesIO()
+        with zipfile.ZipFile(legacy, 'w') as zip_file:
+            # Read with ZipFile, as MemberFile only inflates.
+            zip_file.writestr('model.obj', 'v 1 1 1\n' * 1000, compress_type=zipfile.ZIP_BZIP2)
+        blobstore.get_storage().write(blobstore.legacy_revision_key(1, 1), legacy.getvalue())
+
+        opened = []
+        open_file = storage.FileSystemStorage.open
+        def record_open(self, key):
+            opened.append(open_file(self, key))
+            return opened[-1]
+
+        with mock.patch.object(storage.FileSystemStorage, 'open', record_open):
+            with blobstore.open_member(1, 1, 'model.obj') as f:
+                self.assertEqual(f.read(), b'v 1 1 1\n' * 1000)
+            self.assertTrue(opened[-1].closed)
+
+            # Members ZipFile can't read either.
+            with mock.patch.object(zipfile.ZipFile, 'open', side_effect=NotImplementedError):
+                with self.assertRaises(NotImplementedError):
+                    blobstore.open_member(1, 1, 'model.obj')
+            self.assertTrue(opened[-1].closed)
+
+    def test_s3_storage(self):
+        blobstore.store_revision(1, 1, self.model_file)
+        legacy = io.BytesIO()
+        with zipfile.ZipFile(legacy, 'w') as zip_file:
+            zip_file.writestr('model.obj', 'v 1 1 1\n' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        blobstore.get_storage().write(blobstore.legacy_revision_key(1, 2), legacy.getvalue())
+        content = b''.join(blobstore.revision_chunks(1, 1))
+
+        client = FakeS3Client()
+        s3 = storage.S3Storage('bucket', 'store/', client=client)
+        with mock.patch.object(storage, 's3_storage', lambda: s3):
+            call_command('migrate_model_storage', '--to-s3', '--delete', stdout=io.StringIO())
+
+        self.assertTrue(all(key.startswith('store/') for key in client.objects))
+        self.assertFalse(list(storage.FileSystemStorage(self.model_dir).list(blobstore.BLOB_PREFIX)))
+
+        with mock.patch.object(blobstore, 'get_storage', lambda: s3):
+            self.assertEqual(b''.join(blobstore.revision_chunks(1, 1)), content)
+            with blobstore.open_member(1, 2, 'model.obj') as f:
+                self.assertEqual(f.read(), b'v 1 1 1\n' * 1000)
+            self.assertTrue(s3.exists(blobstore.legacy_index_key(1, 2)))
+
+            self.assertTrue(blobstore.delete_model(1))
+            self.assertFalse(blobstore.has_revision(1, 1))
+            self.assertEqual(blobstore.collect_garbage(grace_seconds=0)[0], 2)
+            self.assertEqual([key for key in client.objects if '/blobs/' in key], [])
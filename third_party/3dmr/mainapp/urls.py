@@ -30,6 +30,10 @@ urlpatterns = [
 
     url(r'^api/model/(?P<model_id>[0-9]+)/(?P<revision>[0-9]+)$', api.get_model, name='get_model'),
     url(r'^api/model/(?P<model_id>[0-9]+)$', api.get_model, name='get_model'),
+    url(r'^api/model/(?P<model_id>[0-9]+)/(?P<revision>[0-9]+)/glb/(?P<level>[0-9]+)$', api.get_glb, name='get_glb'),
+    url(r'^api/model/(?P<model_id>[0-9]+)/(?P<revision>[0-9]+)/glb$', api.get_glb, name='get_glb'),
+    url(r'^api/model/(?P<model_id>[0-9]+)/glb/(?P<level>[0-9]+)$', api.get_glb, name='get_glb'),
+    url(r'^api/model/(?P<model_id>[0-9]+)/glb$', api.get_glb, name='get_glb'),
     url(r'^api/filelist/(?P<model_id>[0-9]+)/(?P<revision>[0-9]+)$', api.get_filelist, name='get_list'),
     url(r'^api/filelist/(?P<model_id>[0-9]+)$', api.get_filelist, name='get_list'),
     url(r'^api/file/(?P<model_id>[0-9]+)/(?P<revision>[0-9]+)/(?P<filename>.+)$', api.get_file, name='get_file'),
@@ -44,7 +48,10 @@ urlpatterns = [
 
     url(r'^api/search/?(?P<latitude>-?[0-9]+(\.[0-9]+)?)/(?P<longitude>-?[0-9]+(\.[0-9]+)?)/(?P<distance>[0-9]+(\.[0-9]+)?)/(?P<page_id>[0-9]+)$', api.search_range, name='lookup_range'),
     url(r'^api/search/(?P<latitude>-?[0-9]+(\.[0-9]+)?)/(?P<longitude>-?[0-9]+(\.[0-9]+)?)/(?P<distance>[0-9]+(\.[0-9]+)?)$', api.search_range, name='lookup_range'),
+    url(r'^api/nearest/(?P<latitude>-?[0-9]+(\.[0-9]+)?)/(?P<longitude>-?[0-9]+(\.[0-9]+)?)/(?P<k>[0-9]+)$', api.search_nearest, name='search_nearest'),
+    url(r'^api/nearest/(?P<latitude>-?[0-9]+(\.[0-9]+)?)/(?P<longitude>-?[0-9]+(\.[0-9]+)?)$', api.search_nearest, name='search_nearest'),
     url(r'^api/search/title/(?P<title>.*)/(?P<page_id>[0-9]+)$', api.search_title, name='search_title'),
     url(r'^api/search/title/(?P<title>.*)$', api.search_title, name='search_title'),
     url(r'^api/search/full$', api.search_full, name='search_full'),
+    url(r'^api/tiles/(?P<zoom>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)$', api.get_tile, name='get_tile'),
 ]
@@ -33,9 +33,20 @@ LICENSES_DISPLAY = {
 }
 
 # The possible changes users can make to the repository
+CHANGE_UPLOAD = 0
+CHANGE_REVISE = 1
+CHANGE_EDIT = 2
+CHANGE_HIDE = 3
+CHANGE_UNHIDE = 4
+CHANGE_DELETE = 5
+
 CHANGES = {
-    0: 'Upload',
-    1: 'Revise',
+    CHANGE_UPLOAD: 'Upload',
+    CHANGE_REVISE: 'Revise',
+    CHANGE_EDIT: 'Edit',
+    CHANGE_HIDE: 'Hide',
+    CHANGE_UNHIDE: 'Unhide',
+    CHANGE_DELETE: 'Delete',
 }
 
 # The directory the models will be stored in
@@ -13,6 +13,7 @@ from .models import Model, LatestModel, Comment, Category, Change, Ban, Location
 from .forms import UploadFileForm, UploadFileMetadataForm, MetadataForm
 from .utils import get_kv, update_last_page, get_last_page, MODEL_DIR, CHANGES, admin, LICENSES_DISPLAY
 from . import database 
+from .search import search_text
 from .markdown import markdown
 
 logger = logging.getLogger(__name__)
@@ -31,7 +32,8 @@ def index(request):
     update_last_page(request)
 
     MODELS_IN_INDEX_PAGE = 6
-    models = LatestModel.objects.order_by('-pk')
+    # The panels show the author and categories of each model.
+    models = LatestModel.objects.select_related('author').prefetch_related('categories').order_by('-pk')
 
     if not admin(request):
         models = models.filter(is_hidden=False)
@@ -71,7 +73,7 @@ def model(request, model_id, revision=None):
     if model.is_hidden and not admin(request):
         raise Http404('Model does not exist.')
 
-    comments = Comment.objects.filter(model__model_id=model_id)
+    comments = Comment.objects.filter(model__model_id=model_id).select_related('author')
 
     if not admin(request):
         comments = comments.filter(is_hidden=False)
@@ -107,35 +109,35 @@ def search(request):
     if category:
         url_params += 'category=' + category
 
-    models = Model.objects
+    models = LatestModel.objects.select_related('author').prefetch_related('categories')
 
     if tag:
         try:
             key, value = get_kv(tag)
         except ValueError:
             return redirect(index)
-        filtered_models = models.filter(tags__contains={key: value})
+        filtered_models = models.filter(tags__contains={key: value}).order_by('-pk')
     elif category:
-        filtered_models = models.filter(categories__name=category)
+        filtered_models = models.filter(categories__name=category).order_by('-pk')
     elif query:
-        filtered_models = \
-            models.filter(title__icontains=query) | \
-            models.filter(description__icontains=query)
+        # Ordered by relevance
+        filtered_models = search_text(models.all(), query)
 
     try:
         if not admin(request):
             filtered_models = filtered_models.filter(is_hidden=False)
 
-        ordered_models = filtered_models.order_by('-pk')
+        ordered_models = filtered_models
     except UnboundLocalError:
         # filtered_models isn't set, redirect to homepage
         return redirect(index)
 
-    if not ordered_models:
+    # Counting is cheaper than fetching every match to see if there are any.
+    paginator = Paginator(ordered_models, RESULTS_PER_PAGE)
+    if paginator.count == 0:
         results = None
         paginator = None
     else:
-        paginator = Paginator(ordered_models, RESULTS_PER_PAGE)
         try:
             results = paginator.page(page_id)
         except EmptyPage:
@@ -183,7 +185,8 @@ def edit(request, model_id, revision):
                 'scale': form.cleaned_data['scale'],
                 'license': form.cleaned_data['license'],
                 'model_id': model_id,
-                'revision': revision
+                'revision': revision,
+                'author': request.user
             })
 
             if status:
@@ -287,7 +290,7 @@ def delete(request, model_id):
         messages.error(request, 'You must be the author of the model to delete it.')
         return redirect(model, model_id=m.model_id, revision=m.revision)
 
-    if database.delete_model(options={'model_id': model_id}):
+    if database.delete_model(options={'model_id': model_id, 'author': request.user}):
         logger.info('Deleted model id: {}'.format(model_id))
     else:
         messages.error(request, 'Server error. Try again later.')
@@ -369,12 +372,12 @@ def user(request, username):
 
     user = get_object_or_404(User, username=username)
 
-    models = user.latestmodel_set.order_by('-pk')
+    models = user.latestmodel_set.select_related('author').prefetch_related('categories').order_by('-pk')
 
     if not admin(request):
         models = models.filter(is_hidden=False)
 
-    changes = user.change_set.order_by('-pk')[:10] # get the 10 latest changes
+    changes = user.change_set.select_related('model').order_by('-pk')[:10] # get the 10 latest changes
 
     try:
         page_id = int(request.GET.get('page', 1))
@@ -552,13 +555,11 @@ def hide_model(request):
 
     try:
         if action == 'hide':
-            hidden_model.is_hidden = True
+            database.set_hidden(hidden_model, True, request.user)
         elif action == 'unhide':
-            hidden_model.is_hidden = False
+            database.set_hidden(hidden_model, False, request.user)
         else:
             raise ValueError('Invalid argument for action.')
-
-        hidden_model.save()
     except ValueError:
         messages.error(request, 'An error occurred. Please try again.')
 
@@ -0,0 +1,102 @@
+import time
+import zipfile
+
+# Size of the reads from member files, and the threshold at which buffered
+# archive bytes are handed to the consumer.
+CHUNK_SIZE = 64 * 1024
+
+# Write-only, unseekable file object for zipfile to write into. Since it
+# can't seek, zipfile writes data descriptors after each member instead of
+# rewriting the local headers, which is what lets us hand out bytes as soon
+# as they're written.
+class _StreamSink(object):
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def pending(self):
+        return len(self._buffer)
+
+    def pop(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+# Builds a zip archive incrementally. Every method is a generator yielding
+# the archive bytes produced so far, so at most about CHUNK_SIZE bytes are
+# held in memory regardless of the size of the archive, e.g.:
+#
+#   stream = ZipStream()
+#   yield from stream.write_file('/some/path.zip', 'path.zip')
+#   yield from stream.write_str('metadata.json', '{}')
+#   yield from stream.close()
+#
+# Members are dated with the current time, or |date_time| if given, which
+# makes archives of the same contents identical.
+class ZipStream(object):
+    def __init__(self, compression=zipfile.ZIP_STORED, date_time=None):
+        self._date_time = date_time
+        self._sink = _StreamSink()
+        self._zip = zipfile.ZipFile(self._sink, 'w', compression, allowZip64=True)
+
+    def write_file(self, path, arcname):
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = self._zip.compression
+
+        with open(path, 'rb') as src:
+            yield from self.write_fileobj(zinfo, src)
+
+    def write_fileobj(self, zinfo, fileobj):
+        with self._zip.open(zinfo, 'w') as dest:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                dest.write(chunk)
+                yield from self._drain()
+
+        yield from self._drain()
+
+    # Writes a member whose contents are produced by the iterable |chunks|,
+    # e.g. another archive that is itself being streamed.
+    def write_chunks(self, arcname, chunks):
+        with self._zip.open(self._zinfo(arcname), 'w') as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+                yield from self._drain()
+
+        yield from self._drain()
+
+    # |arcname| may also be a ZipInfo, as with ZipFile.writestr().
+    def write_str(self, arcname, data):
+        if isinstance(arcname, zipfile.ZipInfo):
+            zinfo = arcname
+        else:
+            zinfo = self._zinfo(arcname)
+
+        self._zip.writestr(zinfo, data)
+
+        yield from self._drain()
+
+    def close(self):
+        self._zip.close()
+
+        yield from self._drain(force=True)
+
+    def _zinfo(self, arcname):
+        zinfo = zipfile.ZipInfo(arcname, self._date_time or time.localtime(time.time())[:6])
+        zinfo.compress_type = self._zip.compression
+        zinfo.external_attr = 0o644 << 16
+        return zinfo
+
+    def _drain(self, force=False):
+        if self._sink.pending() >= CHUNK_SIZE or (force and self._sink.pending()):
+            yield self._sink.pop()